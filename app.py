@@ -10,28 +10,39 @@ Handy links
 
 """
 
-from flask import Flask, Response, redirect, url_for, render_template, flash, g, request, abort
+from flask import Flask, Request, Response, redirect, url_for, render_template, flash, g, request, abort, jsonify, get_template_attribute, make_response, session
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
 from flask_bootstrap import Bootstrap
-from flask_restful import Resource, Api
 from flask_dropzone import Dropzone
 
 from flask_restful import Resource as FlaskRestResource
 from flask_restful import reqparse as FlaskRestReqparse
 from flask_restful import Api as FlaskRestAPI
-from flask_restful import request as FlaskRestRequest
 
-import urllib
-import os,sys,requests
+import os,sys
 import dotenv 
-import pdb # for debugging
-import pprint
 import json
-import socket # to talk to serial port sender
-
-import requests # for slack
+import time
+import zlib
+import sender_client # to talk to serial port sender
+import send_plan # precompiled send plans for the serial sender
+import file_index # cached metadata for the uploaded files
+import send_metrics # serial line metrics, prometheus format
+import upload_store # uploads streamed straight into UPLOAD_PATH
+import gcode_preflight # program stats for uploaded files, background thread
+import gcode_motion # run time model, for durations in templates
+import gcode_arcs # arc fitting setting, for the upload message
+import gcode_resume # restart points, for the send page
+import upload_watcher # inotify, keeps the file index up to date
+
+class UploadRequest(Request):
+    # uploaded files are written as they arrive to a hashing temp file in
+    # UPLOAD_PATH instead of being buffered, see upload_store.py
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_store.HashingTempFile(upload_path, max_upload_size)
 
 flask_app = Flask(__name__)
+flask_app.request_class = UploadRequest
 Bootstrap(flask_app) # bootstrap-a-ma-tize flask
 flask_rest_api = FlaskRestAPI(flask_app) # rest-a-ma-tize flask
 #flask_app.config['BOOTSTRAP_SERVE_LOCAL'] = True # tell bootstrap NOT to fetch from CDNs
@@ -53,13 +64,22 @@ upload_path          = os.environ['UPLOAD_PATH']
 serial_tcp_port      = int(os.environ['SERIAL_TCP_PORT'])
 #slack_webhook_url    = os.environ['SLACK_WEBHOOK_URL']
 
+max_upload_size      = upload_store.max_upload_size() # bytes per file
+flask_app.config['DROPZONE_MAX_FILE_SIZE'] = max_upload_size // (1024 * 1024) # MB
+
+upload_index = file_index.FileIndex(upload_path) # shared by all workers
+preflight = gcode_preflight.PreflightRunner(upload_index) # one thread per worker
+sender = sender_client.SenderClient.from_environment() # one connection per worker
+
 login_manager            = LoginManager(flask_app) # login manager setup
 login_manager.login_view = 'login'
-pp = pprint.PrettyPrinter(stream=sys.stderr) # for debugging
 
 def e(s):
     sys.stderr.write(s)
 
+# e.g. {{ seconds | duration }} is "1:02:03"
+flask_app.add_template_filter(gcode_motion.format_duration, 'duration')
+
 class User(UserMixin):
     def __init__(self,id):
         self.id = id
@@ -91,6 +111,7 @@ def login():
         id = args['username']
         user = User(id)
         login_user(user)
+        flash('You are logged in','success')
         return redirect('/')
     else:
         return abort(401)
@@ -118,12 +139,53 @@ def page_not_found(e):
 def load_user(userid):
     return User(userid)
 
+# ------------
+# rendered pages are cached per worker, keyed on the file index generation
+# (bumped whenever a file, its plan or its preflight changes), and sent
+# with an ETag so a browser reloading an unchanged page gets a 304
+PAGE_CACHE_SIZE = 64
+page_cache = {} # etag: html or json
+
+def templates_version():
+    # changes when the app or its templates are updated, so a browser never
+    # keeps a page from before an update with the same generation
+    names = ['app.py'] + [os.path.join('templates', n) for n in sorted(os.listdir(os.path.join(flask_app.root_path, 'templates')))]
+    stamp = ' '.join('%s %d' % (n, os.stat(os.path.join(flask_app.root_path, n)).st_mtime_ns) for n in names)
+    return '%08x' % zlib.crc32(stamp.encode('utf-8'))
+
+page_version = templates_version()
+
+def cached_page(render, *key, mimetype='text/html'):
+    # render() unless the same page for the same generation is cached;
+    # key is whatever else the page shows (args, sender state)
+    if session.get('_flashes') or not upload_watcher.watching(upload_path):
+        # flashes are shown once; without the watcher the generation
+        # doesn't see files changed by hand
+        response = make_response(render())
+        response.mimetype = mimetype
+        return response
+    etag = '%s-%x-%08x' % (page_version, upload_index.generation.value(),
+                           zlib.crc32(json.dumps([request.path, getattr(current_user, 'id', None)] + list(key),
+                                                 sort_keys=True, default=str).encode('utf-8')))
+    html = page_cache.get(etag)
+    if html is None and etag not in request.if_none_match:
+        html = render()
+        if len(page_cache) >= PAGE_CACHE_SIZE:
+            page_cache.clear()
+        page_cache[etag] = html
+    response = make_response(html or '')
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache' # always ask
+    return response.make_conditional(request)
+
 @flask_app.route('/completed')
 def completed():
-    global g
-    g.files_uploaded = get_files_uploaded()
-    g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
-    return render_template('index.html')
+    def render():
+        global g
+        g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
+        return render_template('index.html')
+    return cached_page(render)
 
 @flask_app.route("/dzupload", methods=['GET', 'POST'])
 def dzupload():
@@ -135,8 +197,7 @@ def dzupload():
                         flash('File NOT uploaded','error')
                         return render_template("index.html")
                     else:
-                        image.save(os.path.join(upload_path,image.filename))
-                        flash('file ' + image.filename + ' uploaded','success')
+                        save_uploaded_file(image)
 
     return render_template("index.html")
 
@@ -150,36 +211,125 @@ def upload_file():
                     flash('File NOT uploaded','error')
                     return render_template("index.html")
                 else:
-                    image.save(os.path.join(upload_path,image.filename))
-                    flash('file ' + image.filename + ' uploaded','success')
+                    save_uploaded_file(image)
 
     global g
-    g.files_uploaded = get_files_uploaded()
     g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
     return render_template("index.html")
 
+def save_uploaded_file(image):
+    # rename the streamed upload into place, then make its send plan
+    try:
+        upload = upload_store.save_upload(image.stream, os.path.join(upload_path,image.filename),
+                                          max_upload_size)
+    except OSError as err:
+        e('could not save upload %s: %s\n' % (image.filename,err))
+        flash('file ' + image.filename + ' NOT uploaded','error')
+        return
+    plan = make_send_plan(image.filename, upload)
+    if plan is None:
+        # the preflight makes the plan, the send page shows its crc
+        flash('file ' + image.filename + ' uploaded','success')
+    elif send_plan.compaction_enabled() or gcode_arcs.arc_tolerance_mm():
+        # the preflight compacts or arc fits the plan, which changes the crc
+        flash('file %s uploaded, crc: %08X before compaction and arc fitting' % (image.filename, plan.crc32_value),'success')
+    else:
+        # same crc the sender shows when the file has been sent
+        flash('file %s uploaded, crc: %08X' % (image.filename, plan.crc32_value),'success')
+
+def make_send_plan(fn, upload=None):
+    # the same bytes uploaded before already have a send plan.  Else the
+    # background preflight compiles it, which takes a while for a big file,
+    # and until then the serial sender reads the file itself
+    plan = None
+    try:
+        if upload and upload.get('deduplicated'):
+            plan = send_plan.SendPlan.load(os.path.join(upload_path,fn))
+    except OSError as err:
+        e('could not load send plan for %s: %s\n' % (fn,err))
+    upload_index.refresh(fn)
+    if not upload_watcher.watching(upload_path):
+        preflight.submit(fn) # else the watching worker does it
+    return plan
+
+@flask_app.errorhandler(upload_store.UploadTooLarge)
+def upload_too_large(err):
+    flash('file NOT uploaded, bigger than %d MB' % (max_upload_size // (1024 * 1024)),'error')
+    global g
+    g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
+    return render_template("index.html"), 413
+
+def need_preflight(files):
+    # queue preflights for files that have none, or an old one
+    for fi in files:
+        if fi['preflight'] is None or \
+                fi['preflight'].get('version') != gcode_preflight.PREFLIGHT_VERSION:
+            fi['preflight'] = None
+            preflight.submit(fi['file_name'])
+    return files
+
+def upload_changed(fn):
+    # a file was uploaded, copied in or changed, see upload_watcher.py.
+    # its preflight compiles the send plan if it has none
+    fi = upload_index.file_info(fn) # refreshes its entry if it changed
+    if fi is not None:
+        need_preflight([fi])
+
+def upload_removed(fn):
+    # a file was deleted or renamed away, drop it and a plain file's plan
+    upload_index.forget(fn)
+    send_plan.remove_plan(os.path.join(upload_path,fn))
+
+# one worker watches UPLOAD_PATH, the rest take over if it goes away
+watcher = upload_watcher.UploadWatcher(upload_index, upload_changed, upload_removed)
+
+@flask_app.before_request
+def start_watcher():
+    # started in each worker, not at import, so gunicorn's preload forks no
+    # threads; gunicorn.conf.py starts it as soon as the worker is forked
+    watcher.start()
+
 def get_first_line(fn):
-    f = open(os.path.join(upload_path,fn),'r')
-    # Skip blank lines and skip '%' line
-    while True:
-        line = f.readline()
-        if line == '':    # EOF
-            break
-        line = line.rstrip()
-        if line == '%' or line == '':
-            continue
-        break
-
-    return line
-
-def get_files_uploaded():
-    file_names = os.listdir(upload_path)
-    file_names.sort()
-    o = []
-    for fns in  file_names:
-        fi = {'file_name':fns,'first_line':get_first_line(fns)}
-        o.append(fi)
-    return o
+    # first line from the index, skipping blank lines and '%' line
+    fi = upload_index.file_info(fn)
+    if fi is None:
+        return ''
+    return fi['first_line']
+
+# ------------
+# the file list, a page at a time for the index page, see static/file_list.js
+@flask_app.route('/files')
+@login_required
+def files():
+    # ?sort=name|mtime|size &order=desc &q=search &match=prefix &cursor= &limit=
+    limit = max(1, min(request.args.get('limit', file_index.PAGE_SIZE, type=int),
+                       file_index.MAX_PAGE_SIZE))
+    search = request.args.get('q', '')
+    prefix = request.args.get('match') == 'prefix'
+    cursor = request.args.get('cursor') or None
+    def render():
+        if cursor is None and not upload_watcher.watching(upload_path):
+            # first page, one stat scan, only changed files get read
+            upload_index.sync()
+        page, next_cursor = upload_index.page(request.args.get('sort', 'name'),
+                                              request.args.get('order') == 'desc',
+                                              search, prefix, cursor, limit)
+        summary_line = get_template_attribute('preflight.html', 'summary_line')
+        ret = {'error': 0, 'next': next_cursor,
+               'files': [{'file_name': f['file_name'], 'first_line': f['first_line'],
+                          'size': f['size'], 'mtime': f['mtime'], 'lines': f['lines'],
+                          'summary': str(summary_line(f))}
+                         for f in need_preflight(page)]}
+        if cursor is None:
+            ret['total'] = upload_index.count(search, prefix)
+        return json.dumps(ret)
+    try:
+        # the same generation and args give the same page, so a repeat
+        # costs no sqlite or template work, and a browser gets a 304
+        return cached_page(render, sorted(request.args.items(multi=True)),
+                           mimetype='application/json')
+    except ValueError as err: # bad sort or cursor
+        return jsonify({'error': 1, 'message': str(err)}), 400
 
 
 class rest_cmd(FlaskRestResource):
@@ -187,54 +337,139 @@ class rest_cmd(FlaskRestResource):
     # REST communications with browser 
     def put(self):
         # curl localhost/api -X PUT -d 'cmd=start' -d 'go
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        e('connecting to serial sender...\n')
-        try:
-            sock.connect(('localhost',serial_tcp_port))
-        except:
-            return {'error': 1, 'message': 'could not connect to serial sender socket'}
-
-        e('done\n')
-
         rp = FlaskRestReqparse.RequestParser()
         rp.add_argument('cmd')
         rp.add_argument('file')
+        rp.add_argument('machine') # which serial port, default if None
+        rp.add_argument('job',type=int) # queued job number for cancel, move
+        rp.add_argument('position',type=int) # where move puts it, 0 is next
+        rp.add_argument('auto',type=int) # enqueue: start when the one before is sent
+        rp.add_argument('line',type=int) # resume: line in the file to restart at
+        rp.add_argument('safe',type=int) # resume: 0 for that very line, not a safe point before it
         args = rp.parse_args()
 
         if (args['cmd'] == 'start' or 
             args['cmd'] == 'stop' or 
-            args['cmd'] == 'status'):
-            # send command to the serial listener
-            arg_as_str = json.dumps(args)
-            arg_as_bytes = arg_as_str.encode('utf-8')
-            sock.sendall(arg_as_bytes)
-
-						# get line line reply
-            rx_mesg_bytes = sock.recv(1024)
-            rx_mesg_str = rx_mesg_bytes.decode('utf-8')
-            rx_mesg_obj = json.loads(rx_mesg_str)
-
-            #pdb.set_trace()
-            ret = rx_mesg_obj
-
+            args['cmd'] == 'status' or
+            args['cmd'] in ('enqueue', 'queue', 'cancel', 'move', 'resume')):
+            # send command to the serial listener over this worker's
+            # persistent connection
+            try:
+                ret = sender.request(args)
+            except sender_client.SenderError as err:
+                e('%s\n' % err)
+                return {'error': 1, 'message': 'could not connect to serial sender socket'}
+        else:
+            ret = {'error': 1, 'message': 'Unknown command'}
 
-        sock.close()
         return ret
 
 flask_rest_api.add_resource(rest_cmd,'/api')
 #--
 
+# ------------
+# server push of status changes to the browser
+SSE_KEEPALIVE_SECS = 15   # comment line to notice browsers that went away
+SSE_MAX_SECS = 300        # end the stream now and then, browser reconnects
+SSE_RETRY_MS = 2000       # how soon the browser reconnects
+
+@flask_app.route('/events')
+@login_required
+def events():
+    # Server-Sent Events stream of status changes from the serial sender.
+    # The browser falls back to polling /api if this is not working.
+    def stream():
+        yield 'retry: %d\n\n' % SSE_RETRY_MS
+        end_time = time.time() + SSE_MAX_SECS
+        try:
+            for event in sender.events(keepalive=SSE_KEEPALIVE_SECS):
+                if time.time() > end_time:
+                    break
+                if event is None:
+                    yield ': keepalive\n\n'
+                elif 'event' in event:
+                    yield 'data: %s\n\n' % json.dumps(event)
+        except sender_client.SenderError as err:
+            e('%s\n' % err)
+            yield 'data: %s\n\n' % json.dumps(
+                {'event': 'error', 'error': 1, 'message': 'could not connect to serial sender socket'})
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# ------------
+# serial line metrics for prometheus. Plain numbers only, no file names,
+# so no login, the scraper can't log in.
+@flask_app.route('/metrics')
+def metrics():
+    # one set per machine, labeled with its name
+    try:
+        names = [m['machine'] for m in sender.request({'cmd': 'machines'}).get('machines', [])]
+        rets = sender.request_many([{'cmd': 'metrics', 'machine': n} for n in names])
+    except sender_client.SenderError as err:
+        e('%s\n' % err)
+        return Response('could not connect to serial sender socket\n',
+                        status=503, mimetype='text/plain')
+    return Response(send_metrics.prometheus_text(
+                        {n: ret.get('metrics', {}) for n, ret in zip(names, rets)}),
+                    mimetype='text/plain; version=0.0.4')
+
 # ------------
 # http routes
 @flask_app.route('/send')
 @login_required
 def send_file():
-    global g
-    g.files_uploaded = [] 
     fns = request.args.get('file_to_send')
-    g.files_uploaded.append( {'file_name':fns,'first_line':get_first_line(fns)} )
-    g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
-    return render_template('send.html')
+    machine = request.args.get('machine')
+    machines = get_machines()
+    queue = get_queue(machine)
+    def render():
+        global g
+        g.files_uploaded = [] 
+        fi = upload_index.file_info(fns) if fns else None
+        if fi is None:
+            fi = {'file_name':fns,'first_line':get_first_line(fns),'preflight':None}
+        else:
+            need_preflight([fi])
+        g.files_uploaded.append(fi)
+        g.machines = machines
+        g.machine = machine
+        g.queue = queue
+        g.tool_changes = get_tool_changes(fns)
+        g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
+        return render_template('send.html')
+    # the page shows the machine names and the queue, not their status
+    return cached_page(render, fns, machine, [m.get('machine') for m in machines], queue)
+
+def get_tool_changes(file_name):
+    # restart-safe tool changes from the preflight's resume index, if any
+    if not file_name:
+        return []
+    path = os.path.join(upload_path, file_name)
+    try:
+        plan = send_plan.SendPlan.load(path)
+    except OSError:
+        return []
+    index = gcode_resume.ResumeIndex.load(path, plan) if plan else None
+    if index is None:
+        return []
+    return [p for p in index.points if p['kind'] == 'tool']
+
+def get_queue(machine):
+    # files waiting to be sent on machine, the sender's default if None
+    try:
+        return sender.request({'cmd': 'queue', 'machine': machine}).get('queue', [])
+    except sender_client.SenderError as err:
+        e('%s\n' % err)
+        return []
+
+def get_machines():
+    # name, serial port and status of each machine the sender drives
+    try:
+        return sender.request({'cmd': 'machines'}).get('machines', [])
+    except sender_client.SenderError as err:
+        e('%s\n' % err)
+        return []
 
 
 @flask_app.route('/file_action', methods=["POST"])
@@ -244,14 +479,14 @@ def file_action():
 
     if 'file_to_delete' in request.form:
       try:
-          os.unlink(os.path.join(upload_path,request.form['file_to_delete']))
+          upload_store.remove_upload(os.path.join(upload_path,request.form['file_to_delete']))
+          upload_index.forget(request.form['file_to_delete'])
       except:
           flash(request.form['file_to_delete']  + '  ' + 'probably already deleted')  
       else:
           flash(request.form['file_to_delete']  + '  ' + 'deleted')  
 
       global g
-      g.files_uploaded = get_files_uploaded()
       g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
       return render_template("index.html")
 
@@ -261,11 +496,11 @@ def file_action():
 @flask_app.route('/')
 @login_required
 def index():
-  flash('You are logged in','success')
-  global g
-  g.files_uploaded = get_files_uploaded()
-  g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
-  return render_template('index.html')
+  def render():
+    global g
+    g.kiosk_user_name = os.environ['KIOSK_USER_NAME']
+    return render_template('index.html')
+  return cached_page(render)
 
 ################################################################################
 # Execution starts here
@@ -0,0 +1,446 @@
+"""
+
+file_index.py - cached metadata for the files in UPLOAD_PATH
+
+Listing the uploaded files used to open and read every file on every page
+render.  This keeps what we show about each file (first line, size, mtime,
+line count) in a small sqlite database in UPLOAD_PATH so it is shared by
+all the web server workers and survives restarts.
+
+A sync is one scan of the directory with stat().  Only files that are
+new, or whose size or mtime changed, are opened and read again.  While
+the upload watcher runs (see upload_watcher.py) it keeps the index up to
+date as files come and go, and requests don't need to sync at all.
+
+The size shown is of the G-code, counted as the file is read, since the
+size on disk of a compressed upload says little about it.  The time shown
+is of the name itself, when it was uploaded or copied in, not of the blob
+it links to (see upload_store.py), which is as old as the first upload of
+the same bytes.  The size and mtime of what the name links to are kept
+only to notice changes, and to match preflight summaries to them.
+
+The file list page gets the files a page at a time with page(), sorted by
+name, mtime or size and searched by name and first line, straight from the
+index with a cursor, so a page costs the same however many files there
+are.
+
+Every change to the index bumps a generation counter, kept in a tiny
+shared file next to it, so the web app can tell whether anything it shows
+about the files could have changed without looking at the directory or
+the database (see cached_page() in app.py).
+
+The preflight summary of each file (see gcode_preflight.py) is kept here
+too, with the size and mtime it was made from, so a stale one is never
+shown.  Names that link to the same blob (see upload_store.py) can share one,
+see shared_preflight().
+
+"""
+
+import os
+import json
+import mmap
+import fcntl
+import base64
+import struct
+import sqlite3
+import threading
+from typing import Optional, List, Tuple
+
+import send_plan
+import upload_store
+
+INDEX_FILE_NAME = ".index.sqlite"   # Hidden file in UPLOAD_PATH
+SCHEMA_VERSION = 3                  # PRAGMA user_version
+GENERATION_FILE_NAME = ".generation"
+GENERATION_FORMAT = struct.Struct("<Q")
+
+READ_CHUNK_SIZE = 1024 * 1024
+PAGE_SIZE = 50                      # Files per page()
+MAX_PAGE_SIZE = 200
+SORT_COLUMNS = {"name": "name", "mtime": "name_mtime_ns",
+                "size": "gcode_size"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name        TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    name_mtime_ns INTEGER NOT NULL,
+    gcode_size  INTEGER NOT NULL,
+    first_line  TEXT NOT NULL,
+    lines       INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS preflight (
+    name        TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    summary     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_by_mtime ON files (name_mtime_ns, name);
+CREATE INDEX IF NOT EXISTS files_by_size ON files (gcode_size, name)
+"""
+
+
+class FileIndex:
+    """ Metadata index for the uploaded files in one directory. """
+    def __init__(self, upload_path: str):
+        self.upload_path = upload_path
+        self.db_file = os.path.join(upload_path, INDEX_FILE_NAME)
+        self._local = threading.local()     # One connection per thread
+        self._generation: Optional[Generation] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """ This thread's connection to the index database. """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_file, timeout=10.0)
+            db.row_factory = sqlite3.Row
+            # WAL lets the workers read while one of them is writing.
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            if db.execute("PRAGMA user_version").fetchone()[0] < \
+                    SCHEMA_VERSION:
+                upgrade(db)
+            self._local.db = db
+        return db
+
+    @property
+    def generation(self) -> "Generation":
+        """ The counter bumped whenever the index changes. """
+        if self._generation is None:
+            self._generation = Generation(
+                os.path.join(self.upload_path, GENERATION_FILE_NAME))
+        return self._generation
+
+    def listing(self) -> List[dict]:
+        """ Return info for all uploaded files, sorted by name.
+
+            Refreshes the index for any file that changed since it
+            was last seen, and forgets files that are gone.
+        """
+        self.sync()
+        rows = self.db.execute(PAGE_SELECT + " ORDER BY f.name")
+        return [row_to_info(row, joined_preflight(row)) for row in rows]
+
+    def sync(self) -> List[str]:
+        """ Bring the index up to date with the directory: refresh any
+            file that changed since it was last seen, and forget files
+            that are gone.  Returns the names that were refreshed.
+        """
+        on_disk = {}
+        with os.scandir(self.upload_path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    # skip hidden files and dirs like the send plans
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    name_st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue    # Deleted while we were looking.
+                on_disk[entry.name] = (st.st_size, st.st_mtime_ns,
+                                       name_st.st_mtime_ns)
+
+        db = self.db
+        indexed = {row['name']: (row['size'], row['mtime_ns'],
+                                 row['name_mtime_ns']) for row in
+                   db.execute("SELECT name, size, mtime_ns, name_mtime_ns"
+                              " FROM files")}
+        changed = [name for name, seen in on_disk.items()
+                   if indexed.get(name) != seen]
+        for name in changed:
+            self.refresh(name)
+
+        preflights = [row['name'] for row in
+                      db.execute("SELECT name FROM preflight")]
+        gone = [(name,) for name in set(indexed) | set(preflights)
+                if name not in on_disk]
+        if gone:
+            with db:
+                db.executemany("DELETE FROM files WHERE name = ?", gone)
+                db.executemany("DELETE FROM preflight WHERE name = ?", gone)
+            self.generation.bump()
+        return changed
+
+    def page(self, sort: str = "name", descending: bool = False,
+             search: str = "", prefix: bool = False,
+             cursor: Optional[str] = None,
+             limit: int = PAGE_SIZE) -> Tuple[List[dict], Optional[str]]:
+        """ One page of the files in the index, sorted by sort (a key of
+            SORT_COLUMNS) then name.
+
+            With search, only files whose name or first line has it in
+            them (case blind), or starts with it if prefix.  cursor is
+            from the page before, None for the first page.
+
+            Returns (files, cursor of the next page or None).  The index
+            is not synced first, see sync().
+            Raises ValueError for an unknown sort or a bad cursor.
+        """
+        column = "f." + SORT_COLUMNS[sort] if sort in SORT_COLUMNS else None
+        if column is None:
+            raise ValueError(f"can't sort by {sort!r}")
+        where, params = search_where(search, prefix)
+        if cursor is not None:
+            key, name = decode_cursor(cursor)
+            after = "<" if descending else ">"
+            if sort == "name":
+                where.append(f"f.name {after} ?")
+                params.append(name)
+            else:
+                where.append(f"({column} {after} ? OR"
+                             f" ({column} = ? AND f.name {after} ?))")
+                params.extend((key, key, name))
+        order = "DESC" if descending else "ASC"
+        sql = PAGE_SELECT
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {column} {order}, f.name {order} LIMIT ?"
+        rows = self.db.execute(sql, params + [limit + 1]).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(last[SORT_COLUMNS[sort]], last['name'])
+        return [row_to_info(row, joined_preflight(row)) for row in rows], \
+            next_cursor
+
+    def count(self, search: str = "", prefix: bool = False) -> int:
+        """ How many files page() would go through with search. """
+        where, params = search_where(search, prefix)
+        sql = "SELECT count(*) FROM files f"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return self.db.execute(sql, params).fetchone()[0]
+
+    def file_info(self, name: str) -> Optional[dict]:
+        """ Return info for one file, or None if it does not exist. """
+        path = os.path.join(self.upload_path, name)
+        try:
+            st = os.stat(path)
+            name_st = os.lstat(path)
+        except OSError:
+            return None
+        row = self.db.execute("SELECT * FROM files WHERE name = ?",
+                              (name,)).fetchone()
+        if row is None or row['size'] != st.st_size or \
+                row['mtime_ns'] != st.st_mtime_ns or \
+                row['name_mtime_ns'] != name_st.st_mtime_ns:
+            row = self.refresh(name)
+            if row is None:
+                return None
+        preflight = self.db.execute("SELECT * FROM preflight WHERE name = ?",
+                                    (name,)).fetchone()
+        return row_to_info(row, preflight)
+
+    def refresh(self, name: str) -> Optional[sqlite3.Row]:
+        """ Read the file and update its index entry.
+            Returns the new row, or None if the file can't be read.
+        """
+        path = os.path.join(self.upload_path, name)
+        try:
+            st = os.stat(path)
+            name_st = os.lstat(path)
+            first_line, lines, gcode_size = scan_file(path)
+        except OSError:
+            self.forget(name)
+            return None
+
+        db = self.db
+        with db:
+            db.execute("INSERT OR REPLACE INTO files"
+                       " (name, size, mtime_ns, name_mtime_ns, gcode_size,"
+                       " first_line, lines) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (name, st.st_size, st.st_mtime_ns,
+                        name_st.st_mtime_ns, gcode_size, first_line, lines))
+        self.generation.bump()
+        return db.execute("SELECT * FROM files WHERE name = ?",
+                          (name,)).fetchone()
+
+    def set_preflight(self, name: str, size: int, mtime_ns: int,
+                      summary: dict) -> None:
+        """ Save the preflight summary made from the file at size and
+            mtime_ns.  It is only shown while the file still matches.
+        """
+        db = self.db
+        with db:
+            db.execute("INSERT OR REPLACE INTO preflight"
+                       " (name, size, mtime_ns, summary) VALUES (?, ?, ?, ?)",
+                       (name, size, mtime_ns, json.dumps(summary)))
+        self.generation.bump()
+
+    def shared_preflight(self, name: str) -> Optional[dict]:
+        """ The preflight summary of another name that links to the same
+            blob as name, or None if there isn't one for the blob as it
+            is now.
+        """
+        path = os.path.join(self.upload_path, name)
+        sha256 = upload_store.blob_of(path)
+        if sha256 is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        rows = self.db.execute("SELECT * FROM preflight WHERE size = ?"
+                               " AND mtime_ns = ? AND name != ?",
+                               (st.st_size, st.st_mtime_ns, name))
+        for row in rows:
+            other = os.path.join(self.upload_path, row['name'])
+            if upload_store.blob_of(other) == sha256:
+                return json.loads(row['summary'])
+        return None
+
+    def forget(self, name: str) -> None:
+        """ Drop a file from the index. """
+        db = self.db
+        with db:
+            db.execute("DELETE FROM files WHERE name = ?", (name,))
+            db.execute("DELETE FROM preflight WHERE name = ?", (name,))
+        self.generation.bump()
+
+
+class Generation:
+    """ A counter shared by all the workers in a tiny file, mapped into
+        memory so reading it costs nothing.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < GENERATION_FORMAT.size:
+                os.ftruncate(fd, GENERATION_FORMAT.size)
+            self.map = mmap.mmap(fd, GENERATION_FORMAT.size)
+        finally:
+            os.close(fd)
+
+    def value(self) -> int:
+        return GENERATION_FORMAT.unpack_from(self.map)[0]
+
+    def bump(self) -> None:
+        """ Add one.  Locked, so two workers bumping at once both count. """
+        # A new open file each time, flock on one shared by forked
+        # workers would not keep them out of each other's way.
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            GENERATION_FORMAT.pack_into(self.map, 0, self.value() + 1)
+        finally:
+            os.close(fd)
+
+
+PAGE_SELECT = ("SELECT f.*, p.size AS preflight_size,"
+               " p.mtime_ns AS preflight_mtime_ns, p.summary"
+               " FROM files f LEFT JOIN preflight p ON p.name = f.name")
+
+
+def joined_preflight(row: sqlite3.Row) -> Optional[dict]:
+    """ The preflight columns of a PAGE_SELECT row, like a preflight
+        row, or None if there were none.
+    """
+    if row['summary'] is None:
+        return None
+    return {'size': row['preflight_size'],
+            'mtime_ns': row['preflight_mtime_ns'],
+            'summary': row['summary']}
+
+
+def search_where(search: str, prefix: bool) -> Tuple[List[str], list]:
+    """ The WHERE terms and parameters for a page() search. """
+    if not search:
+        return [], []
+    pattern = search.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_') + '%'
+    if not prefix:
+        pattern = '%' + pattern
+    term = "(f.name LIKE ? ESCAPE '\\' OR f.first_line LIKE ? ESCAPE '\\')"
+    return [term], [pattern, pattern]
+
+
+def encode_cursor(key, name: str) -> str:
+    """ Where a page ends, as a string safe in a URL. """
+    return base64.urlsafe_b64encode(
+        json.dumps([key, name]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[object, str]:
+    """ (sort key, name) from encode_cursor().
+        Raises ValueError if it is not one, base64 and json errors are
+        ValueErrors too.
+    """
+    try:
+        key, name = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError) as err:
+        raise ValueError(f"bad cursor: {err}")
+    if not isinstance(name, str):
+        raise ValueError("bad cursor")
+    return key, name
+
+
+def row_to_info(row: sqlite3.Row,
+                preflight: Optional[sqlite3.Row] = None) -> dict:
+    """ The info dict for a file.  'preflight' is its summary, or None if
+        there isn't one for the file as it is now.
+    """
+    summary = None
+    if preflight is not None and preflight['size'] == row['size'] and \
+            preflight['mtime_ns'] == row['mtime_ns']:
+        summary = json.loads(preflight['summary'])
+    return {'file_name': row['name'],
+            'first_line': row['first_line'],
+            'size': row['gcode_size'],
+            'mtime': row['name_mtime_ns'] / 1e9,
+            'lines': row['lines'],
+            'preflight': summary}
+
+
+def upgrade(db: sqlite3.Connection) -> None:
+    """ Bring an index made by an older version up to SCHEMA_VERSION.
+        The files table is only a cache, it is made again from scratch.
+    """
+    db.execute("BEGIN IMMEDIATE")   # One worker at a time
+    try:
+        if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            db.execute("DROP TABLE IF EXISTS files")
+            for statement in SCHEMA.split(";"):
+                db.execute(statement)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def scan_file(path: str) -> Tuple[str, int, int]:
+    """ Return the first line worth showing, the number of lines and the
+        size of the G-code, which for a compressed upload is not the size
+        on disk.
+
+        The first line skips blank lines and a '%' line.
+        Raises OSError if the file can't be read.
+    """
+    first_line = ''
+    with send_plan.open_source(path) as fd:
+        for _, line in send_plan.source_lines(fd):
+            line = line.rstrip()
+            if line == '%' or line == '':
+                continue
+            first_line = line
+            break
+
+        # Count the lines in big chunks, \r alone ends a line too.
+        fd.seek(0)
+        lines = 0
+        size = 0
+        last = b''
+        for chunk in send_plan.source_chunks(fd, size=READ_CHUNK_SIZE):
+            lines += chunk.count(b'\n')
+            size += len(chunk)
+            last = chunk
+        if last and not last.endswith(b'\n'):
+            lines += 1  # Last line has no \n
+    return first_line, lines, size
@@ -0,0 +1,262 @@
+"""
+
+flow_control.py - pacing policies for writing G-code to the serial port
+
+The serial sender asks a flow control policy two things: how many
+characters to write next, and when to look at the port again.  The goal is
+to keep the 9600 baud line busy whenever the Matsuura has CTS on, without
+ever leaving more than a few characters sitting in the OS and USB buffers
+when it turns CTS off (see the long story in serial_sender.py for why
+buffered data is so confusing for users).
+
+Two policies are available, picked with FLOW_CONTROL in .env:
+
+    fixed       The default, and the original policy.  50 character writes, only when CTS is
+                on and nothing is buffered, then wait until those characters
+                have had time to go out on the wire.
+
+    adaptive    Watches how long CTS stays on and off, how many characters
+                the Matsuura takes in each CTS on period, and whether
+                characters are left in out_waiting when CTS drops.  Grows
+                the write size while everything gets taken, shrinks it when
+                characters get stranded, and checks the port again exactly
+                when the last write should be out instead of polling.  The
+                write size stays between FLOW_MIN_CHUNK and FLOW_MAX_CHUNK.
+
+                If the send plan says how long the lines coming up take to
+                run (see the timing file in send_plan.py), it also looks
+                ahead.  When the machine is projected to run out of blocks
+                in the next buffer full of lines, it will take all it can
+                get, so it writes up to FLOW_MAX_CHUNK of whole lines at a
+                time and writes again before the line runs dry, instead of
+                waiting for CTS cycles that are not going to come.  If the
+                machine strands chars when we expected it to take them, the
+                plan is wrong about this machine and looking ahead is turned
+                off.
+
+                It has only been run against matsuura_simulator.py (see
+                serial_benchmark.py).  It leaves more chars buffered and
+                writes sooner than fixed does, and overrunning the Matsuura's
+                buffer is an alarm, so it is only used if asked for until it
+                has been proven on the real machine.
+
+"""
+
+import os
+import time
+from typing import Optional
+
+BAUD = 9600                 # Not meant to be changed
+CHARS_PER_SEC = BAUD / 10   # 1 start, 8 data, 1 stop bit per char
+
+FIXED_CHUNK_SIZE = 50
+FIXED_RETRY_TIME = 0.02     # Seconds between checks when not ready
+
+DEFAULT_FLOW_CONTROL = "fixed"
+DEFAULT_MIN_CHUNK = 10
+DEFAULT_MAX_CHUNK = 120
+DEFAULT_MAX_BACKLOG = 2     # Chars we allow in out_waiting when writing
+LINK_BOUND_BACKLOG = 16     # Chars left in out_waiting when link bound
+LINK_BOUND_MISSES = 3       # Strandings before we stop looking ahead
+LOOKAHEAD_CHARS = 256       # Chars of coming lines to look at, a buffer full
+POLL_TIME = 0.005           # Seconds between CTS checks when CTS is off
+GROW_STEP = 4               # Chars added to the chunk per clean CTS cycle
+CYCLE_SMOOTHING = 0.25      # Weight of newest CTS cycle in the averages
+
+
+class FlowControl:
+    """ Base flow control policy.
+
+        The sender calls observe() every time it looks at the port,
+        ready() to ask if it can write now, chunk_size for how much to
+        write, wrote() after a write and idle() when it did not write.
+        wrote() and idle() return the time to look at the port again.
+
+        If it knows, the sender calls ahead() first to say whether the
+        machine will run out of blocks in the next LOOKAHEAD_CHARS or so.
+        While link_bound, the sender fills each write with as many whole
+        lines as fit in chunk_size.
+    """
+    name = "base"
+    link_bound = False
+
+    def __init__(self):
+        self.chunk_size = FIXED_CHUNK_SIZE
+
+    def observe(self, cts: bool, out_waiting: int, now: float) -> None:
+        pass
+
+    def ahead(self, starving: bool) -> None:
+        """ Called with True if the machine is projected to wait on the
+            line for the lines coming up.
+        """
+        pass
+
+    def ready(self, cts: bool, out_waiting: int) -> bool:
+        return cts and out_waiting == 0
+
+    def wrote(self, bytes_sent: int, now: float) -> float:
+        # Don't try to send more until these bytes have had time
+        # to be sent. (9600 baud is 960 characters per second)
+        # 1 stop bit, 8 data, 1 stop so 10 bits per character sent.
+        return now + (bytes_sent - 1) / CHARS_PER_SEC
+
+    def idle(self, cts: bool, out_waiting: int, now: float) -> float:
+        return now
+
+    @property
+    def status(self) -> str:
+        return f"{self.name} flow control, {self.chunk_size} char writes"
+
+
+class FixedFlowControl(FlowControl):
+    """ The original fixed compromise.  50 char writes. """
+    name = "fixed"
+
+
+class AdaptiveFlowControl(FlowControl):
+    """ Adapts write size and pacing to how the Matsuura is taking data. """
+    name = "adaptive"
+
+    def __init__(self, min_chunk=DEFAULT_MIN_CHUNK,
+                 max_chunk=DEFAULT_MAX_CHUNK,
+                 max_backlog=DEFAULT_MAX_BACKLOG):
+        super().__init__()
+        self.min_chunk = max(1, min_chunk)
+        self.max_chunk = max(self.min_chunk, max_chunk)
+        self.max_backlog = max(0, max_backlog)
+        self.cycle_chunk = min(max(FIXED_CHUNK_SIZE, self.min_chunk),
+                               self.max_chunk)
+        self.link_bound = False         # Machine about to wait on the line
+        self.link_bound_misses = 0
+
+        self.cts: Optional[bool] = None
+        self.cts_changed_at = time.time()
+        self.cycle_bytes = 0            # Chars written this CTS on period
+        self.stranded = 0               # Most chars seen buffered since CTS off
+        self.avg_on_time = 0.0          # Seconds
+        self.avg_off_time = 0.0         # Seconds
+        self.avg_cycle_bytes = 0.0      # Chars taken per CTS on period
+
+    @property
+    def chunk_size(self) -> int:
+        if self.link_bound:
+            return self.max_chunk
+        return self.cycle_chunk
+
+    @chunk_size.setter
+    def chunk_size(self, value: int):
+        self.cycle_chunk = value
+
+    @property
+    def backlog(self) -> int:
+        """ Chars we allow in out_waiting when writing. """
+        if self.link_bound:
+            return max(self.max_backlog, LINK_BOUND_BACKLOG)
+        return self.max_backlog
+
+    @property
+    def duty_cycle(self) -> float:
+        """ Fraction of time CTS has been on, on average. """
+        total = self.avg_on_time + self.avg_off_time
+        if total == 0.0:
+            return 1.0
+        return self.avg_on_time / total
+
+    def observe(self, cts: bool, out_waiting: int, now: float) -> None:
+        if self.cts is None:
+            self.cts = cts
+            self.cts_changed_at = now
+
+        if cts != self.cts:
+            duration = now - self.cts_changed_at
+            self.cts_changed_at = now
+            self.cts = cts
+            if cts:
+                # CTS back on. Off period is over.
+                self.avg_off_time = smooth(self.avg_off_time, duration)
+                self.end_off_period()
+            else:
+                # CTS dropped. See how much the Matsuura took.
+                self.avg_on_time = smooth(self.avg_on_time, duration)
+                taken = max(0, self.cycle_bytes - out_waiting)
+                self.avg_cycle_bytes = smooth(self.avg_cycle_bytes, taken)
+                self.cycle_bytes = 0
+                self.stranded = out_waiting
+        elif not cts:
+            self.stranded = max(self.stranded, out_waiting)
+
+    def end_off_period(self):
+        """ Adjust the chunk size now that we know how the last
+            CTS cycle went.
+        """
+        if self.stranded > self.max_backlog:
+            # We wrote more than the Matsuura wanted.  Back off hard.
+            self.cycle_chunk = max(self.min_chunk,
+                                   min(self.cycle_chunk // 2,
+                                       self.cycle_chunk - self.stranded))
+            if self.link_bound:
+                # It was meant to be taking everything we sent.
+                self.link_bound_misses += 1
+                self.link_bound = False
+        else:
+            self.cycle_chunk = min(self.max_chunk, self.cycle_chunk + GROW_STEP)
+
+        if self.avg_cycle_bytes >= self.min_chunk:
+            # Never write more in one go than the Matsuura typically
+            # takes in a whole CTS on period.
+            self.cycle_chunk = min(self.cycle_chunk, int(self.avg_cycle_bytes))
+        self.stranded = 0
+
+    def ahead(self, starving: bool) -> None:
+        self.link_bound = starving \
+            and self.link_bound_misses < LINK_BOUND_MISSES
+
+    def ready(self, cts: bool, out_waiting: int) -> bool:
+        return cts and out_waiting <= self.backlog
+
+    def wrote(self, bytes_sent: int, now: float) -> float:
+        self.cycle_bytes += bytes_sent
+        # Look again just as the last of these chars, less the backlog
+        # we allow, goes out.  That keeps the line busy with no gap.
+        return now + max(0, bytes_sent - self.backlog) / CHARS_PER_SEC
+
+    def idle(self, cts: bool, out_waiting: int, now: float) -> float:
+        if cts and out_waiting > self.backlog:
+            # Wait just long enough for the backlog to drain.
+            return now + (out_waiting - self.backlog) / CHARS_PER_SEC
+        return now + POLL_TIME
+
+    @property
+    def status(self) -> str:
+        status = (f"{self.name} flow control, {self.chunk_size} char writes,"
+                  f" CTS duty {self.duty_cycle * 100:.0f}%,"
+                  f" {self.avg_cycle_bytes:.0f} chars per CTS cycle")
+        if self.link_bound:
+            status += ", link bound ahead"
+        return status
+
+
+def smooth(average: float, value: float) -> float:
+    """ Exponential moving average, seeded by the first value. """
+    if average == 0.0:
+        return float(value)
+    return average + CYCLE_SMOOTHING * (value - average)
+
+
+def make_flow_control(name: Optional[str] = None) -> FlowControl:
+    """ Build the flow control policy named in FLOW_CONTROL.
+        Raises ValueError for an unknown name.
+    """
+    if name is None:
+        name = os.environ.get('FLOW_CONTROL', DEFAULT_FLOW_CONTROL)
+    name = name.strip().lower()
+    if name == FixedFlowControl.name:
+        return FixedFlowControl()
+    if name == AdaptiveFlowControl.name:
+        return AdaptiveFlowControl(
+            min_chunk=int(os.environ.get('FLOW_MIN_CHUNK', DEFAULT_MIN_CHUNK)),
+            max_chunk=int(os.environ.get('FLOW_MAX_CHUNK', DEFAULT_MAX_CHUNK)),
+            max_backlog=int(os.environ.get('FLOW_MAX_BACKLOG',
+                                           DEFAULT_MAX_BACKLOG)))
+    raise ValueError(f"Unknown FLOW_CONTROL {name!r}")
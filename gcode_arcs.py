@@ -0,0 +1,498 @@
+"""
+
+gcode_arcs.py - fit G2/G3 arcs to runs of short G1 moves
+
+CAM output often cuts a curve as hundreds of tiny G1 moves.  Drip fed, each
+of them is a block the Yasnac has to be sent over the 9600 baud line, and
+a run of blocks that short runs faster than the line can bring them.
+ArcFitting replaces a run of G1 moves that all stay within a tolerance of a
+circle in the active plane (G17, G18 or G19) with one G2 or G3 block that
+cuts the same curve.
+
+It is a stage of the send plan pipeline (see send_plan.py), only used when
+ARC_TOLERANCE_MM is set in the environment.  Like compaction it only
+touches what it is sure of.  A run is G1 moves in G90 with nothing but
+X Y Z F and N words, at one feed, that stay in the plane, from a position
+we know.  Axis words must have a decimal point, as the Yasnac may read
+X1 as one least increment.  Anything else ends the run and is sent as it
+is.  After a tool change, a canned cycle or any G code we don't follow the
+position is unknown until the axes are set again, and after a subprogram,
+macro or M code we don't know, the whole modal state is.
+
+The arc end point is written the way the last G1 wrote it, so the path
+ends up exactly where it did.  The center I J K is rounded to the number
+of decimals the run used, and the fit is checked again with the rounded
+center.  The deviation of a G1 move from the arc is how far its end points
+are off the circle plus how far the arc bows away from it.
+
+"""
+
+import math
+import os
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from gcode_motion import CHARS_PER_SEC, COMMENT_RE, PLANES
+
+MIN_SEGMENTS = 3            # G1 moves an arc has to replace to be worth it
+MAX_SEGMENTS = 500          # G1 moves in one arc, bounds the refitting
+MAX_SWEEP = math.pi         # Most an arc may turn, radians
+MIN_DECIMALS = 3            # For I J K when the run has fewer
+MM_PER_INCH = 25.4
+
+AXES = "XYZ"
+NUMBER = r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)'
+RUN_LINE_RE = re.compile(r'(?:[GNXYZF]' + NUMBER + r')+')
+PLAIN_LINE_RE = re.compile(r'(?:[A-Z]' + NUMBER + r')+')
+WORD_RE = re.compile(r'([A-Z])(' + NUMBER + r')')
+SEQUENCE_START_RE = re.compile(r'\s*N\s*[0-9]+\s*')
+NO_SPACES = str.maketrans("", "", " \t\n\v\f\r")
+
+# G codes that leave the position where the axis words put it.
+KNOWN_G_CODES = (0, 1, 2, 3, 4, 17, 18, 19, 20, 21, 40, 41, 42, 43, 49,
+                 80, 90, 91, 94)
+SAFE_M_CODES = (3, 4, 5, 7, 8, 9)   # Spindle and coolant, no moves
+MOVE_M_CODES = (0, 1, 6, 19)        # Stops, tool change, may move the tool
+MACRO_G_CODES = (65, 66, 67)        # Macro calls, could change anything
+MOVE_LETTERS = "NXYZFS"     # Lines we can put a G1 in front of
+OTHER_AXES = frozenset("ABCUVW")
+
+Point = Tuple[float, float]
+
+
+def fitted_lines(lines: Iterable[Tuple[int, str]],
+                 fitting: "ArcFitting") -> Iterator[Tuple[int, str]]:
+    """ Yield (file offset, line) with runs of G1 moves replaced by arcs,
+        see ArcFitting.  An arc has the offset of the first move it
+        replaces.
+    """
+    for offset, line in lines:
+        yield from fitting.add(offset, line)
+    yield from fitting.finish()
+
+
+class ArcFitting:
+    """ Replaces runs of G1 moves with G2/G3 arcs within tolerance_mm.
+
+        Lines go in with add() and come out of it, and finish(), in the
+        same order, with some runs of moves replaced.  Counts what it did,
+        see summary().
+    """
+    def __init__(self, tolerance_mm: float,
+                 keep_sequence_numbers: bool = False):
+        self.tolerance_mm = tolerance_mm
+        self.keep_sequence_numbers = keep_sequence_numbers
+
+        # Modal state, None if unknown.
+        self.motion: Optional[int] = None
+        self.absolute: Optional[bool] = None
+        self.plane: Optional[int] = None
+        self.inch: Optional[bool] = None
+        self.inverse_time = False
+        self.feed: Optional[float] = None
+        self.position: Dict[str, Optional[float]] = dict.fromkeys(AXES)
+        self.position_text: Dict[str, Optional[str]] = dict.fromkeys(AXES)
+        self.restore_motion = False     # An arc left the machine in G2/G3
+
+        # The run of G1 moves being fitted.  points[0] is where it starts.
+        self.points: List[Point] = []
+        self.moves: List[Tuple[int, str, Optional[str], int]] = []
+        self.center: Point = (0.0, 0.0)
+        self.radius = 0.0
+        self.sweep = 0.0
+        self.direction = 0
+        self.end_text: Dict[str, str] = {}
+
+        self.arcs = 0
+        self.moves_replaced = 0
+        self.lines_added = 0
+        self.chars_before = 0
+        self.chars_after = 0
+        self.max_deviation = 0.0
+
+    @property
+    def tolerance(self) -> float:
+        """ tolerance_mm in program units, inches if we don't know. """
+        if self.inch is False:
+            return self.tolerance_mm
+        return self.tolerance_mm / MM_PER_INCH
+
+    def add(self, offset: int, line: str) -> List[Tuple[int, str]]:
+        """ The lines to send for line, from gcode_lines(), and any run
+            it ended.
+        """
+        out: List[Tuple[int, str]] = []
+        move = self.run_move(line)
+        if move is None:
+            self.flush(out)
+            self.emit(out, offset, line)
+            self.follow(line)
+        else:
+            self.extend(out, offset, line, move)
+        return out
+
+    def finish(self) -> List[Tuple[int, str]]:
+        """ The lines left at the end of the file. """
+        out: List[Tuple[int, str]] = []
+        self.flush(out)
+        return out
+
+    def run_move(self, line: str):
+        """ (a, b, feed, feed text, end words, decimals) if line is a G1
+            move that can be part of a run, else None.  a and b are where
+            it goes in the plane.
+        """
+        if (self.absolute is not True or self.plane is None
+                or self.inverse_time):
+            return None
+        text = line.translate(NO_SPACES)
+        if not RUN_LINE_RE.fullmatch(text):
+            return None
+        words = WORD_RE.findall(text)
+        values = dict(words)
+        if len(values) != len(words):
+            return None     # A letter twice
+        if "N" in values and self.keep_sequence_numbers:
+            return None
+        if "G" in values:
+            if float(values["G"]) != 1:
+                return None
+        elif self.motion != 1:
+            return None
+
+        a_axis, b_axis, normal = PLANES[self.plane][:3]
+        if a_axis not in values and b_axis not in values:
+            return None
+        if any(self.position[axis] is None for axis in AXES):
+            return None
+        if any("." not in values[axis] for axis in AXES if axis in values):
+            return None
+        if normal in values and \
+                float(values[normal]) != self.position[normal]:
+            return None
+        a = float(values.get(a_axis, self.position[a_axis]))
+        b = float(values.get(b_axis, self.position[b_axis]))
+        if a == self.position[a_axis] and b == self.position[b_axis]:
+            return None
+        feed = float(values["F"]) if "F" in values else None
+        end_words = {axis: values[axis] for axis in (a_axis, b_axis)
+                     if axis in values}
+        decimals = max(len(n) - n.index(".") - 1 for n in end_words.values())
+        return a, b, feed, values.get("F"), end_words, decimals
+
+    def extend(self, out: List[Tuple[int, str]], offset: int, line: str,
+               move) -> None:
+        """ Add the G1 move on line to the run, sending the run first if
+            it does not fit.
+        """
+        a, b, feed, feed_text, end_words, decimals = move
+        if feed is not None and feed != self.feed:
+            self.flush(out)     # The arc can only set the feed at its start
+        a_axis, b_axis = PLANES[self.plane][:2]
+        while True:
+            if not self.points:
+                # A new run starts where the last move ended.
+                self.points = [(self.position[a_axis], self.position[b_axis])]
+                self.end_text = {axis: self.position_text[axis]
+                                 for axis in (a_axis, b_axis)}
+            if self.fits((a, b)):
+                break
+            if len(self.moves) >= MIN_SEGMENTS:
+                self.flush(out)
+            else:
+                self.slide(out)
+        self.moves.append((offset, line, feed_text, decimals))
+        self.end_text.update(end_words)
+        self.position[a_axis], self.position[b_axis] = a, b
+        self.position_text.update(end_words)
+        self.motion = 1
+        if feed is not None:
+            self.feed = feed
+
+    def fits(self, point: Point) -> bool:
+        """ Add point to the run if the run still fits an arc. """
+        points = self.points
+        if len(points) == 1:
+            points.append(point)
+            return True
+        if len(self.moves) >= MAX_SEGMENTS:
+            return False
+        segment = check_segment(self.center, self.radius, points[-1], point)
+        if (len(points) > 2 and segment is not None
+                and segment[0] <= self.tolerance
+                and segment[1] * self.direction > 0
+                and self.sweep + abs(segment[1]) <= MAX_SWEEP):
+            self.sweep += abs(segment[1])
+            points.append(point)
+            return True
+
+        # Try a circle through the start, middle and new end.
+        circle = circle_through(points[0], points[len(points) // 2], point)
+        if circle is None:
+            return False
+        fit = check_arc(circle[0], circle[1], points + [point],
+                        self.tolerance)
+        if fit is None:
+            return False
+        self.center, self.radius = circle
+        _, self.sweep, self.direction = fit
+        points.append(point)
+        return True
+
+    def slide(self, out: List[Tuple[int, str]]) -> None:
+        """ Send the first move of a run too short to be an arc, and fit
+            the rest again.
+        """
+        offset, line, _, _ = self.moves[0]
+        self.emit(out, offset, line)
+        points, moves = self.points[1:], self.moves[1:]
+        self.points, self.moves = points[:1], []
+        for point, move in zip(points[1:], moves):
+            if not self.fits(point):
+                # Only happens if MIN_SEGMENTS is raised past 3.
+                self.points = [point]
+                self.emit(out, move[0], move[1])
+                continue
+            self.moves.append(move)
+
+    def flush(self, out: List[Tuple[int, str]]) -> None:
+        """ Send the run, as an arc if it makes one, and start a new run
+            where it ended.
+        """
+        if not self.moves:
+            self.points = []
+            return
+        arc = self.arc_line() if len(self.moves) >= MIN_SEGMENTS else None
+        if arc is None:
+            for offset, line, _, _ in self.moves:
+                self.emit(out, offset, line)
+        else:
+            line, deviation = arc
+            self.arcs += 1
+            self.moves_replaced += len(self.moves)
+            self.chars_before += sum(sent_chars(m[1]) for m in self.moves)
+            self.chars_after += sent_chars(line)
+            scale = MM_PER_INCH if self.inch is not False else 1.0
+            self.max_deviation = max(self.max_deviation, deviation * scale)
+            out.append((self.moves[0][0], line))
+            self.restore_motion = True
+        self.points = []
+        self.moves = []
+
+    def arc_line(self) -> Optional[Tuple[str, float]]:
+        """ (the G2/G3 block for the run, its deviation), or None if the
+            run is not an arc once the center is rounded, or is so nearly
+            straight it is better left as it is.
+        """
+        start = self.points[0]
+        if self.radius * (1 - math.cos(self.sweep / 2)) <= self.tolerance:
+            return None
+        decimals = max(MIN_DECIMALS, max(m[3] for m in self.moves))
+        i = round(self.center[0] - start[0], decimals) + 0.0     # No -0
+        j = round(self.center[1] - start[1], decimals) + 0.0
+        fit = check_arc((start[0] + i, start[1] + j), math.hypot(i, j),
+                        self.points, self.tolerance)
+        if fit is None:
+            return None
+        deviation, _, direction = fit
+
+        a_axis, b_axis, _, i_word, j_word = PLANES[self.plane]
+        words = {a_axis: self.end_text[a_axis], b_axis: self.end_text[b_axis],
+                 i_word: "%.*f" % (decimals, i),
+                 j_word: "%.*f" % (decimals, j)}
+        line = "G3" if direction > 0 else "G2"
+        for letter in "XYZIJK":
+            if letter in words:
+                line += " " + letter + words[letter]
+        if self.moves[0][2] is not None:
+            line += " F" + self.moves[0][2]
+        return line, deviation
+
+    def emit(self, out: List[Tuple[int, str]], offset: int,
+             line: str) -> None:
+        """ Send a line as it is, putting G1 back first after an arc. """
+        if self.restore_motion and COMMENT_RE.sub("", line).strip():
+            self.restore_motion = False
+            if not has_motion_word(line):
+                text = line.translate(NO_SPACES)
+                if (PLAIN_LINE_RE.fullmatch(text)
+                        and not text.strip(MOVE_LETTERS + "0123456789.+-")):
+                    n = SEQUENCE_START_RE.match(line)
+                    cut = n.end() if n else 0
+                    line = (line[:cut] + "G1 " + line[cut:]).rstrip()
+                    self.chars_after += 3
+                else:
+                    out.append((offset, "G1"))
+                    self.lines_added += 1
+                    self.chars_after += sent_chars("G1")
+        out.append((offset, line))
+
+    def follow(self, line: str) -> None:
+        """ Track the modal state and position through a line that is not
+            part of a run.
+        """
+        if "(" in line or ";" in line:
+            line = COMMENT_RE.sub("", line)
+        text = line.translate(NO_SPACES)
+        if not text:
+            return
+        if not PLAIN_LINE_RE.fullmatch(text):
+            self.forget()
+            return
+        words = WORD_RE.findall(text)
+        moves = True
+        for letter, number in words:
+            if letter == "G":
+                value = float(number)
+                if value in (0, 1, 2, 3):
+                    self.motion = int(value)
+                elif value in PLANES:
+                    self.plane = int(value)
+                elif value in (20, 21):
+                    self.inch = value == 20
+                elif value in (90, 91):
+                    self.absolute = value == 90
+                elif value == 93:
+                    self.inverse_time = True
+                elif value == 94:
+                    self.inverse_time = False
+                elif value == 4:
+                    moves = False   # X is the dwell time
+                elif value in MACRO_G_CODES:
+                    self.forget()
+                    return
+                elif value not in KNOWN_G_CODES:
+                    self.forget_position()
+                    return
+            elif letter == "M":
+                value = float(number)
+                if value in MOVE_M_CODES:
+                    self.forget_position()
+                    return
+                if value not in SAFE_M_CODES:
+                    self.forget()
+                    return
+            elif letter == "F":
+                self.feed = float(number)
+            elif letter in OTHER_AXES:
+                self.forget()
+                return
+
+        if not moves:
+            return
+        for letter, number in words:
+            if letter not in AXES:
+                continue
+            if "." not in number or self.absolute is None:
+                self.position[letter] = None
+                self.position_text[letter] = None
+            elif self.absolute:
+                self.position[letter] = float(number)
+                self.position_text[letter] = number
+            elif self.position[letter] is not None:
+                # Added up, so not written the way a G1 would write it.
+                self.position[letter] += float(number)
+                self.position_text[letter] = "%.6f" % self.position[letter]
+
+    def forget(self) -> None:
+        """ Don't fit anything until the state is seen again. """
+        self.absolute = None
+        self.plane = None
+        self.inch = None
+        self.feed = None
+        self.forget_position()
+
+    def forget_position(self) -> None:
+        """ Don't fit anything until the axes and motion are set again. """
+        self.motion = None
+        self.position = dict.fromkeys(AXES)
+        self.position_text = dict.fromkeys(AXES)
+
+    def summary(self) -> dict:
+        removed = self.chars_before - self.chars_after
+        return {
+            "tolerance_mm": self.tolerance_mm,
+            "arcs": self.arcs,
+            "blocks_removed": self.moves_replaced - self.arcs
+            - self.lines_added,
+            "chars_before": self.chars_before,
+            "chars_after": self.chars_after,
+            "seconds_saved": round(removed / CHARS_PER_SEC, 1),
+            "max_deviation_mm": round(self.max_deviation, 6),
+        }
+
+
+def sent_chars(line: str) -> int:
+    """ Chars line takes on the wire, padded and with CR LF. """
+    return max(len(line), 3) + 2
+
+
+def has_motion_word(line: str) -> bool:
+    """ True if line has a G0 to G3 word. """
+    text = COMMENT_RE.sub("", line).translate(NO_SPACES)
+    for letter, number in WORD_RE.findall(text):
+        if letter == "G" and float(number) in (0, 1, 2, 3):
+            return True
+    return False
+
+
+def circle_through(p: Point, q: Point, r: Point):
+    """ (center, radius) of the circle through three points, None if
+        they are in a line.
+    """
+    bx, by = q[0] - p[0], q[1] - p[1]
+    cx, cy = r[0] - p[0], r[1] - p[1]
+    d = 2.0 * (bx * cy - by * cx)
+    if d == 0.0:
+        return None
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    ux = (cy * b2 - by * c2) / d
+    uy = (bx * c2 - cx * b2) / d
+    return (p[0] + ux, p[1] + uy), math.hypot(ux, uy)
+
+
+def check_segment(center: Point, radius: float, p: Point, q: Point):
+    """ (deviation, signed angle) of the move from p to q against the arc
+        around center, or None if it can't be part of it.  The angle is
+        positive counterclockwise.
+    """
+    pa, pb = p[0] - center[0], p[1] - center[1]
+    qa, qb = q[0] - center[0], q[1] - center[1]
+    angle = math.atan2(pa * qb - pb * qa, pa * qa + pb * qb)
+    half_chord = math.hypot(q[0] - p[0], q[1] - p[1]) / 2
+    if angle == 0.0 or half_chord > radius:
+        return None
+    bow = radius - math.sqrt(radius * radius - half_chord * half_chord)
+    off = max(abs(math.hypot(pa, pb) - radius),
+              abs(math.hypot(qa, qb) - radius))
+    return off + bow, angle
+
+
+def check_arc(center: Point, radius: float, points: List[Point],
+              tolerance: float):
+    """ (deviation, sweep, direction) if the moves through points all
+        fit the arc around center within tolerance, turning the same way
+        less than MAX_SWEEP, else None.  direction is 1 counterclockwise.
+    """
+    deviation = 0.0
+    sweep = 0.0
+    direction = 0
+    for p, q in zip(points, points[1:]):
+        segment = check_segment(center, radius, p, q)
+        if segment is None or segment[0] > tolerance:
+            return None
+        turn = 1 if segment[1] > 0 else -1
+        if direction and turn != direction:
+            return None
+        direction = turn
+        deviation = max(deviation, segment[0])
+        sweep += abs(segment[1])
+        if sweep > MAX_SWEEP:
+            return None
+    return deviation, sweep, direction
+
+
+def arc_tolerance_mm() -> float:
+    """ ARC_TOLERANCE_MM from the environment, 0 (no fitting) if not set. """
+    return float(os.environ.get('ARC_TOLERANCE_MM') or '0')
@@ -0,0 +1,269 @@
+"""
+
+gcode_motion.py - simple model of how long G-code blocks take to run
+
+Tracks the modal state a block inherits from the blocks before it (motion
+mode, feed rate, absolute or incremental, current position) and works out
+how far each block moves and roughly how long the machine takes to run it.
+
+This is a model, not a controller.  It knows G0, G1, G2, G3 (I J K centers
+or R), G4 dwells, G17/G18/G19, G90/G91 and F.  Everything else is taken to
+run in the minimum block time.  Acceleration is ignored, so short moves come
+out a bit faster than a real machine runs them.
+
+DripFeed adds the 9600 baud line to that.  In TAPE mode the Yasnac runs
+each block as it arrives, so a run of blocks that take less time to run
+than to send leaves the machine waiting on the line.  It projects when each
+line of a program would finish running when drip fed, and where the
+machine would sit waiting for data.
+
+"""
+
+import re
+import math
+from collections import deque
+from typing import Dict, List, Tuple
+
+DEFAULT_RAPID_RATE = 400.0      # Units per minute for G0
+DEFAULT_MIN_BLOCK_TIME = 0.004  # Seconds to read and set up any block
+DEFAULT_BUFFER_SIZE = 256       # Chars the Yasnac reads ahead, a guess
+CHARS_PER_SEC = 9600 / 10       # 1 start, 8 data, 1 stop bit per char
+
+REGION_GAP = 10                 # Lines between waits in one region
+MIN_REGION_WAIT = 0.1           # Seconds waiting for a region to count
+MAX_REGIONS = 20                # Regions kept, the longest waits
+
+WORD_RE = re.compile(r'([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+COMMENT_RE = re.compile(r'\([^)]*\)|;.*')
+
+AXES = "XYZ"
+
+# Axes for the arc plane and the axis normal to it, by plane G code.
+PLANES = {17: ("X", "Y", "Z", "I", "J"),
+          18: ("Z", "X", "Y", "K", "I"),
+          19: ("Y", "Z", "X", "J", "K")}
+
+
+def parse_words(block: str) -> List[Tuple[str, float]]:
+    """ Return the (letter, value) words in a block, comments removed. """
+    words = []
+    for letter, value in WORD_RE.findall(COMMENT_RE.sub('', block.upper())):
+        try:
+            words.append((letter, float(value)))
+        except ValueError:
+            continue
+    return words
+
+
+class MotionState:
+    """ Modal state carried from block to block. """
+    def __init__(self, rapid_rate: float = DEFAULT_RAPID_RATE,
+                 min_block_time: float = DEFAULT_MIN_BLOCK_TIME):
+        self.rapid_rate = rapid_rate
+        self.min_block_time = min_block_time
+        self.motion = 0             # 0, 1, 2 or 3
+        self.feed = 0.0             # Units per minute
+        self.absolute = True        # G90 vs G91
+        self.plane = 17
+        self.position: Dict[str, float] = {axis: 0.0 for axis in AXES}
+
+    def block(self, text: str) -> Tuple[float, float]:
+        """ Run one block through the model.
+            Returns (distance moved, seconds to run it).
+        """
+        words = parse_words(text)
+        targets = {}
+        arc = {}
+        dwell = 0.0
+        g_codes = []
+        for letter, value in words:
+            if letter == 'G':
+                g_codes.append(value)
+            elif letter in AXES:
+                targets[letter] = value
+            elif letter in "IJKR":
+                arc[letter] = value
+            elif letter == 'F':
+                self.feed = value
+
+        for g in g_codes:
+            code = int(g)
+            if code in (0, 1, 2, 3) and g == code:
+                self.motion = code
+            elif code == 4:
+                dwell = dwell_seconds(words)
+            elif code in PLANES and g == code:
+                self.plane = code
+            elif code == 90:
+                self.absolute = True
+            elif code == 91:
+                self.absolute = False
+
+        if dwell:
+            # A dwell block does not move, X is the dwell time.
+            return 0.0, max(self.min_block_time, dwell)
+
+        if not targets:
+            return 0.0, self.min_block_time
+
+        start = dict(self.position)
+        end = dict(start)
+        for axis, value in targets.items():
+            end[axis] = value if self.absolute else start[axis] + value
+        self.position = end
+
+        if self.motion in (2, 3):
+            distance = arc_length(start, end, arc, self.plane, self.motion == 2)
+        else:
+            distance = math.sqrt(sum((end[a] - start[a]) ** 2 for a in AXES))
+
+        rate = self.rapid_rate if self.motion == 0 else self.feed
+        if rate <= 0.0:
+            # No feed rate set.  A real machine alarms, we just say it
+            # took the minimum time.
+            return distance, self.min_block_time
+        return distance, max(self.min_block_time, distance / rate * 60.0)
+
+
+def dwell_seconds(words: List[Tuple[str, float]]) -> float:
+    """ G4 dwell time.  P is in milliseconds, X in seconds. """
+    for letter, value in words:
+        if letter == 'P':
+            return value / 1000.0
+        if letter == 'X':
+            return value
+    return 0.0
+
+
+def arc_length(start: Dict[str, float], end: Dict[str, float],
+               arc: Dict[str, float], plane: int, clockwise: bool) -> float:
+    """ Length of a G2/G3 arc, including any helical move. """
+    a, b, normal, i_word, j_word = PLANES[plane]
+    sa, sb = start[a], start[b]
+    ea, eb = end[a], end[b]
+    chord = math.hypot(ea - sa, eb - sb)
+    height = end[normal] - start[normal]
+
+    if 'R' in arc:
+        radius = abs(arc['R'])
+        if radius == 0.0 or chord > 2 * radius:
+            return math.hypot(chord, height)
+        sweep = 2 * math.asin(min(1.0, chord / (2 * radius)))
+        if arc['R'] < 0:
+            sweep = 2 * math.pi - sweep     # Negative R is the long way
+    else:
+        ca = sa + arc.get(i_word, 0.0)
+        cb = sb + arc.get(j_word, 0.0)
+        radius = math.hypot(sa - ca, sb - cb)
+        if radius == 0.0:
+            return math.hypot(chord, height)
+        start_angle = math.atan2(sb - cb, sa - ca)
+        end_angle = math.atan2(eb - cb, ea - ca)
+        sweep = start_angle - end_angle if clockwise else end_angle - start_angle
+        sweep %= 2 * math.pi
+        if sweep < 1e-9:
+            sweep = 2 * math.pi     # Same start and end is a full circle
+
+    return math.hypot(radius * sweep, height)
+
+
+class DripFeed:
+    """ Projects a drip fed run of a program, one line at a time.
+
+        The line sends each line as soon as the machine has buffer room
+        for it.  A line leaves the buffer when it starts running, and it
+        can't start until the one before has finished and all its chars
+        have arrived.  Times are seconds from the start of the send.
+    """
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 chars_per_sec: float = CHARS_PER_SEC):
+        self.buffer_size = buffer_size
+        self.chars_per_sec = chars_per_sec
+        self.buffer = deque()       # (chars, start time) of buffered lines
+        self.buffered = 0           # Chars in the buffer
+        self.link_free = 0.0        # When the line can send the next line
+        self.finish = 0.0           # When the last line finishes running
+        self.running = False        # A block that takes time has started
+        self.lines = 0
+        self.chars = 0
+        self.machine_seconds = 0.0
+        self.starved_seconds = 0.0  # Machine waiting on the line
+        self.region: List = []      # [first line, last line, seconds]
+        self.regions: List[List] = []
+
+    def line(self, chars: int, seconds: float) -> float:
+        """ Add the next line, chars long, that takes seconds to run.
+            Returns when it would finish running.
+        """
+        send_at = self.link_free
+        while self.buffer and (self.buffered + chars > self.buffer_size
+                               or self.buffer[0][1] <= send_at):
+            # Wait for the oldest buffered line to start running.
+            buffered_chars, start = self.buffer.popleft()
+            self.buffered -= buffered_chars
+            send_at = max(send_at, start)
+        arrived = send_at + chars / self.chars_per_sec
+        self.link_free = arrived
+
+        wait = arrived - self.finish
+        if self.running and wait > 0.0:
+            self.waited(wait)
+        start = max(self.finish, arrived)
+        self.finish = start + seconds
+        self.buffer.append((chars, start))
+        self.buffered += chars
+
+        self.running = self.running or seconds > 0.0
+        self.lines += 1
+        self.chars += chars
+        self.machine_seconds += seconds
+        return self.finish
+
+    def waited(self, wait: float):
+        """ The machine waits on the line before running this line. """
+        self.starved_seconds += wait
+        line = self.lines
+        if self.region and line - self.region[1] <= REGION_GAP:
+            self.region[1] = line
+            self.region[2] += wait
+            return
+        self.end_region()
+        self.region = [line, line, wait]
+
+    def end_region(self):
+        if self.region and self.region[2] >= MIN_REGION_WAIT:
+            self.regions.append(self.region)
+            if len(self.regions) > 4 * MAX_REGIONS:
+                self.regions = longest(self.regions)
+        self.region = []
+
+    def summary(self) -> dict:
+        """ Totals, and the regions where the machine waits longest on
+            the line as [first line, last line, seconds waiting], lines
+            counted from 0 in the order they were added.
+        """
+        self.end_region()
+        return {
+            "lines": self.lines,
+            "machine_seconds": round(self.machine_seconds, 3),
+            "link_seconds": round(self.chars / self.chars_per_sec, 3),
+            "drip_feed_seconds": round(self.finish, 3),
+            "starved_seconds": round(self.starved_seconds, 3),
+            "buffer_size": self.buffer_size,
+            "link_bound": [[first, last, round(wait, 3)] for first, last, wait
+                           in sorted(longest(self.regions))],
+        }
+
+
+def format_duration(seconds: float) -> str:
+    """ e.g. "1:02:03" or "2:03" """
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
+
+
+def longest(regions: List[List]) -> List[List]:
+    """ The MAX_REGIONS regions with the longest waits. """
+    return sorted(regions, key=lambda r: r[2], reverse=True)[:MAX_REGIONS]
@@ -0,0 +1,750 @@
+"""
+
+gcode_preflight.py - program statistics for an uploaded G-code file
+
+Runs once per uploaded file, in a background thread of the web app, and
+the result is cached in the file index (see file_index.py) so the index and
+send pages can show it without reading the file again:
+
+    blocks, tool changes and tools used, feed and spindle ranges,
+    X Y Z extents, path length (feed and rapid), the longest line, and
+    how many lines the serial sender's clean up will change (padded short
+    lines, line endings, upper case, blank lines dropped, anything after
+    the % end marker), and how long it takes to run, fed from memory or drip
+fed over the 9600 baud line, and where a drip fed run leaves the machine
+waiting on the line.
+
+The time each line takes to run goes in a timing file next to the send
+plan (see save_timing() in send_plan.py), which is what the serial sender
+paces its writes and works out its ETA from.  The points a send can be
+restarted from go in a resume index next to it (see gcode_resume.py).
+
+The file is read in big chunks and each chunk is taken apart with numpy
+array operations, not a Python loop per line or word.  Two passes still
+go line by line in Python, over the plan's lines: the drip feed projection
+(gcode_motion.DripFeed) and the restart points.  A 50 MB file takes about
+20 seconds on a desktop PC, half of it finding the restart points, and the
+worker doing it grows to about 200 MB while it runs; the Pi is several
+times slower.  So the summary and timing are saved as soon as they are
+done, and the restart points are added to the summary once they are found
+(see save_preflight()).
+
+The rules for what gets sent are the same as gcode_lines() in
+send_plan.py.  Motion follows gcode_motion.py: G0 to G3 with I J K or R
+arcs, G17/G18/G19 and G90/G91.  G4, G10, G28, G30, G52, G53 and G92 blocks
+are not counted as moves.  Like gcode_motion.py this is a model for a
+summary, not a controller.
+
+"""
+
+import os
+import sys
+import queue
+import threading
+import time
+from array import array
+from typing import Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+
+import gcode_arcs
+import gcode_motion
+import gcode_resume
+import send_plan
+
+PREFLIGHT_VERSION = 6
+CHUNK_SIZE = 1024 * 1024        # Bytes per chunk, whole lines
+EXAMPLE_LINES = 10              # Line numbers kept for each kind of change
+MAX_DIGITS = 18                 # Digits of a number that are used
+
+AXES = "XYZ"
+NOT_MOVES = (4, 10, 28, 30, 52, 53, 92)   # G codes whose XYZ words don't move
+# Axes for the arc plane and the axis normal to it, by plane G code.
+PLANES = {17: ("X", "Y", "Z", "I", "J"),
+          18: ("Z", "X", "Y", "K", "I"),
+          19: ("Y", "Z", "X", "J", "K")}
+
+WHITESPACE = np.array([9, 10, 11, 12, 13, 32], dtype=np.uint8)
+NEWLINE, CR, PERCENT = 10, 13, 37
+POWERS_OF_TEN = 10 ** np.arange(MAX_DIGITS + 1, dtype=np.int64)
+
+
+class Blocks:
+    """ The G-code blocks (lines that get sent) in one chunk of a file.
+
+        Each attribute is a numpy array with one entry per block.
+        Words a block does not have are NaN.
+    """
+    def __init__(self, line_numbers: np.ndarray, lengths: np.ndarray,
+                 offsets: np.ndarray):
+        n = len(line_numbers)
+        self.line_numbers = line_numbers    # 1 based line in the file
+        self.lengths = lengths              # Chars, not counting CR LF
+        self.offsets = offsets              # Where the line starts in the file
+        self.words: Dict[str, np.ndarray] = {
+            letter: np.full(n, np.nan) for letter in "FIJKMPRSTXYZ"}
+        self.g_block = np.zeros(0, dtype=np.int64)  # G words, any number
+        self.g_value = np.zeros(0)                  # per block
+        self.motion = np.zeros(n)           # G0 to G3, modal
+        self.moves = np.zeros(n, dtype=bool)    # Block moves the tool
+        self.start: Dict[str, np.ndarray] = {}  # Position before the block
+        self.end: Dict[str, np.ndarray] = {}    # Position after the block
+        self.distance = np.zeros(n)         # Path length of the block
+        self.seconds = np.zeros(n)          # Time to run the block
+        self.run_seconds = np.zeros(n)      # Without the minimum block time
+
+
+class ChunkState:
+    """ What one chunk of the file leaves for the next. """
+    def __init__(self):
+        self.line_base = 0          # Lines in earlier chunks
+        self.offset_base = 0        # Bytes in earlier chunks
+        self.saw_start_percent = False
+        self.saw_code = False
+        self.ended = False          # Saw the % end marker
+        self.motion = 0
+        self.feed = 0.0
+        self.plane = 17
+        self.absolute = True
+        self.position = {axis: 0.0 for axis in AXES}
+
+
+class Preflight:
+    """ Accumulates the program statistics over the chunks of a file. """
+    def __init__(self):
+        self.blocks = 0
+        self.lines = 0
+        self.tool_changes = 0
+        self.tools = set()
+        self.units: Optional[str] = None
+        self.feed = [np.inf, -np.inf]
+        self.spindle = [np.inf, -np.inf]
+        self.extents = {axis: [np.inf, -np.inf] for axis in AXES}
+        self.feed_length = 0.0
+        self.rapid_length = 0.0
+        self.longest_line = {"line": 0, "length": 0}
+        self.changes = {"padded": 0, "line_endings": 0, "upper_cased": 0,
+                        "blank_lines": 0, "after_end": 0}
+        self.examples: Dict[str, List[int]] = {
+            name: [] for name in self.changes}
+
+        # One entry per line of the send plan, starting with the leader.
+        # Until end(), one per block, as if there was no plan.
+        self.drip = gcode_motion.DripFeed()
+        self.line_chars = array('I', [2])   # The leader, just CR LF
+        self.line_seconds = array('f', [0.0])
+        self.line_finish = array('d')
+        self.file_lines = array('I', [0])   # Line in the file, 0 for none
+        self.file_offsets = array('Q')      # Of each block, no leader
+        self.run_seconds = array('f')       # Of each block, unclamped
+        self.compaction: Optional[dict] = None
+        self.arcs: Optional[dict] = None
+
+    def add(self, blocks: Blocks):
+        self.blocks += len(blocks.line_numbers)
+        chars = np.maximum(blocks.lengths, 3) + 2      # Padded, CR LF
+        self.line_chars.frombytes(chars.astype(np.uint32).tobytes())
+        self.line_seconds.frombytes(blocks.seconds.astype(np.float32).tobytes())
+        self.file_lines.frombytes(
+            blocks.line_numbers.astype(np.uint32).tobytes())
+        self.file_offsets.frombytes(blocks.offsets.astype(np.uint64).tobytes())
+        self.run_seconds.frombytes(
+            blocks.run_seconds.astype(np.float32).tobytes())
+        if len(blocks.lengths):
+            i = int(np.argmax(blocks.lengths))
+            if blocks.lengths[i] > self.longest_line["length"]:
+                self.longest_line = {"line": int(blocks.line_numbers[i]),
+                                     "length": int(blocks.lengths[i])}
+
+        self.tool_changes += int(np.count_nonzero(blocks.words["M"] == 6))
+        t = blocks.words["T"]
+        self.tools.update(int(v) for v in np.unique(t[~np.isnan(t)]))
+        widen(self.feed, blocks.words["F"][blocks.words["F"] > 0])
+        widen(self.spindle, blocks.words["S"][blocks.words["S"] > 0])
+
+        for axis in AXES:
+            moved = blocks.moves & ~np.isnan(blocks.words[axis])
+            widen(self.extents[axis], blocks.end[axis][moved])
+
+        rapid = blocks.moves & (blocks.motion == 0)
+        self.rapid_length += float(blocks.distance[rapid].sum())
+        self.feed_length += float(blocks.distance[blocks.moves & ~rapid].sum())
+
+        if self.units is None:
+            units = blocks.g_value[np.isin(blocks.g_value, (20, 21))]
+            if len(units):
+                self.units = "in" if units[0] == 20 else "mm"
+
+    def change(self, name: str, line_numbers: np.ndarray):
+        self.changes[name] += len(line_numbers)
+        room = EXAMPLE_LINES - len(self.examples[name])
+        if room > 0:
+            self.examples[name].extend(int(n) for n in line_numbers[:room])
+
+    def end(self, plan: Optional[send_plan.SendPlan] = None):
+        """ No more blocks.  The % goes on the end of the last line.
+
+            With a plan, the lines are the plan's lines, see plan_lines().
+            Then projects when each line would finish when drip fed.
+        """
+        if plan is not None:
+            if plan.compaction is not None:
+                self.compaction = dict(plan.compaction,
+                                       crc32=plan.crc32_value)
+            if plan.arcs is not None:
+                self.arcs = dict(plan.arcs, crc32=plan.crc32_value)
+            chars, seconds, file_lines = self.plan_lines(plan)
+        else:
+            chars = np.frombuffer(self.line_chars, dtype=np.uint32)
+            seconds = np.frombuffer(self.line_seconds, dtype=np.float32)
+            file_lines = np.frombuffer(self.file_lines, dtype=np.uint32)
+            if len(chars) == 1:
+                # Nothing but the leader, the % is a line of its own.
+                seconds = np.append(seconds, 0).astype(np.float32)
+                file_lines = np.append(file_lines, 0).astype(np.uint32)
+                chars = np.append(chars, 0)
+            chars = chars.astype(np.uint32)     # A copy we can change
+            chars[-1] += 1
+
+        self.line_chars = to_array('I', chars)
+        self.line_seconds = to_array('f', seconds)
+        self.file_lines = to_array('I', file_lines)
+        self.drip = gcode_motion.DripFeed()
+        # From the arrays, which hand out one number at a time, not
+        # tolist(), which makes them all at once.
+        self.line_finish = array('d', map(self.drip.line, self.line_chars,
+                                          self.line_seconds))
+
+    def plan_lines(self, plan: send_plan.SendPlan):
+        """ (chars, seconds, file lines) for each line of plan.
+
+            Each block is part of the plan line that starts at or before it
+            in the file, so the time of moves a stage merged into one line
+            adds up, and a dropped block that doesn't move adds nothing.
+            The minimum block time is per plan line.
+        """
+        offsets = np.frombuffer(plan.line_offsets(), dtype=np.uint64)
+        chars = np.diff(np.append(offsets, plan.data_size)).astype(np.uint32)
+        sources = np.frombuffer(plan.source_offsets(), dtype=np.uint64)
+        blocks = np.frombuffer(self.file_offsets, dtype=np.uint64)
+        block_seconds = np.frombuffer(self.run_seconds, dtype=np.float32)
+        block_lines = np.frombuffer(self.file_lines, dtype=np.uint32)[1:]
+
+        which = np.searchsorted(sources[1:], blocks, side="right")
+        seconds = np.bincount(which, weights=block_seconds,
+                              minlength=plan.lines)[:plan.lines]
+        seconds = np.maximum(seconds, gcode_motion.DEFAULT_MIN_BLOCK_TIME)
+        seconds[0] = 0.0    # The leader, and blocks before the first line
+
+        first = np.minimum(np.searchsorted(blocks, sources),
+                           max(len(blocks) - 1, 0))
+        file_lines = np.zeros(plan.lines, dtype=np.uint32)
+        if len(blocks):
+            found = blocks[first] == sources
+            file_lines[found] = block_lines[first[found]]
+        file_lines[0] = 0
+        return chars, seconds.astype(np.float32), file_lines
+
+    def timing(self) -> dict:
+        """ The drip feed projection, regions as lines in the file. """
+        timing = self.drip.summary()
+        timing["link_bound"] = [
+            [self.file_lines[first], self.file_lines[last], wait]
+            for first, last, wait in timing["link_bound"]]
+        return timing
+
+    def summary(self) -> dict:
+        return {
+            "version": PREFLIGHT_VERSION,
+            "blocks": self.blocks,
+            "lines": self.lines,
+            "units": self.units,
+            "tool_changes": self.tool_changes,
+            "tools": sorted(self.tools),
+            "feed": span(self.feed),
+            "spindle": span(self.spindle),
+            "extents": {axis: span(r) for axis, r in self.extents.items()
+                        if span(r) is not None},
+            "path_length": round(self.feed_length + self.rapid_length, 4),
+            "feed_length": round(self.feed_length, 4),
+            "rapid_length": round(self.rapid_length, 4),
+            "longest_line": self.longest_line,
+            "changes": dict(self.changes),
+            "examples": {k: v for k, v in self.examples.items() if v},
+            "timing": self.timing(),
+            "compaction": self.compaction,
+            "arcs": self.arcs,
+        }
+
+
+def to_array(typecode: str, values: np.ndarray) -> array:
+    """ values as an array of the same item type. """
+    result = array(typecode)
+    result.frombytes(values.tobytes())
+    return result
+
+
+def widen(limits: list, values: np.ndarray):
+    if len(values):
+        limits[0] = min(limits[0], float(values.min()))
+        limits[1] = max(limits[1], float(values.max()))
+
+
+def span(limits: list) -> Optional[list]:
+    if limits[0] > limits[1]:
+        return None
+    return [round(limits[0], 4), round(limits[1], 4)]
+
+
+def analyze(path: str) -> dict:
+    """ Program statistics for the G-code file at path.
+        Raises OSError if it can't be read.
+    """
+    return preflight_file(path)[0].summary()
+
+
+def preflight_file(path: str, plan: Optional[send_plan.SendPlan] = None):
+    """ Run the preflight of the file at path, with the lines of its
+        send plan if there is one.
+        Returns (Preflight, summary).
+        Raises OSError if it can't be read.
+    """
+    started = time.time()
+    preflight = Preflight()
+    state = ChunkState()
+    for chunk in read_chunks(path):
+        preflight.add(chunk_blocks(chunk, state, preflight))
+    preflight.lines = state.line_base
+    preflight.end(plan)
+    result = preflight.summary()
+    result["size"] = os.path.getsize(path)
+    result["seconds"] = round(time.time() - started, 3)
+    return preflight, result
+
+
+def save_preflight(path: str, compact: Optional[bool] = None,
+                   arc_tolerance_mm: Optional[float] = None,
+                   summary_ready: Optional[Callable[[dict], None]] = None
+                   ) -> dict:
+    """ Run the preflight of the file at path, save the time each line
+        of its send plan takes to run and its resume index, and return the
+        summary.
+
+        If there is no plan, or it was not made with compact (default
+        COMPACT_GCODE from the environment) and arc_tolerance_mm (default
+        ARC_TOLERANCE_MM), it is made again with them first.
+
+        Finding the restart points takes about as long again as the rest,
+        so summary_ready, if given, is called with the summary as soon as
+        the timing is saved, before the resume index.  That summary has
+        no "resume" yet.
+
+        Raises OSError on error.
+    """
+    st = os.stat(path)
+    if compact is None:
+        compact = send_plan.compaction_enabled()
+    if arc_tolerance_mm is None:
+        arc_tolerance_mm = gcode_arcs.arc_tolerance_mm()
+    plan = send_plan.SendPlan.load(path)
+    if plan is None or not plan.made_with(compact, arc_tolerance_mm):
+        plan = send_plan.compile_plan(
+            path, plan.upload if plan is not None else None,
+            compact=compact, arc_tolerance_mm=arc_tolerance_mm)
+    preflight, result = preflight_file(path, plan)
+    result["crc32"] = plan.crc32_value
+    send_plan.save_timing(path, st, preflight.line_chars,
+                          preflight.line_seconds, preflight.line_finish,
+                          preflight.drip.summary())
+    if summary_ready is not None:
+        summary_ready(dict(result))
+    file_lines = preflight.file_lines
+    del preflight   # Let the rest go before the long pass over the plan
+    result["resume"] = gcode_resume.save_resume_index(
+        path, st, plan, file_lines)
+    return result
+
+
+def read_chunks(path: str) -> Iterator[np.ndarray]:
+    """ The file in chunks of whole lines, each ending in \\n.  A line
+        ending in \\r alone ends in \\n here, see source_chunks().
+    """
+    with send_plan.open_source(path) as fd:
+        tail = b""
+        for data in send_plan.source_chunks(fd, size=CHUNK_SIZE):
+            data = tail + data
+            cut = data.rfind(b"\n") + 1
+            tail = data[cut:]
+            if cut:
+                yield np.frombuffer(data[:cut], dtype=np.uint8)
+        if tail:
+            # Last line has no \n.  Its ending gets changed either way.
+            yield np.frombuffer(tail + b"\n", dtype=np.uint8)
+
+
+def chunk_blocks(b: np.ndarray, state: ChunkState,
+                 preflight: Preflight) -> Blocks:
+    """ Find the blocks in one chunk, note the clean up changes in
+        preflight, and work out their words and motion.
+    """
+    ends = np.flatnonzero(b == NEWLINE)     # Index of each \n
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    line_lengths = ends - starts + 1
+    line_numbers = state.line_base + np.arange(1, len(ends) + 1)
+    offsets = state.offset_base + starts
+    state.line_base += len(ends)
+    state.offset_base += len(b)
+
+    # Where each line's text ends once trailing white space is stripped.
+    text = ~np.isin(b, WHITESPACE)
+    last_text = np.maximum.accumulate(
+        np.where(text, np.arange(len(b), dtype=np.int32), -1))
+    text_ends = np.maximum(last_text[ends] + 1, starts)
+    lengths = text_ends - starts
+    is_percent = (lengths > 0) & (b[starts] == PERCENT)
+
+    after = np.zeros(len(ends), dtype=bool)     # After the % end marker
+    if state.ended:
+        after[:] = True
+    code, end_marker = code_lines(lengths, is_percent, state)
+    if end_marker is not None:
+        after[end_marker + 1:] = True
+    preflight.change("blank_lines", line_numbers[(lengths == 0) & ~after])
+    preflight.change("after_end", line_numbers[(lengths > 0) & after])
+
+    # What the clean up does to the lines that get sent.
+    lower = ((b >= 97) & (b <= 122)).astype(np.int32)
+    lower_sums = np.concatenate(([0], np.cumsum(lower)))
+    has_lower = lower_sums[text_ends] > lower_sums[starts]
+    crlf = (ends - text_ends == 1) & (b[ends - 1] == CR)
+    preflight.change("padded", line_numbers[code][lengths[code] < 3])
+    preflight.change("line_endings", line_numbers[code][~crlf[code]])
+    preflight.change("upper_cased", line_numbers[code][has_lower[code]])
+
+    blocks = Blocks(line_numbers[code], lengths[code], offsets[code])
+    find_words(b, text, starts, ends, line_lengths, code, blocks)
+    find_motion(blocks, state)
+    find_times(blocks, state)
+    return blocks
+
+
+def code_lines(lengths: np.ndarray, is_percent: np.ndarray,
+               state: ChunkState):
+    """ Index of the lines in the chunk that get sent, and of the %
+        end marker if it is in this chunk.  Same rules as gcode_lines()
+        in send_plan.py.
+    """
+    if state.ended:
+        return np.zeros(0, dtype=np.int64), None
+    non_blank = np.flatnonzero(lengths > 0)
+    if (not state.saw_code and not state.saw_start_percent
+            and len(non_blank) and is_percent[non_blank[0]]):
+        state.saw_start_percent = True
+        non_blank = non_blank[1:]
+    end_marker = None
+    markers = np.flatnonzero(is_percent[non_blank])
+    if len(markers):
+        end_marker = int(non_blank[markers[0]])
+        non_blank = non_blank[:markers[0]]
+        state.ended = True
+    if len(non_blank):
+        state.saw_code = True
+    return non_blank, end_marker
+
+
+def find_words(b: np.ndarray, text: np.ndarray, starts: np.ndarray,
+               ends: np.ndarray, line_lengths: np.ndarray, code: np.ndarray,
+               blocks: Blocks):
+    """ Pull the letter and number words out of the blocks, comments
+        and spaces removed, into blocks.words, g_block and g_value.
+    """
+    is_code = np.zeros(len(starts), dtype=bool)
+    is_code[code] = True
+    keep = np.repeat(is_code, line_lengths) & text
+
+    # Comments in ( ) and after ; to the end of the line.  Most files
+    # only have a few, so don't pay for them when there are none.
+    if (b == 40).any():
+        parens = (b == 40).astype(np.int32) - (b == 41)
+        keep &= (count_in_runs(parens, starts, line_lengths) <= 0) & (b != 41)
+    if (b == 59).any():
+        semis = (b == 59).astype(np.int32)
+        keep &= count_in_runs(semis, starts, line_lengths) == 0
+
+    keep |= b == NEWLINE    # Newlines stay so words can't run together
+    kept = np.flatnonzero(keep)
+    chars = b[kept]
+    chars = np.where((chars >= 97) & (chars <= 122), chars - 32, chars)
+
+    # A word is a letter then a run of number chars.
+    is_letter = (chars >= 65) & (chars <= 90)
+    is_number = ((chars >= 48) & (chars <= 57)) | (chars == 46) \
+        | (chars == 43) | (chars == 45)
+    run_start = is_number & ~np.concatenate(([False], is_number[:-1]))
+    run_start &= np.concatenate(([False], is_letter[:-1]))
+    if not run_start.any():
+        return
+    index = np.arange(len(chars), dtype=np.int32)
+    # Number chars in a run that started right after a letter.
+    word_run = np.maximum.accumulate(np.where(run_start, index, -1))
+    reset = np.maximum.accumulate(np.where(is_number, -1, index))
+    positions = np.flatnonzero(is_number & (word_run > reset))
+    c = chars[positions]
+    word_id = word_run[positions]
+    word_starts, word_lengths = runs(word_id)
+
+    # Like float(), a number ends at a second point or a sign that is
+    # not the first char, so X1.2.3 is X1.2.
+    point = (c == 46).astype(np.int32)
+    sign = (c == 43) | (c == 45)
+    sign[word_starts] = False
+    bad = sign | ((point > 0) & (count_in_runs(point, word_starts,
+                                               word_lengths) > 1))
+    if bad.any():
+        good = count_in_runs(bad.astype(np.int32), word_starts,
+                             word_lengths) == 0
+        positions, c, word_id = positions[good], c[good], word_id[good]
+        point = point[good]
+        word_starts, word_lengths = runs(word_id)
+
+    # Value = the digits as an integer / 10 ** digits after the point.
+    # Past MAX_DIGITS the digits are too small to matter and are dropped.
+    digit = ((c >= 48) & (c <= 57)).astype(np.int32)
+    digit_count = np.add.reduceat(digit, word_starts)
+    used = np.minimum(digit_count, MAX_DIGITS)
+    nth = count_in_runs(digit, word_starts, word_lengths)   # 1 based
+    over = (digit > 0) & (nth > MAX_DIGITS)
+    digit[over] = 0
+    place = np.clip(np.repeat(used, word_lengths) - nth, 0, MAX_DIGITS)
+    mantissa = np.add.reduceat(
+        digit * (c.astype(np.int64) - 48) * POWERS_OF_TEN[place], word_starts)
+    after_point = count_in_runs(point, word_starts, word_lengths) > 0
+    decimals = np.add.reduceat(digit * after_point, word_starts)
+    dropped = digit_count - used - np.add.reduceat(
+        over & after_point, word_starts)    # Dropped before the point
+    values = mantissa * np.power(10.0, dropped - decimals)
+    values = np.where(c[word_starts] == 45, -values, values)
+
+    good = digit_count > 0
+    letters = chars[positions[word_starts] - 1][good]
+    values = values[good]
+    lines = np.searchsorted(ends, kept[positions[word_starts][good]])
+    block_of_line = np.cumsum(is_code) - 1
+    word_blocks = block_of_line[lines]
+
+    for letter, block_values in blocks.words.items():
+        mask = letters == ord(letter)
+        which, last = last_per_block(word_blocks[mask], values[mask])
+        block_values[which] = last
+    g = letters == ord("G")
+    blocks.g_block = word_blocks[g]
+    blocks.g_value = values[g]
+
+
+def runs(ids: np.ndarray):
+    """ Start and length of each run of equal ids. """
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    return starts, np.diff(np.concatenate((starts, [len(ids)])))
+
+
+def count_in_runs(mask: np.ndarray, run_starts: np.ndarray,
+                  run_lengths: np.ndarray) -> np.ndarray:
+    """ Running total of mask, starting again at each run. """
+    totals = np.cumsum(mask)
+    return totals - np.repeat(totals[run_starts] - mask[run_starts],
+                              run_lengths)
+
+
+def last_per_block(block_index: np.ndarray, values: np.ndarray):
+    """ The last value for each block, for words in order.
+        Returns (block indexes, values).
+    """
+    last = np.concatenate((block_index[1:] != block_index[:-1], [True])) \
+        if len(block_index) else np.zeros(0, dtype=bool)
+    return block_index[last], values[last]
+
+
+def forward_fill(values: np.ndarray, first: float) -> np.ndarray:
+    """ Replace each NaN with the last value before it, first if none. """
+    values = np.concatenate(([first], values))
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    return values[np.maximum.accumulate(index)][1:]
+
+
+def modal(blocks: Blocks, codes, first: float) -> np.ndarray:
+    """ Value of one modal G code group for each block. """
+    group = np.full(len(blocks.line_numbers), np.nan)
+    mask = np.isin(blocks.g_value, codes)
+    which, last = last_per_block(blocks.g_block[mask], blocks.g_value[mask])
+    group[which] = last
+    return forward_fill(group, first)
+
+
+def find_motion(blocks: Blocks, state: ChunkState):
+    """ Work out where each block goes and how far. """
+    n = len(blocks.line_numbers)
+    blocks.motion = modal(blocks, (0, 1, 2, 3), state.motion)
+    plane = modal(blocks, tuple(PLANES), state.plane)
+    absolute = modal(blocks, (90, 91), 90 if state.absolute else 91) == 90
+
+    not_move = np.zeros(n, dtype=bool)
+    not_move[blocks.g_block[np.isin(blocks.g_value, NOT_MOVES)]] = True
+    has_axis = np.zeros(n, dtype=bool)
+    for axis in AXES:
+        has_axis |= ~np.isnan(blocks.words[axis])
+    blocks.moves = has_axis & ~not_move
+
+    for axis in AXES:
+        # Incremental moves add up, an absolute move starts over.
+        value = np.where(blocks.moves, blocks.words[axis], np.nan)
+        step = np.where(~absolute & ~np.isnan(value), value, 0.0)
+        total = np.cumsum(step)
+        anchor = np.where(absolute & ~np.isnan(value), value - total, np.nan)
+        end = forward_fill(anchor, state.position[axis]) + total
+        blocks.end[axis] = end
+        blocks.start[axis] = np.concatenate(([state.position[axis]], end[:-1]))
+        if n:
+            state.position[axis] = float(end[-1])
+
+    distance = np.sqrt(sum((blocks.end[a] - blocks.start[a]) ** 2
+                           for a in AXES))
+    arcs = blocks.moves & ((blocks.motion == 2) | (blocks.motion == 3))
+    if arcs.any():
+        distance = np.where(arcs, arc_lengths(blocks, plane), distance)
+    blocks.distance = np.where(blocks.moves, distance, 0.0)
+
+    if n:
+        state.motion = int(blocks.motion[-1])
+        state.plane = int(plane[-1])
+        state.absolute = bool(absolute[-1])
+
+
+def find_times(blocks: Blocks, state: ChunkState):
+    """ Seconds to run each block, like MotionState.block() in
+        gcode_motion.py.
+    """
+    feed = forward_fill(blocks.words["F"], state.feed)
+    if len(feed):
+        state.feed = float(feed[-1])
+    rate = np.where(blocks.motion == 0, gcode_motion.DEFAULT_RAPID_RATE, feed)
+    moving = blocks.moves & (rate > 0)
+    seconds = np.zeros(len(rate))
+    seconds[moving] = blocks.distance[moving] / rate[moving] * 60.0
+
+    # G4 dwells, P in milliseconds or X in seconds.
+    dwell = blocks.g_block[blocks.g_value == 4]
+    p, x = blocks.words["P"][dwell], blocks.words["X"][dwell]
+    seconds[dwell] = np.nan_to_num(np.where(np.isnan(p), x, p / 1000.0))
+    blocks.run_seconds = seconds
+    blocks.seconds = np.maximum(seconds, gcode_motion.DEFAULT_MIN_BLOCK_TIME)
+
+
+def in_plane(plane: np.ndarray, which: int,
+             arrays: Dict[str, np.ndarray]) -> np.ndarray:
+    """ For each block, the array named by PLANES[plane][which]. """
+    out = np.zeros(len(plane))
+    for code, names in PLANES.items():
+        out = np.where(plane == code, arrays[names[which]], out)
+    return out
+
+
+def arc_lengths(blocks: Blocks, plane: np.ndarray) -> np.ndarray:
+    """ Length of every block taken as a G2/G3 arc, in its plane.
+        Same sums as arc_length() in gcode_motion.py.
+    """
+    centers = {k: np.nan_to_num(blocks.words[k]) for k in "IJK"}
+    sa, sb = in_plane(plane, 0, blocks.start), in_plane(plane, 1, blocks.start)
+    ea, eb = in_plane(plane, 0, blocks.end), in_plane(plane, 1, blocks.end)
+    height = in_plane(plane, 2, blocks.end) - in_plane(plane, 2, blocks.start)
+    chord = np.hypot(ea - sa, eb - sb)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Center from I J K
+        ca = sa + in_plane(plane, 3, centers)
+        cb = sb + in_plane(plane, 4, centers)
+        radius = np.hypot(sa - ca, sb - cb)
+        start_angle = np.arctan2(sb - cb, sa - ca)
+        end_angle = np.arctan2(eb - cb, ea - ca)
+        sweep = np.where(blocks.motion == 2, start_angle - end_angle,
+                         end_angle - start_angle) % (2 * np.pi)
+        sweep = np.where(sweep < 1e-9, 2 * np.pi, sweep)  # Full circle
+
+        # Or from R, negative R is the long way round
+        r = blocks.words["R"]
+        has_r = ~np.isnan(r)
+        r = np.nan_to_num(r)
+        r_sweep = 2 * np.arcsin(np.minimum(1.0, chord / (2 * np.abs(r))))
+        r_sweep = np.where(r < 0, 2 * np.pi - r_sweep, r_sweep)
+        radius = np.where(has_r, np.abs(r), radius)
+        sweep = np.where(has_r, r_sweep, sweep)
+        length = np.hypot(radius * sweep, height)
+
+    straight = (radius == 0.0) | (has_r & (chord > 2 * radius))
+    return np.where(straight, np.hypot(chord, height), length)
+
+
+class PreflightRunner:
+    """ Runs preflights one at a time in a background thread and saves
+        them in the file index.
+    """
+    def __init__(self, index):
+        self.index = index          # file_index.FileIndex
+        self.queue: "queue.Queue[str]" = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.pid = os.getpid()
+
+    def submit(self, name: str) -> None:
+        """ Queue a preflight of the upload name, unless one is queued. """
+        with self.lock:
+            if self.pid != os.getpid():
+                # We were forked, the thread belongs to our parent.
+                self.thread = None
+                self.pending = set()
+                self.queue = queue.Queue()
+                self.pid = os.getpid()
+            if name in self.pending:
+                return
+            self.pending.add(name)
+            self.queue.put(name)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            name = self.queue.get()
+            try:
+                self.preflight(name)
+            except Exception as err:
+                # Keep the thread, or every later submit waits forever.
+                sys.stderr.write(f"preflight of {name}: {err!r}\n")
+            finally:
+                with self.lock:
+                    self.pending.discard(name)
+
+    def preflight(self, name: str) -> None:
+        """ Preflight the upload name and save the result in the index.
+            A file the preflight fails on gets a result saying so, with
+            "failed" in it, so it is not tried again until it changes.
+        """
+        path = os.path.join(self.index.upload_path, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return      # Gone
+        def summary_ready(summary: dict) -> None:
+            self.index.set_preflight(name, st.st_size, st.st_mtime_ns,
+                                     summary)
+
+        try:
+            # The same bytes under another name share the plan and timing,
+            # once the other's resume index is done too.
+            result = self.index.shared_preflight(name)
+            if result is None or result.get("version") != PREFLIGHT_VERSION \
+                    or "resume" not in result:
+                result = save_preflight(path, summary_ready=summary_ready)
+        except (OSError, ValueError, MemoryError) as err:
+            result = {"version": PREFLIGHT_VERSION, "failed": str(err)}
+        self.index.set_preflight(name, st.st_size, st.st_mtime_ns, result)
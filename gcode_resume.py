@@ -0,0 +1,505 @@
+"""
+
+gcode_resume.py - restart a drip feed part way through a program
+
+When a job stopped part way (a broken tool, a power blip) the only way on
+was to send the file again from the start.  This finds the places in a send
+plan a job can be restarted from, and the modal state the machine has to be
+put back in first, so the sender can start from there instead.
+
+The preflight (see save_preflight() in gcode_preflight.py) runs every line
+of the send plan through ModalState and saves a resume index next to the
+plan:
+
+    [file line of each plan line][json header][header size][magic]
+
+File lines are 4 byte little endian unsigned ints, 0 for lines that are not
+the start of a line in the file, like the leader.  The header records the
+source size and mtime and the CRC and line count of the plan it was made
+from, a stale index is ignored.  It lists the restart-safe points:
+
+    tool     a tool change (M6).  The preamble puts back the modes and
+             selects the tool, the program does the rest.
+    retract  the line after a G0 straight up to the highest Z used since
+             the tool change.  The preamble also loads the tool, sets the
+             tool length, spindle and coolant, goes to that Z and then
+             over to X Y.
+
+and the state every CHECKPOINT_LINES lines, so the state before any line is
+worked out by running no more than that many lines from the checkpoint
+before it.  A job can also restart at any other line where the state is
+known, the same way as a retract, but feeding back down to Z at the end.
+
+The sender sends the leader, the preamble, then the plan from the restart
+line on, seeking straight to it with the plan's line offsets.
+
+The state is lost for good after a macro (# or [), a subprogram call or a
+change to the coordinate systems (G10, G52, G92), so nothing after one is
+offered.  A position is lost after G28, G30 or G53 moves it and Z in canned
+cycles, until an absolute move sets it again.  Restarts in cutter
+compensation, canned cycles or G2/G3 are refused.  Like gcode_motion.py this
+is a model of the Yasnac, not the Yasnac: the preamble is only as right as
+the program before the restart.
+
+"""
+
+import os
+import re
+import sys
+import json
+import struct
+import tempfile
+from array import array
+from bisect import bisect_right
+from typing import Optional, List, Dict
+
+from gcode_motion import WORD_RE, COMMENT_RE
+from send_plan import SendPlan, TRAILER, resume_path, read_header, \
+    padded_lines
+
+RESUME_VERSION = 1
+RESUME_MAGIC = b"MATRESU1"
+FILE_LINE = struct.Struct("<I")    # file_lines() entry
+CHECKPOINT_LINES = 1000     # Plan lines between saved states
+
+AXES = "XYZ"
+LOST_G_CODES = (10, 52, 65, 66, 92)     # Coordinate changes, macro calls
+LOST_M_CODES = (97, 98, 99)             # Subprogram calls and jumps
+HOME_G_CODES = (28, 30, 53)             # Moves we can't follow
+CANNED_G_CODES = (73, 74, 76, 81, 82, 83, 84, 85, 86, 87, 88, 89)
+MACRO_RE = re.compile(r'[#\[]')
+TOOL_CHANGE_RE = re.compile(r'M0*6(?![0-9])')
+
+
+class ResumeError(ValueError):
+    """ The program can't be restarted there. """
+
+
+class ModalState:
+    """ The state the machine is in before a line, as far as a restart
+        has to put it back.  None is not known.
+    """
+    def __init__(self):
+        self.units: Optional[int] = None        # 20 or 21
+        self.plane = 17
+        self.absolute = True
+        self.work_offset: Optional[int] = None  # 54 to 59
+        self.inverse_time = False               # G93
+        self.comp = 40                          # 40, 41 or 42
+        self.canned = False
+        self.length: Optional[int] = None       # 43, 44 or 49
+        self.h: Optional[int] = None
+        self.tool: Optional[int] = None         # In the spindle
+        self.selected: Optional[int] = None     # Last T
+        self.spindle: Optional[int] = None      # 3, 4 or 5
+        self.speed: Optional[float] = None
+        self.coolant: List[int] = []            # 7 and or 8
+        self.motion = 0
+        self.feed = 0.0
+        self.position: Dict[str, Optional[float]] = {a: None for a in AXES}
+        self.clearance: Optional[float] = None  # Highest Z since M6
+        self.lost = False
+        # What the last line did.
+        self.tool_changed = False
+        self.retracted = False
+
+    def snapshot(self) -> dict:
+        """ The state as a json friendly dict, see from_snapshot(). """
+        state = dict(vars(self))
+        state["position"] = dict(self.position)
+        state["coolant"] = list(self.coolant)
+        del state["tool_changed"], state["retracted"]
+        return state
+
+    @classmethod
+    def from_snapshot(cls, state: dict) -> "ModalState":
+        modal = cls()
+        for name, value in state.items():
+            setattr(modal, name, value)
+        modal.position = dict(modal.position)
+        modal.coolant = list(modal.coolant)
+        return modal
+
+    def line(self, text: str) -> None:
+        """ Carry the state through one line as it is sent. """
+        self.tool_changed = False
+        self.retracted = False
+        if self.lost:
+            return
+        if "(" in text:
+            text = COMMENT_RE.sub('', text)
+        if MACRO_RE.search(text):
+            self.lost = True
+            return
+
+        targets = {}
+        g_codes = []
+        for letter, number_text in WORD_RE.findall(text.upper()):
+            try:
+                value = float(number_text)
+            except ValueError:
+                continue
+            if letter in AXES:
+                targets[letter] = value
+            elif letter == 'G':
+                g_codes.append(value)
+            elif letter == 'M':
+                self.m_code(value)
+            elif letter == 'F':
+                self.feed = value
+            elif letter == 'S':
+                self.speed = value
+            elif letter == 'T':
+                self.selected = int(value)
+            elif letter == 'H':
+                self.h = int(value)
+
+        moves = bool(targets)
+        home = False
+        for g in g_codes:
+            code = int(g)
+            if g != code:
+                continue
+            if code in (0, 1, 2, 3):
+                self.motion = code
+            elif code == 4:
+                moves = False   # Dwell, X is the time
+            elif code in (17, 18, 19):
+                self.plane = code
+            elif code in (20, 21):
+                self.units = code
+            elif code in (40, 41, 42):
+                self.comp = code
+            elif code in (43, 44, 49):
+                self.length = code
+            elif 54 <= code <= 59:
+                self.work_offset = code
+            elif code == 80:
+                self.canned = False
+            elif code in CANNED_G_CODES:
+                self.canned = True
+            elif code == 90:
+                self.absolute = True
+            elif code == 91:
+                self.absolute = False
+            elif code == 93:
+                self.inverse_time = True
+            elif code == 94:
+                self.inverse_time = False
+            elif code in HOME_G_CODES:
+                home = True
+            elif code in LOST_G_CODES:
+                self.lost = True
+                return
+
+        if moves:
+            self.move(targets, home)
+
+    def m_code(self, value: float) -> None:
+        code = int(value)
+        if value != code:
+            return
+        if code in (3, 4, 5):
+            self.spindle = code
+        elif code == 6:
+            self.tool = self.selected
+            self.clearance = None
+            self.tool_changed = True
+        elif code in (7, 8):
+            if code not in self.coolant:
+                self.coolant.append(code)
+        elif code == 9:
+            self.coolant = []
+        elif code in LOST_M_CODES:
+            self.lost = True
+
+    def move(self, targets: Dict[str, float], home: bool) -> None:
+        z_before = self.position["Z"]
+        for axis, value in targets.items():
+            if home:
+                self.position[axis] = None
+            elif self.absolute:
+                self.position[axis] = value
+            elif self.position[axis] is not None:
+                self.position[axis] += value
+        if self.canned:
+            # Z is the bottom of the hole, it comes back up to R or the
+            # start.
+            self.position["Z"] = None
+        z = self.position["Z"]
+        if z is None or "Z" not in targets:
+            return
+        if self.clearance is None or z >= self.clearance:
+            self.retracted = (self.clearance is not None
+                              and self.motion == 0 and len(targets) == 1
+                              and z_before is not None and z > z_before)
+            self.clearance = z
+
+    def problem(self, kind: str) -> Optional[str]:
+        """ Why the machine can't be restarted from this state with a
+            kind ("tool", "retract" or "line") of preamble, or None.
+        """
+        if self.lost:
+            return "state not known after a macro, subprogram call" \
+                   " or coordinate change"
+        if self.comp != 40:
+            return "cutter compensation is on"
+        if self.canned:
+            return "in a canned cycle"
+        if kind == "tool":
+            return None
+        if self.motion not in (0, 1):
+            return "in the middle of G2/G3 moves"
+        if any(value is None for value in self.position.values()):
+            return "position not known"
+        if self.clearance is None:
+            return "no clearance height since the tool change"
+        if self.feed <= 0.0 and self.position["Z"] < self.clearance:
+            return "no feed rate to go back down"
+        return None
+
+    def preamble(self, kind: str) -> List[str]:
+        """ The lines to send before restarting from this state. """
+        modes = [f"G{self.plane}", "G40", "G49", "G80",
+                 "G93" if self.inverse_time else "G94", "G90"]
+        lines = []
+        if self.units is not None:
+            lines.append(f"G{self.units}")
+        lines.append(" ".join(modes))
+        if self.work_offset is not None:
+            lines.append(f"G{self.work_offset}")
+        if kind == "tool":
+            if self.selected is not None:
+                lines.append(f"T{self.selected}")
+            return lines
+
+        if self.tool is not None:
+            lines.append(f"T{self.tool} M6")
+        if self.spindle in (3, 4) and self.speed is not None:
+            lines.append(f"S{number(self.speed)} M{self.spindle}")
+        lines.extend(f"M{code}" for code in self.coolant)
+        x, y, z = (self.position[axis] for axis in AXES)
+        if self.length in (43, 44) and self.h is not None:
+            lines.append(f"G0 G{self.length} Z{number(self.clearance)}"
+                         f" H{self.h}")
+        else:
+            lines.append(f"G0 Z{number(self.clearance)}")
+        lines.append(f"X{number(x)} Y{number(y)}")
+        if z < self.clearance:
+            lines.append(f"G1 Z{number(z)} F{number(self.feed)}")
+        lines.append(f"G{self.motion} F{number(self.feed)}"
+                     if self.feed > 0.0 else f"G{self.motion}")
+        if not self.absolute:
+            lines.append("G91")
+        return lines
+
+
+class Resume:
+    """ Where to restart a send, and what to send first. """
+    def __init__(self, line: int, file_line: int, kind: str,
+                 preamble: List[str]):
+        self.line = line                # Plan line to send from
+        self.file_line = file_line      # Line in the file it came from
+        self.kind = kind                # "tool", "retract" or "line"
+        self.preamble = preamble        # Lines to send first
+
+    def preamble_lines(self) -> List[str]:
+        """ The preamble padded and with CR LF, ready to send. """
+        return list(padded_lines((0, line) for line in self.preamble))
+
+
+class ResumeIndex:
+    """ The restart points of a send plan, from the resume file.  Only
+        the header is read on load.
+    """
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.header = header
+
+    @property
+    def points(self) -> List[dict]:
+        """ {"line", "file_line", "kind", "tool", "state"} for each
+            restart-safe point, in order.
+        """
+        return self.header["points"]
+
+    @classmethod
+    def load(cls, source_file: str,
+             plan: SendPlan) -> Optional["ResumeIndex"]:
+        """ The resume index for plan, or None if there is none or it is
+            out of date.
+        """
+        path = resume_path(source_file)
+        try:
+            st = os.stat(source_file)
+            header = read_header(path, RESUME_MAGIC)
+        except (OSError, ValueError, struct.error):
+            return None
+        if (header is None
+                or header.get("version") != RESUME_VERSION
+                or header.get("source_size") != st.st_size
+                or header.get("source_mtime_ns") != st.st_mtime_ns
+                or header.get("plan_crc32") != plan.crc32_value
+                or header.get("lines") != plan.lines):
+            return None
+        return cls(path, header)
+
+    def file_lines(self) -> array:
+        """ Line in the file of every plan line ('I').
+            Raises OSError on error.
+        """
+        lines = array('I')
+        with open(self.path, 'rb') as fd:
+            lines.frombytes(fd.read(4 * self.header["lines"]))
+        if sys.byteorder != "little":
+            lines.byteswap()
+        return lines
+
+    def file_line(self, line: int) -> int:
+        """ Line in the file of plan line line, without reading the rest.
+            Raises OSError on error.
+        """
+        with open(self.path, 'rb') as fd:
+            fd.seek(FILE_LINE.size * line)
+            data = fd.read(FILE_LINE.size)
+        if len(data) != FILE_LINE.size:
+            raise OSError(f"{self.path}: no line {line}")
+        return FILE_LINE.unpack(data)[0]
+
+    def resume(self, plan: SendPlan, file_line: int,
+               safe: bool = True) -> Resume:
+        """ Where and how to restart plan at file_line.
+
+            If safe, from the last restart-safe point at or before it,
+            else from the plan line that has file_line in it.
+            Raises ResumeError if it can't, OSError on error.
+        """
+        if safe:
+            points = [p for p in self.points if p["file_line"] <= file_line]
+            if not points:
+                raise ResumeError(f"No restart-safe point at or before"
+                                  f" line {file_line}")
+            point = points[-1]
+            state = ModalState.from_snapshot(point["state"])
+            return Resume(point["line"], point["file_line"], point["kind"],
+                          state.preamble(point["kind"]))
+
+        file_lines = self.file_lines()
+        line = bisect_right(file_lines, file_line, 1, last_line(file_lines))
+        line -= 1
+        if line < 1:
+            raise ResumeError(f"Line {file_line} is before the program")
+        for point in self.points:
+            if point["line"] == line and point["kind"] == "tool":
+                state = ModalState.from_snapshot(point["state"])
+                return Resume(line, file_lines[line], "tool",
+                              state.preamble("tool"))
+        state = self.state_before(plan, line)
+        problem = state.problem("line")
+        if problem is not None:
+            raise ResumeError(f"Can't restart at line {file_lines[line]},"
+                              f" {problem}")
+        return Resume(line, file_lines[line], "line", state.preamble("line"))
+
+    def state_before(self, plan: SendPlan, line: int) -> ModalState:
+        """ The state before plan line, from the checkpoint before it. """
+        checkpoints = self.header["checkpoints"]
+        starts = [start for start, _ in checkpoints]
+        start, snapshot = checkpoints[bisect_right(starts, line) - 1]
+        state = ModalState.from_snapshot(snapshot)
+        lines = plan.open_lines(start)
+        try:
+            for _ in range(line - start):
+                state.line(next(lines))
+        finally:
+            lines.close()
+        return state
+
+
+def last_line(file_lines: array) -> int:
+    """ One past the last plan line that starts a line in the file. """
+    end = len(file_lines)
+    while end > 1 and file_lines[end - 1] == 0:
+        end -= 1
+    return end
+
+
+def number(value: float) -> str:
+    """ value with a point, so the Yasnac doesn't read it as steps. """
+    text = f"{value:.4f}".rstrip("0")
+    return "0." if text in ("-0.", "0.") else text
+
+
+def find_points(plan: SendPlan, file_lines: array) -> dict:
+    """ Run plan through ModalState.  Returns the header fields of the
+        resume index: points, checkpoints and summary.
+    """
+    state = ModalState()
+    plan_lines = plan.lines
+    points = []
+    checkpoints = []
+    tool_changes = retracts = 0
+    lines = plan.open_lines()
+    try:
+        for line, text in enumerate(lines):
+            if line % CHECKPOINT_LINES == 0:
+                checkpoints.append([line, state.snapshot()])
+            before = state.snapshot() if TOOL_CHANGE_RE.search(text) else None
+            state.line(text)
+            if before is not None and state.tool_changed and \
+                    ModalState.from_snapshot(before).problem("tool") is None:
+                before["selected"] = state.tool     # The tool it loads
+                points.append({"line": line, "file_line": file_lines[line],
+                               "kind": "tool", "tool": state.tool,
+                               "state": before})
+                tool_changes += 1
+            if state.retracted and line + 1 < plan_lines and \
+                    state.problem("retract") is None:
+                points.append({"line": line + 1,
+                               "file_line": file_lines[line + 1],
+                               "kind": "retract", "tool": state.tool,
+                               "state": state.snapshot()})
+                retracts += 1
+    finally:
+        lines.close()
+    return {"points": points, "checkpoints": checkpoints,
+            "summary": {"tool_changes": tool_changes, "retracts": retracts}}
+
+
+def save_resume_index(source_file: str, st: os.stat_result, plan: SendPlan,
+                      file_lines: array) -> dict:
+    """ Find the restart points of plan and write the resume index for
+        source_file.  Returns its summary, how many of each kind.
+
+        st is the stat of the file the plan was made from.  file_lines
+        ('I') has the line in the file of each plan line.
+
+        Raises OSError on error.
+    """
+    path = resume_path(source_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    header = {
+        "version": RESUME_VERSION,
+        "source_size": st.st_size,
+        "source_mtime_ns": st.st_mtime_ns,
+        "plan_crc32": plan.crc32_value,
+        "lines": plan.lines,
+    }
+    header.update(find_points(plan, file_lines))
+    fd_out, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        suffix=".tmp")
+    try:
+        with open(fd_out, 'wb') as out:
+            if sys.byteorder != "little":
+                file_lines = array('I', file_lines)
+                file_lines.byteswap()
+            out.write(file_lines.tobytes())
+            header_bytes = json.dumps(header).encode("utf-8")
+            out.write(header_bytes)
+            out.write(TRAILER.pack(len(header_bytes), RESUME_MAGIC))
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return header["summary"]
+
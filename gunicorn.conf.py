@@ -0,0 +1,43 @@
+"""
+
+gunicorn.conf.py - how gunicorn runs the web app on the Pi
+
+    gunicorn3 -c gunicorn.conf.py app:flask_app
+
+The app is imported once, in the master, before the workers are forked
+(preload_app), so Flask, numpy and the rest are loaded once and their
+pages shared by all the workers instead of each worker loading its own
+copy.  That also means a new worker is ready at once.
+
+Workers and threads can be set in .env:
+
+    WEB_WORKERS   worker processes, 2 by default
+    WEB_THREADS   threads per worker, 8 by default.  Each open send page
+                  holds one for its /events stream.
+    WEB_PRELOAD   0 to import the app in each worker instead
+    WEB_BIND      address to listen on, 0.0.0.0:80 by default
+
+See web_footprint.py to measure the import time and memory.
+
+"""
+
+import os
+import sys
+
+import dotenv
+
+dotenv.load_dotenv()    # WEB_* may be in .env
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread'
+preload_app = os.environ.get('WEB_PRELOAD', '1') != '0'
+
+
+def post_fork(server, worker):
+    # Threads don't survive the fork, start this worker's upload watcher
+    # now rather than on its first request.
+    app = sys.modules.get('app')
+    if app is not None:
+        app.watcher.start()
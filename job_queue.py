@@ -0,0 +1,114 @@
+"""
+
+job_queue.py - the serial sender's queue of files waiting to be sent
+
+Each machine (see Machine in serial_sender.py) has its own queue of files
+to send, in order.  Jobs can be added, moved, cancelled and listed, and a
+job added with auto set is started by the sender as soon as the send
+before it has finished without error, so a batch of programs can be loaded
+one after another without anyone at the kiosk pressing START each time.
+
+The queue is kept in a small sqlite database in UPLOAD_PATH so it survives
+restarts of the sender.  Only the sender uses it, from its one thread.
+
+"""
+
+import os
+import sqlite3
+import time
+from typing import Optional, List
+
+QUEUE_FILE_NAME = ".queue.sqlite"   # Hidden file in UPLOAD_PATH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    machine     TEXT NOT NULL,
+    file        TEXT NOT NULL,
+    auto        INTEGER NOT NULL,
+    seq         INTEGER NOT NULL,
+    added       REAL NOT NULL
+)
+"""
+
+
+class JobQueue:
+    """ Queues of files to send, one per machine, kept on disk. """
+    def __init__(self, upload_path: str):
+        self.db_file = os.path.join(upload_path, QUEUE_FILE_NAME)
+        self.db = sqlite3.connect(self.db_file, timeout=10.0)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def jobs(self, machine: str) -> List[dict]:
+        """ The jobs queued for machine, next to be sent first. """
+        rows = self.db.execute(
+            "SELECT id, machine, file, auto, added FROM jobs"
+            " WHERE machine = ? ORDER BY seq, id", (machine,))
+        return [job_dict(row) for row in rows]
+
+    def depth(self, machine: str) -> int:
+        """ How many jobs are queued for machine. """
+        return self.db.execute("SELECT count(*) FROM jobs WHERE machine = ?",
+                               (machine,)).fetchone()[0]
+
+    def next_job(self, machine: str) -> Optional[dict]:
+        """ The job to send next on machine, or None. """
+        row = self.db.execute(
+            "SELECT id, machine, file, auto, added FROM jobs"
+            " WHERE machine = ? ORDER BY seq, id LIMIT 1",
+            (machine,)).fetchone()
+        return None if row is None else job_dict(row)
+
+    def get(self, job_id: int) -> Optional[dict]:
+        row = self.db.execute(
+            "SELECT id, machine, file, auto, added FROM jobs WHERE id = ?",
+            (job_id,)).fetchone()
+        return None if row is None else job_dict(row)
+
+    def add(self, machine: str, file_name: str, auto: bool) -> dict:
+        """ Add a job to the end of machine's queue and return it. """
+        with self.db:
+            seq = self.db.execute(
+                "SELECT coalesce(max(seq) + 1, 0) FROM jobs WHERE machine = ?",
+                (machine,)).fetchone()[0]
+            cursor = self.db.execute(
+                "INSERT INTO jobs (machine, file, auto, seq, added)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (machine, file_name, int(bool(auto)), seq, time.time()))
+        return self.get(cursor.lastrowid)
+
+    def remove(self, job_id: int) -> Optional[dict]:
+        """ Take a job out of its queue.  Returns it, or None if there
+            was no such job.
+        """
+        job = self.get(job_id)
+        if job is not None:
+            with self.db:
+                self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return job
+
+    def move(self, job_id: int, position: int) -> Optional[dict]:
+        """ Move a job to position (0 is next) in its machine's queue.
+            Positions past the end move it to the end.  Returns the job,
+            or None if there was no such job.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        ids = [other["job"] for other in self.jobs(job["machine"])
+               if other["job"] != job_id]
+        ids.insert(max(0, min(position, len(ids))), job_id)
+        with self.db:
+            self.db.executemany("UPDATE jobs SET seq = ? WHERE id = ?",
+                                enumerate(ids))
+        return job
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def job_dict(row: sqlite3.Row) -> dict:
+    """ A job as json friendly dict. """
+    return {"job": row["id"], "machine": row["machine"], "file": row["file"],
+            "auto": bool(row["auto"]), "added": row["added"]}
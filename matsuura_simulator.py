@@ -0,0 +1,406 @@
+"""
+
+matsuura_simulator.py - software stand in for the Matsuura/Yasnac
+
+Lets us run and tune serial_sender.py on any Linux box with no mill, no
+USB dongles and no null modem cable.  Creates a pseudo-terminal pair, links
+the sender's end of it to a name like /tmp/matsuura_sim, and acts like the
+Yasnac on the other end.
+
+    python3 matsuura_simulator.py --link /tmp/matsuura_sim --mode tape
+    SERIAL_SIMULATOR=1 SERIAL_PORT_NAME=/tmp/matsuura_sim python3 serial_sender.py
+
+What it models:
+
+    The wire.  A pty moves data instantly, so the simulator only takes
+    characters off the pty at 960 per second (9600 baud).  What the sender
+    has written but the "wire" has not delivered yet is reported to the
+    sender as out_waiting, and RTS is reported to it as CTS, through the
+    small shared file described in pty_lines.py.
+
+    The Yasnac input buffer.  Characters go into a buffer of --buffer-size
+    characters.  RTS is turned off when the buffer is within --rts-margin of
+    full and back on when it has drained to half full.
+
+    The overrun alarm.  The sender's UART finishes up to --late-chars
+    characters after RTS drops.  More than --overrun-limit (10) characters
+    received after RTS drops, or a full buffer, is an RS-232 overrun alarm.
+
+    Memory load vs TAPE drip feed.  In memory mode every block is stored
+    as soon as it arrives.  In tape mode blocks are run one at a time, each
+    taking the time worked out by gcode_motion.py from the feed and distance,
+    or a fixed --block-time.  M30 or M02 stops the machine reading until
+    --reset-time seconds later, like the real thing, which is why the
+    sender puts the % on the end of the last line.
+
+Every program ends with a summary of characters, blocks, run time, time the
+machine sat waiting for data, time RTS was on with no data coming, and the
+most characters received after RTS dropped.  The same numbers are kept in MachineSimulator.results for
+serial_benchmark.py.
+
+"""
+
+import os
+import sys
+import time
+import fcntl
+import termios
+import argparse
+import threading
+import tty
+from typing import Optional, List
+from zlib import crc32
+
+import gcode_motion
+from pty_lines import PtyLines, LINES_SUFFIX
+
+CHARS_PER_SEC = 9600 / 10   # 1 start, 8 data, 1 stop bit per char
+
+DEFAULT_LINK = "/tmp/matsuura_sim"
+DEFAULT_BUFFER_SIZE = 256   # Chars
+DEFAULT_RTS_MARGIN = 32     # Turn RTS off this close to a full buffer
+DEFAULT_LATE_CHARS = 2      # Chars the sender's UART finishes after RTS off
+DEFAULT_OVERRUN_LIMIT = 10  # Yasnac alarms past this many late chars
+DEFAULT_RESET_TIME = 2.0    # Seconds after M30 until we read again
+TICK = 0.001                # Seconds per simulation step
+MAX_CREDIT = 50.0           # Most chars delivered in one late step
+
+MODES = ("tape", "memory")
+END_CODES = (2.0, 30.0)     # M02, M30
+
+
+def log(message: str):
+    """ The simulator always logs to stderr, never to the sender's syslog. """
+    now = time.time()
+    stamp = time.strftime("%H:%M:%S", time.localtime(now))
+    print(f"{stamp}.{int(now % 1 * 1000):03d} sim: {message}",
+          file=sys.stderr, flush=True)
+
+
+class MachineSimulator:
+    """ Simulated Yasnac on the far end of a pty. """
+    def __init__(self, link: str = DEFAULT_LINK, mode: str = "tape",
+                 buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 rts_margin: int = DEFAULT_RTS_MARGIN,
+                 late_chars: int = DEFAULT_LATE_CHARS,
+                 overrun_limit: int = DEFAULT_OVERRUN_LIMIT,
+                 block_time: Optional[float] = None,
+                 rapid_rate: float = gcode_motion.DEFAULT_RAPID_RATE,
+                 min_block_time: float = gcode_motion.DEFAULT_MIN_BLOCK_TIME,
+                 reset_time: float = DEFAULT_RESET_TIME):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        self.link = link
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.rts_high = max(1, buffer_size - rts_margin)
+        self.rts_low = buffer_size // 2
+        self.late_chars = late_chars
+        self.overrun_limit = overrun_limit
+        self.block_time = block_time
+        self.rapid_rate = rapid_rate
+        self.min_block_time = min_block_time
+        self.reset_time = reset_time
+
+        self.master_fd: Optional[int] = None
+        self.slave_fd: Optional[int] = None
+        self.lines: Optional[PtyLines] = None
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+        self.results: List[dict] = []   # Summary of each program received
+        self.reset()
+
+    def reset(self):
+        """ Get ready for a new program. """
+        self.rts = True
+        self.buffer = bytearray()
+        self.credit = 0.0           # Chars the wire can deliver now
+        self.late_budget = 0        # Chars the UART may still finish
+        self.late_count = 0         # Chars received since RTS dropped
+        self.busy_until = 0.0       # Tape mode, current block done
+        self.halted_until = 0.0     # After M30, not reading until then
+        self.motion = gcode_motion.MotionState(self.rapid_rate,
+                                               self.min_block_time)
+        self.program = None         # Stats for the program being received
+
+    def new_program(self, now: float) -> dict:
+        return {"mode": self.mode, "start": now, "first_char": None,
+                "end": None, "chars": 0, "blocks": 0, "crc32": 0,
+                "machine_time": 0.0, "starved_time": 0.0, "rts_drops": 0,
+                "rts_idle_time": 0.0, "max_backlog": 0,
+                "max_late_chars": 0, "overrun_alarms": 0,
+                "saw_percent": False, "stranded_by_end": False}
+
+    # ------------------------------------------------------------------
+    # Set up and tear down
+
+    def open(self):
+        """ Make the pty pair and the link and control lines files. """
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        fcntl.fcntl(self.master_fd, fcntl.F_SETFL,
+                    fcntl.fcntl(self.master_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        slave_name = os.ttyname(self.slave_fd)
+        self.remove_link()
+        os.symlink(slave_name, self.link)
+        self.lines = PtyLines(self.link + LINES_SUFFIX, create=True)
+        self.lines.update(True, 0)
+        log(f"Simulator on {slave_name}, use SERIAL_SIMULATOR=1"
+            f" SERIAL_PORT_NAME={self.link}"
+            f" ({self.mode} mode, {self.buffer_size} char buffer)")
+
+    def close(self):
+        if self.lines is not None:
+            self.lines.close()
+            self.lines = None
+        self.remove_link()
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+    def remove_link(self):
+        for path in (self.link, self.link + LINES_SUFFIX):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def start(self):
+        """ Open and run in a background thread. """
+        self.open()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.close()
+
+    # ------------------------------------------------------------------
+    # Simulation
+
+    def run(self):
+        """ Simulate until stop() is called. """
+        last = time.monotonic()
+        while not self.stop_event.wait(TICK):
+            now = time.monotonic()
+            self.step(now, now - last)
+            last = now
+
+    def waiting(self) -> int:
+        """ Chars written to the pty the wire has not delivered. """
+        buf = bytearray(4)
+        fcntl.ioctl(self.master_fd, termios.FIONREAD, buf)
+        return int.from_bytes(buf, sys.byteorder)
+
+    def step(self, now: float, dt: float):
+        waiting = self.waiting()
+
+        # The wire.  Deliver chars at the baud rate, and only a few once
+        # RTS is off.
+        if waiting == 0 or (not self.rts and self.late_budget <= 0):
+            # Wire is idle, it can't save up time to send faster later.
+            self.credit = min(self.credit, 1.0)
+        else:
+            self.credit = min(self.credit + dt * CHARS_PER_SEC, MAX_CREDIT)
+        n = min(int(self.credit), waiting)
+        if not self.rts:
+            n = min(n, self.late_budget)
+        data = b""
+        if n > 0:
+            try:
+                data = os.read(self.master_fd, n)
+            except BlockingIOError:
+                data = b""
+            self.credit -= len(data)
+            if not self.rts:
+                self.late_budget -= len(data)
+
+        if data:
+            self.receive(data, now)
+        self.line_stats(waiting - len(data), dt)
+
+        self.run_blocks(now, dt)
+        self.update_rts(now)
+        self.lines.update(self.rts, max(0, waiting - len(data)))
+
+    def line_stats(self, waiting: int, dt: float):
+        """ Time RTS was on with nothing coming in, and the most chars
+            left waiting while RTS was off.
+        """
+        p = self.program
+        if p is None or p["end"] is not None:
+            return
+        if self.rts and waiting == 0:
+            p["rts_idle_time"] += dt
+        elif not self.rts:
+            p["max_backlog"] = max(p["max_backlog"], waiting)
+
+    def receive(self, data: bytes, now: float):
+        if self.program is None:
+            self.program = self.new_program(now)
+        p = self.program
+        if p["first_char"] is None:
+            p["first_char"] = now
+        p["chars"] += len(data)
+        p["crc32"] = crc32(data, p["crc32"])
+
+        if not self.rts:
+            self.late_count += len(data)
+            p["max_late_chars"] = max(p["max_late_chars"], self.late_count)
+            if self.late_count > self.overrun_limit:
+                self.alarm(f"{self.late_count} chars received after RTS off")
+
+        self.buffer += data
+        if len(self.buffer) > self.buffer_size:
+            self.alarm(f"input buffer overflow, {len(self.buffer)} chars")
+            del self.buffer[self.buffer_size:]
+
+    def alarm(self, why: str):
+        p = self.program
+        p["overrun_alarms"] += 1
+        log(f"ALARM: RS-232 overrun: {why}")
+
+    def run_blocks(self, now: float, dt: float):
+        """ Store or execute blocks from the input buffer. """
+        p = self.program
+        if p is None or p["end"] is not None:
+            if self.halted_until and now > self.halted_until:
+                log("Reset, ready for the next program")
+                self.reset()
+            return
+
+        while True:
+            if self.mode == "tape" and now < self.busy_until:
+                return      # Still running the last block
+            block = self.next_block()
+            if block is None:
+                if self.mode == "tape" and p["blocks"] and now >= self.busy_until:
+                    # Machine idle waiting on data.  Dwell marks!
+                    p["starved_time"] += dt
+                return
+            if block.startswith("%"):
+                p["saw_percent"] = True
+                self.end_program(now)
+                return
+            p["blocks"] += 1
+            if self.block_time is not None:
+                seconds = self.block_time
+            else:
+                _, seconds = self.motion.block(block)
+            p["machine_time"] += seconds
+            if self.mode == "tape":
+                self.busy_until = max(now, self.busy_until) + seconds
+                if is_program_end(block):
+                    # Stops reading.  If the % is not read yet, it never
+                    # will be.
+                    p["saw_percent"] = b"%" in self.buffer
+                    p["stranded_by_end"] = not p["saw_percent"]
+                    self.end_program(self.busy_until)
+                    return
+
+    def next_block(self) -> Optional[str]:
+        """ Pop the next complete block from the buffer, skipping leader
+            and blank lines.  A % counts as a complete block.
+        """
+        while True:
+            stripped = self.buffer.lstrip(b"\r\n ")
+            if len(stripped) != len(self.buffer):
+                del self.buffer[:len(self.buffer) - len(stripped)]
+            if self.buffer.startswith(b"%"):
+                del self.buffer[:1]
+                return "%"
+            end = self.buffer.find(b"\n")
+            if end < 0:
+                return None
+            block = bytes(self.buffer[:end]).decode("utf-8", errors="replace")
+            del self.buffer[:end + 1]
+            block = block.strip()
+            if block:
+                return block
+
+    def end_program(self, now: float):
+        p = self.program
+        p["end"] = now
+        elapsed = now - p["start"]
+        cps = p["chars"] / elapsed if elapsed > 0 else 0.0
+        log(f"END OF PROGRAM ({self.mode}): {p['chars']} chars,"
+            f" {p['blocks']} blocks, {elapsed:.2f} s, {cps:.0f} chars/sec,"
+            f" starved {p['starved_time']:.2f} s,"
+            f" RTS on idle {p['rts_idle_time']:.2f} s,"
+            f" max late chars {p['max_late_chars']},"
+            f" alarms {p['overrun_alarms']}, crc: {p['crc32']:08X}")
+        if p["stranded_by_end"]:
+            log("M30 ran before the % was read, sender will wait forever")
+        self.results.append(p)
+        if self.mode == "tape" and not p["saw_percent"]:
+            self.halted_until = now + self.reset_time
+            self.rts = False
+        else:
+            self.reset()
+
+    def update_rts(self, now: float):
+        if self.halted_until:
+            return      # Not reading at all
+        if self.rts and len(self.buffer) >= self.rts_high:
+            self.rts = False
+            self.late_budget = self.late_chars
+            self.late_count = 0
+            if self.program is not None:
+                self.program["rts_drops"] += 1
+        elif not self.rts and len(self.buffer) <= self.rts_low:
+            self.rts = True
+
+
+def is_program_end(block: str) -> bool:
+    """ True if block has an M02 or M30. """
+    return any(letter == 'M' and value in END_CODES
+               for letter, value in gcode_motion.parse_words(block))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--link", default=DEFAULT_LINK,
+                        help="name to give the sender's end of the pty")
+    parser.add_argument("--mode", choices=MODES, default="tape")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE)
+    parser.add_argument("--rts-margin", type=int, default=DEFAULT_RTS_MARGIN)
+    parser.add_argument("--late-chars", type=int, default=DEFAULT_LATE_CHARS)
+    parser.add_argument("--overrun-limit", type=int,
+                        default=DEFAULT_OVERRUN_LIMIT)
+    parser.add_argument("--block-time", type=float, default=None,
+                        help="fixed seconds per block instead of feed/distance")
+    parser.add_argument("--rapid-rate", type=float,
+                        default=gcode_motion.DEFAULT_RAPID_RATE)
+    parser.add_argument("--min-block-time", type=float,
+                        default=gcode_motion.DEFAULT_MIN_BLOCK_TIME)
+    parser.add_argument("--reset-time", type=float, default=DEFAULT_RESET_TIME)
+    args = parser.parse_args()
+
+    sim = MachineSimulator(link=args.link, mode=args.mode,
+                           buffer_size=args.buffer_size,
+                           rts_margin=args.rts_margin,
+                           late_chars=args.late_chars,
+                           overrun_limit=args.overrun_limit,
+                           block_time=args.block_time,
+                           rapid_rate=args.rapid_rate,
+                           min_block_time=args.min_block_time,
+                           reset_time=args.reset_time)
+    sim.open()
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        log("KeyboardInterrupt")
+    finally:
+        sim.close()
+
+
+if __name__ == '__main__':
+    main()
+    exit(0)
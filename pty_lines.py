@@ -0,0 +1,55 @@
+"""
+
+pty_lines.py - RS-232 control lines for a pseudo-terminal
+
+A pty has no RTS/CTS wires and no real output buffer, so a simulated
+machine on the other end of a pty (see matsuura_simulator.py) can't tell
+the sender to stop, and the sender can't see what is waiting to go out.
+The simulator fills that gap with a tiny shared file next to the port
+name, e.g. /tmp/matsuura_sim.lines for the port /tmp/matsuura_sim.
+
+It holds the CTS line as the sender sees it, and the number of characters
+written to the pty that the simulated wire has not yet delivered, which
+stands in for out_waiting.  SimulatedSerialPort in serial_sender.py reads
+it; the sender only uses that when SERIAL_SIMULATOR is 1, so a real port
+never looks for the file.
+
+"""
+
+import os
+import mmap
+import struct
+
+LINES_SUFFIX = ".lines"
+LINES_FORMAT = struct.Struct("<BxxxI")  # cts, out_waiting
+
+
+class PtyLines:
+    """ Shared CTS and out_waiting for one simulated serial port. """
+    def __init__(self, path: str, create: bool = False):
+        self.path = path
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        fd = os.open(path, flags, 0o644)
+        try:
+            if create:
+                os.ftruncate(fd, LINES_FORMAT.size)
+            self.map = mmap.mmap(fd, LINES_FORMAT.size)
+        finally:
+            os.close(fd)
+
+    def _get(self):
+        return LINES_FORMAT.unpack(self.map[:LINES_FORMAT.size])
+
+    @property
+    def cts(self) -> bool:
+        return bool(self._get()[0])
+
+    @property
+    def out_waiting(self) -> int:
+        return self._get()[1]
+
+    def update(self, cts: bool, out_waiting: int):
+        self.map[:LINES_FORMAT.size] = LINES_FORMAT.pack(int(cts), out_waiting)
+
+    def close(self):
+        self.map.close()
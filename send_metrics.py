@@ -0,0 +1,207 @@
+"""
+
+send_metrics.py - counters and histograms for the serial sender
+
+The status line says how far along a send is, but not why it is going as
+fast or as slow as it is.  The serial sender keeps these numbers, from the
+time it started, so we can tell whether a slow job is held up by the
+Matsuura (CTS off), by the 9600 baud line (chars waiting to go out), or by
+our own pacing (CTS on, nothing waiting, and we are not writing).
+
+Ask the sender for them with {"cmd": "metrics"}, each machine keeps its
+own.  The web app serves them at /metrics in the Prometheus text format,
+with a machine label.
+
+Only plain numbers are kept, nothing about what is being sent, so they are
+cheap to update on every serial write.
+
+"""
+
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence
+
+METRIC_PREFIX = "matsuura_sender_"
+
+WRITE_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)               # Chars
+OUT_WAITING_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)           # Chars
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+GAP_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)  # Seconds
+LATENESS_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+
+class Counter:
+    """ A number that only goes up. """
+    kind = "counter"
+
+    def __init__(self, help_text: str):
+        self.help = help_text
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def snapshot(self) -> dict:
+        return {"type": self.kind, "help": self.help, "value": self.value}
+
+
+class Histogram:
+    """ Counts of values at or below each bucket bound, plus the total
+        count and sum of everything seen.
+    """
+    kind = "histogram"
+
+    def __init__(self, help_text: str, bounds: Sequence[float]):
+        self.help = help_text
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # Last is over the top
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> dict:
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets.append([bound, total])
+        return {"type": self.kind, "help": self.help, "buckets": buckets,
+                "count": self.count, "sum": self.sum}
+
+
+class SendMetrics:
+    """ Everything the serial sender measures about the serial line. """
+    def __init__(self):
+        self.bytes_written = Counter(
+            "Chars written to the serial port")
+        self.writes = Counter(
+            "Writes to the serial port")
+        self.files_started = Counter(
+            "Files started")
+        self.files_sent = Counter(
+            "Files sent to the end")
+        self.cts_off_seconds = Counter(
+            "Seconds CTS was off while sending, machine not taking data")
+        self.link_busy_seconds = Counter(
+            "Seconds CTS was on with chars waiting to go out, line limited")
+        self.ready_idle_seconds = Counter(
+            "Seconds CTS was on and nothing was waiting, pacing limited")
+        self.write_size = Histogram(
+            "Chars per serial port write", WRITE_SIZE_BUCKETS)
+        self.cts_off_wait = Histogram(
+            "Seconds CTS stayed off each time it dropped while sending",
+            WAIT_BUCKETS)
+        self.out_waiting = Histogram(
+            "Chars waiting to go out each time the port is checked",
+            OUT_WAITING_BUCKETS)
+        self.write_gap = Histogram(
+            "Seconds between serial port writes while sending",
+            GAP_BUCKETS)
+        self.loop_lateness = Histogram(
+            "Seconds the serial loop woke up after the port was due a check",
+            LATENESS_BUCKETS)
+
+        self.last_check: Optional[float] = None     # Time of last observe()
+        self.last_state: Optional[str] = None       # What we saw then
+        self.cts_off_since: Optional[float] = None
+        self.last_write: Optional[float] = None
+
+    def started(self):
+        """ A new file is starting. """
+        self.files_started.inc()
+        self.last_check = None
+        self.last_state = None
+        self.cts_off_since = None
+        self.last_write = None
+
+    def finished(self):
+        self.files_sent.inc()
+
+    def observe(self, cts: bool, out_waiting: int, now: float):
+        """ Called each time the port is checked while sending.
+
+            The time since the last check is put down to whatever was
+            holding us up at the last check.
+        """
+        self.out_waiting.observe(out_waiting)
+        if self.last_check is not None:
+            elapsed = now - self.last_check
+            if self.last_state == "cts_off":
+                self.cts_off_seconds.inc(elapsed)
+            elif self.last_state == "link_busy":
+                self.link_busy_seconds.inc(elapsed)
+            else:
+                self.ready_idle_seconds.inc(elapsed)
+        self.last_check = now
+
+        if not cts:
+            self.last_state = "cts_off"
+            if self.cts_off_since is None:
+                self.cts_off_since = now
+        else:
+            self.last_state = "link_busy" if out_waiting else "ready"
+            if self.cts_off_since is not None:
+                self.cts_off_wait.observe(now - self.cts_off_since)
+                self.cts_off_since = None
+
+    def wrote(self, bytes_sent: int, now: float, busy_until: float):
+        """ Called after each write.  The line is busy until busy_until,
+            the time the flow control policy gave to check again.
+        """
+        self.writes.inc()
+        self.bytes_written.inc(bytes_sent)
+        self.write_size.observe(bytes_sent)
+        if self.last_write is not None:
+            self.write_gap.observe(now - self.last_write)
+        self.last_write = now
+        if busy_until > now:
+            self.last_state = "link_busy"
+
+    def loop_woke(self, due: float, now: float):
+        """ The serial loop got to the port at now, it was due at due. """
+        self.loop_lateness.observe(max(0.0, now - due))
+
+    def snapshot(self) -> Dict[str, dict]:
+        """ All metrics as a json friendly dict, keyed by full name. """
+        metrics = {}
+        for name, metric in vars(self).items():
+            if isinstance(metric, (Counter, Histogram)):
+                metrics[METRIC_PREFIX + name] = metric.snapshot()
+        return metrics
+
+
+def prometheus_text(machines: Dict[str, Dict[str, dict]]) -> str:
+    """ Format SendMetrics snapshots in the Prometheus text format.
+
+        machines maps each machine name to its snapshot, which becomes
+        the machine label of its samples.
+    """
+    names: Dict[str, dict] = {}     # One of each metric, for HELP and TYPE
+    for metrics in machines.values():
+        for name, metric in metrics.items():
+            names.setdefault(name, metric)
+    lines: List[str] = []
+    for key, first in sorted(names.items()):
+        kind = first.get("type")
+        name = key + "_total" if kind == "counter" else key
+        lines.append(f"# HELP {name} {first.get('help', '')}")
+        lines.append(f"# TYPE {name} {kind}")
+        for machine, metrics in machines.items():
+            metric = metrics.get(key)
+            if metric is None or metric.get("type") != kind:
+                continue
+            label = f'machine="{machine}"'
+            if kind == "counter":
+                lines.append(f"{name}{{{label}}} {metric['value']}")
+            elif kind == "histogram":
+                for bound, count in metric["buckets"]:
+                    lines.append(f'{name}_bucket{{{label},le="{bound:g}"}}'
+                                 f' {count}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}}'
+                             f' {metric["count"]}')
+                lines.append(f"{name}_sum{{{label}}} {metric['sum']}")
+                lines.append(f"{name}_count{{{label}}} {metric['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,830 @@
+"""
+
+send_plan.py - G-code clean up and precompiled send plans
+
+The clean up the Matsuura needs (see FileToSend in serial_sender.py) is done
+here as a pipeline of generators so both the web app and the serial sender
+use the same rules.
+
+A send plan is the result of running a file through that pipeline once,
+at upload time, and saving it next to the upload in UPLOAD_PATH/.plans so
+the serial sender can start sending instantly instead of reading and
+cleaning up the whole file again.  An upload that is a link to a blob (see
+upload_store.py) has its plan next to the blob, in UPLOAD_PATH/.blobs/.plans,
+shared by every name for the same bytes.
+
+A plan file is laid out so it can be written in one pass and opened
+without reading it all:
+
+    [normalized bytes][line offsets][source offsets][json header]
+    [header size][magic]
+
+The line offsets are 8 byte little endian offsets into the normalized bytes,
+one for every line sent, so we can seek to any line.  The source offsets,
+the same size, are where in the source file each line sent came from (0
+for the leader), so a line can be found in the file even when a stage of
+the pipeline has dropped or merged lines.  The header records the
+size, mtime and SHA-256 of the source file the plan was built from, the line
+count, and the CRC32 of the normalized bytes which is the same CRC the serial
+sender computes as it sends.  If the source size or mtime does not match, the
+plan is stale and is ignored.
+
+When the plan is made right after an upload, the size, CRC32 and SHA-256
+worked out as the upload came in (see upload_store.py) are checked against
+the file and kept in the header too.  So a send whose CRC matches the plan
+sent exactly what was uploaded.
+
+With COMPACT_GCODE=1 in the environment the plan is made again after the
+upload with a compaction stage in the pipeline (see Compaction) that takes
+comments, spaces, N numbers, extra zeros and repeated modal words out of
+each line before it is padded, so there are fewer chars to push through the
+9600 baud line.  The header of a compacted plan records how many chars it
+saved.
+
+With ARC_TOLERANCE_MM set the plan is made again with an arc fitting stage
+before compaction (see gcode_arcs.py), that replaces runs of short G1 moves
+with G2/G3 arcs within that tolerance.  The header records how many blocks
+and chars that took out, and the largest deviation from the G1 path.
+
+The serial sender keeps the plan file open while sending, so a plan
+replaced part way through a send does not change what is sent.
+
+The preflight of the upload (see gcode_preflight.py) adds a timing file
+next to the plan, one entry for each line of the plan:
+
+    [chars][seconds to run][projected finish][json header][header size][magic]
+
+chars are 4 byte unsigned ints, seconds 4 byte floats and finish 8 byte
+floats, all little endian.  The finish is when the line would be done
+running if the file were drip fed from the start, see DripFeed in
+gcode_motion.py.  Like the plan, the
+header records the source size and mtime, and a stale timing file is
+ignored.  It also adds a resume index of the places a send can be
+restarted from, see gcode_resume.py.
+
+"""
+
+import os
+import re
+import sys
+import gzip
+import json
+import struct
+import hashlib
+import tempfile
+from array import array
+from typing import Optional, Iterable, Iterator, Tuple
+from zlib import crc32
+
+from gcode_arcs import ArcFitting, fitted_lines
+from gcode_motion import CHARS_PER_SEC
+
+PLAN_DIR_NAME = ".plans"      # Hidden sub directory of UPLOAD_PATH
+PLAN_SUFFIX = ".plan"
+PLAN_VERSION = 3
+PLAN_MAGIC = b"MATPLAN1"
+TIMING_SUFFIX = ".timing"
+TIMING_VERSION = 1
+TIMING_MAGIC = b"MATTIME1"
+RESUME_SUFFIX = ".resume"
+TRAILER = struct.Struct("<Q8s")     # header size, magic
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Compaction, see Compaction
+COMPACT_G_CODES = (0, 1, 2, 3, 17, 18, 19, 20, 21, 90, 91, 94)  # Followed
+MOTION_G_CODES = (0, 1, 2, 3)
+COMPACT_LINE_RE = re.compile(r'(?:[A-Z][-+]?[0-9]*\.?[0-9]*)+')
+NO_NUMBER_RE = re.compile(r'[A-Z](?=([-+]?\.?))\1(?![0-9])')
+SEQUENCE_RE = re.compile(r'N[-+]?[0-9]*\.?[0-9]*')
+MODAL_WORD_RE = re.compile(r'([FGMT])([-.0-9]*)')
+TRAILING_ZEROS_RE = re.compile(r'(\.[0-9]*?)0+(?![0-9])')
+LEADING_ZEROS_RE = re.compile(r'(?<=[A-Z-])0+(?=[0-9])')
+JUMP_RE = re.compile(rb'[Mm]0*9[79](?![0-9])|[Gg][Oo][Tt][Oo]')
+NO_SPACES = str.maketrans("", "", " \t\n\v\f\r")
+GZIP_MAGIC = b"\x1f\x8b"     # G-code never starts with these
+LONE_CR_RE = re.compile(rb'\r(?!\n)')
+
+
+def open_source(path: str):
+    """ Open an uploaded file to read its G-code, through a streaming
+        decompressor if it is stored compressed (see upload_store.py).
+        Offsets, sizes and lines are all of the G-code as uploaded.
+        Raises OSError on error.
+    """
+    with open(path, 'rb') as fd:
+        compressed = fd.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+# The G-code clean up is done as a pipeline of generators so a file of
+# any size can be prepared a line at a time as it is being sent.
+
+def source_chunks(fd, digest=None,
+                  size: int = HASH_CHUNK_SIZE) -> Iterator[bytes]:
+    """ Read a binary file in chunks with each \r that does not start a
+        \r\n made a \n.  Every byte stays where it was, and splitting on
+        \n gives the same lines as text mode's universal newlines, so an
+        old Mac file ending its lines with \r alone is not one long line.
+
+        digest, a hashlib object, gets the bytes as they are read.
+    """
+    held = b""      # A \r at the end of a chunk, until we see what's next
+    for raw in iter(lambda: fd.read(size), b""):
+        if digest is not None:
+            digest.update(raw)
+        data = held + raw
+        held = data[-1:] if data.endswith(b"\r") else b""
+        yield LONE_CR_RE.sub(b"\n", data[:len(data) - len(held)])
+    if held:
+        yield b"\n"
+
+
+def source_lines(fd, digest=None) -> Iterator[Tuple[int, str]]:
+    """ Yield (file offset, text) for each line of a binary file, lines
+        ending with \r\n, \r or \n, see source_chunks().
+    """
+    offset = 0
+    tail = b""
+    for chunk in source_chunks(fd, digest):
+        raws = (tail + chunk).split(b"\n")
+        tail = raws.pop()
+        for raw in raws:
+            yield offset, raw.decode("utf-8", errors="replace")
+            offset += len(raw) + 1
+    if tail:
+        yield offset, tail.decode("utf-8", errors="replace")
+
+
+def gcode_lines(source: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+    """ Yield (file offset, line) for each G-code line worth sending.
+
+        Lines are stripped of \r, \n and trailing spaces and made upper
+        case.  Blank lines are skipped.
+
+        Only reads up to the % End-of-code marker and skips a beginning
+        % if there is one.
+    """
+    saw_start_percent = False
+    saw_code = False
+    for offset, line in source:
+        line = line.rstrip().upper()    # Strip \n, spaces, make upper
+        if line == "":
+            # Strip all blank lines.
+            continue
+        if not saw_code and not saw_start_percent and line[0] == "%":
+            # We treat an initial '%' as a G code start of code
+            # marker but we can not send it because the Matsuura
+            # will treat it as an end of code marker and stop
+            # reading. So we strip it, but we only strip one. The
+            # next one we see is the end of code marker.
+            saw_start_percent = True
+            continue
+        # We have a non blank line
+        if line[0] == "%":  # end of code marker
+            return
+        saw_code = True
+        yield offset, line
+
+
+def compacted_lines(lines: Iterable[Tuple[int, str]],
+                    compaction: "Compaction") -> Iterator[Tuple[int, str]]:
+    """ Yield (file offset, line) for each line with the bytes the
+        Matsuura does not need taken out, see Compaction.  Lines left
+        with nothing to send are dropped.
+    """
+    for offset, line in lines:
+        line = compaction.compact(line)
+        if line is not None:
+            yield offset, line
+
+
+class Compaction:
+    """ Optional clean up stage that takes out what CAM output wastes
+        bytes on, without changing what the machine does:
+
+            comments in ( ), spaces, N sequence numbers, trailing zeros
+            ("X1.500000" is "X1.5", the point stays), leading zeros and
+            + signs, and G0 to G3 or F words that repeat the modal state.
+
+        A line with anything this does not understand (macro # [ = ,
+        block delete /, a ; or a ( left open) is sent as it is, and the
+        modal state is forgotten.  So is it after any M or T word or a
+        G code other than the ones in COMPACT_G_CODES, as a tool change
+        or canned cycle can leave the machine in a state we don't know.
+        A line left with nothing but a comment or N number is dropped.
+
+        Counts what it took out, in chars sent, see summary().
+    """
+    def __init__(self, keep_sequence_numbers: bool = False):
+        self.keep_sequence_numbers = keep_sequence_numbers
+        self.motion: Optional[float] = None     # G0 to G3, None if unknown
+        self.feed: Optional[float] = None       # F, None if unknown
+        self.inverse_time = False   # Saw G93, every move needs its own F
+        self.lines = 0
+        self.dropped = 0
+        self.chars_before = 0
+        self.chars_after = 0
+
+    def compact(self, line: str) -> Optional[str]:
+        """ The line to send instead of line, None to drop it.
+            line is from gcode_lines().
+        """
+        self.lines += 1
+        self.chars_before += max(len(line), 3) + 2     # Padded, CR LF
+        compacted = self._compact(line)
+        if compacted is None:
+            self.dropped += 1
+        else:
+            self.chars_after += max(len(compacted), 3) + 2
+        return compacted
+
+    def _compact(self, line: str) -> Optional[str]:
+        if ";" in line:
+            self.forget()
+            return line
+        text, balanced = strip_comments(line)
+        text = text.translate(NO_SPACES)
+        if droppable(text, self.keep_sequence_numbers):
+            return None
+        if not balanced or not COMPACT_LINE_RE.fullmatch(text):
+            self.forget()
+            return line
+
+        if NO_NUMBER_RE.search(text):
+            # A letter without a number, like GOTO.
+            self.forget()
+            return line
+        if not self.keep_sequence_numbers:
+            text = SEQUENCE_RE.sub("", text)
+        text = compact_numbers(text)
+
+        motions = []
+        feeds = []
+        known = True
+        for letter, number in MODAL_WORD_RE.findall(text):
+            if letter == "G":
+                g = float(number)
+                if g == 93:
+                    self.inverse_time = True
+                if g in MOTION_G_CODES:
+                    motions.append(letter + number)
+                known = known and g in COMPACT_G_CODES
+            elif letter == "F":
+                feeds.append(letter + number)
+            else:
+                known = False   # M or T
+        if not known:
+            self.forget()
+            return text
+
+        compacted = text
+        if len(motions) == 1 and float(motions[0][1:]) == self.motion:
+            compacted = remove_word(compacted, motions[0])
+        if len(feeds) == 1 and not self.inverse_time and \
+                float(feeds[0][1:]) == self.feed:
+            compacted = remove_word(compacted, feeds[0])
+
+        if len(motions) == 1:
+            self.motion = float(motions[0][1:])
+        elif motions:
+            self.motion = None
+        if feeds:
+            self.feed = float(feeds[-1][1:])
+        # Only repeated modal words, send them rather than nothing.
+        return compacted or text
+
+    def forget(self) -> None:
+        """ Don't take out modal words until they are seen again. """
+        self.motion = None
+        self.feed = None
+
+    def summary(self) -> dict:
+        return {
+            "lines_dropped": self.dropped,
+            "chars_before": self.chars_before,
+            "chars_after": self.chars_after,
+            "seconds_saved": round(
+                (self.chars_before - self.chars_after) / CHARS_PER_SEC, 1),
+            "sequence_numbers": self.keep_sequence_numbers,
+        }
+
+
+def strip_comments(line: str) -> Tuple[str, bool]:
+    """ line without its ( ) comments, and False if a ( was left open
+        or a ) had no (.  An open ( runs to the end of the line.
+    """
+    if "(" not in line and ")" not in line:
+        return line, True
+    depth = 0
+    balanced = True
+    kept = []
+    for c in line:
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            balanced = balanced and depth >= 0
+        if depth <= 0 and c != ")":
+            kept.append(c)
+    return "".join(kept), balanced and depth == 0
+
+
+def droppable(text: str, keep_sequence_numbers: bool) -> bool:
+    """ True if text, a line without comments or spaces, has nothing to
+        send.  Just an N number counts as nothing unless we keep them.
+    """
+    if not text:
+        return True
+    return (not keep_sequence_numbers and text[0] == "N"
+            and not text.strip("N0123456789"))
+
+
+def compact_numbers(text: str) -> str:
+    """ text with each number written the shortest way with the same
+        value, keeping the point if it had one.  "X+01.2500" is "X1.25",
+        "G01" is "G1", "Z-0.0" is "Z-0.".
+    """
+    text = TRAILING_ZEROS_RE.sub(r"\1", text.replace("+", ""))
+    return LEADING_ZEROS_RE.sub("", text)
+
+
+def remove_word(text: str, word: str) -> str:
+    """ text without the first whole word that is word. """
+    start = 0
+    while True:
+        i = text.index(word, start)
+        end = i + len(word)
+        if end == len(text) or text[end] not in "0123456789.":
+            return text[:i] + text[end:]
+        start = end
+
+
+def uses_sequence_numbers(source_file: str) -> bool:
+    """ True if the G-code file might jump to or call an N number (M97,
+        M99 or a macro GOTO), so compaction must leave them in.
+        Raises OSError on error.
+    """
+    with open_source(source_file) as fd:
+        tail = b""
+        for data in iter(lambda: fd.read(HASH_CHUNK_SIZE), b""):
+            if JUMP_RE.search(tail + data):
+                return True
+            tail = data[-8:]
+    return False
+
+
+def compaction_enabled() -> bool:
+    """ COMPACT_GCODE from the environment, off if not set. """
+    return bool(int(os.environ.get('COMPACT_GCODE', '0')))
+
+
+def recorded_lines(lines: Iterable[Tuple[int, str]],
+                   offsets: array) -> Iterator[Tuple[int, str]]:
+    """ Pass lines through while adding their file offsets to offsets. """
+    for offset, line in lines:
+        offsets.append(offset)
+        yield offset, line
+
+
+def padded_lines(lines: Iterable[Tuple[int, str]]) -> Iterator[str]:
+    """ Pad short lines and add CR LF to every line. """
+    for _, line in lines:
+        if len(line) < 3:
+            # Short lines like "M06\n" (4 chars) seemed to have been
+            # a key part of the Matsuura RS-232 Over-run Alarm so
+            # I'm going to just pad all short lines with spaces
+            # to make sure "M6" becomes "M6 " as well
+            # as adding \r\n instead of just \n.
+            line = line.ljust(3)
+        yield line + '\r\n'  # Put CR LF on every line
+
+
+def framed_lines(lines: Iterable[str]) -> Iterator[str]:
+    """ Add the leader line at the start and the % marker at the end.
+
+        Because there is a really odd bug here we add the % to the end of
+        the last line so it gets sent at the same time the last line is
+        sent. The bug is if we are drip feeding slowly, and the M30 stop
+        command at the end of the file gets executed before
+        the Matsuura reads the %, then the Matsuura stops reading.
+        So CTS will never go low and we will be hung waiting
+        for the Matsuura to ask for more data so we can send the % to tell
+        it there is nothing more to send!  In drip feed (TAPE) mode,
+        we could imply never bother to send the %. But when sending to load
+        a program into memory, the % is required.  Since we don't know if we
+        are drip feeding or loading into memory, we must send the %.  So the
+        simple hack I choose to use here, is to send it as part of the last
+        line of the file.
+
+        We do not add a CR or LF after the %.
+    """
+    # Initial blank line for the Matsuura LSK (Leader Skip) to eat.
+    yield "\r\n"
+
+    last_line = None
+    for line in lines:
+        if last_line is not None:
+            yield last_line
+        last_line = line
+
+    if last_line is None:
+        # There is no last line to add it to!
+        yield "%"
+    else:
+        yield last_line + "%"
+
+
+class SendPlan:
+    """ A compiled send plan for one uploaded G-code file.
+
+        Only the header is read on load.  Lines are read from the plan
+        file as they are sent.
+    """
+    def __init__(self, plan_file: str, header: dict,
+                 timing: Optional["LineTiming"] = None):
+        self.plan_file = plan_file
+        self.header = header
+        self.timing = timing        # Time to run each line, if known
+
+    @property
+    def lines(self) -> int:
+        """ Number of lines to send, including the leader line. """
+        return self.header["lines"]
+
+    @property
+    def crc32_value(self) -> int:
+        """ CRC32 of all the bytes to be sent. """
+        return self.header["crc32"]
+
+    @property
+    def source_sha256(self) -> str:
+        return self.header["source_sha256"]
+
+    @property
+    def data_size(self) -> int:
+        return self.header["data_size"]
+
+    @property
+    def upload(self) -> Optional[dict]:
+        """ Size and hashes of the upload, if the plan was made for one. """
+        return self.header.get("upload")
+
+    @property
+    def compaction(self) -> Optional[dict]:
+        """ What compaction took out, see Compaction.summary(), or None
+            if the plan was made without it.
+        """
+        return self.header.get("compaction")
+
+    @property
+    def arcs(self) -> Optional[dict]:
+        """ What arc fitting did, see ArcFitting.summary(), or None if the
+            plan was made without it.
+        """
+        return self.header.get("arcs")
+
+    def made_with(self, compact: bool, arc_tolerance_mm: float) -> bool:
+        """ True if the plan was made with these compile_plan() stages. """
+        arcs = self.arcs["tolerance_mm"] if self.arcs is not None else 0.0
+        return (self.compaction is not None) == compact and \
+            arcs == arc_tolerance_mm
+
+    @classmethod
+    def load(cls, source_file: str) -> Optional["SendPlan"]:
+        """ Return the plan for source_file, or None if there is no plan
+            or the plan is out of date.
+
+            Raises OSError if source_file can not be accessed.
+        """
+        st = os.stat(source_file)
+        plan_file = plan_path(source_file)
+        try:
+            header = read_header(plan_file, PLAN_MAGIC)
+        except (OSError, ValueError, struct.error):
+            return None
+
+        if (header is None
+                or header.get("version") != PLAN_VERSION
+                or header.get("source_size") != st.st_size
+                or header.get("source_mtime_ns") != st.st_mtime_ns):
+            return None
+
+        timing = LineTiming.load(source_file, st)
+        if timing is not None and timing.lines != header["lines"]:
+            timing = None
+        return cls(plan_file, header, timing)
+
+    def line_offset(self, line: int) -> int:
+        """ Offset of line in the normalized bytes. """
+        with open(self.plan_file, 'rb') as fd:
+            return self._line_offset(fd, line)
+
+    def _line_offset(self, fd, line: int) -> int:
+        fd.seek(self.data_size + 8 * line)
+        return struct.unpack("<Q", fd.read(8))[0]
+
+    def source_offset(self, line: int) -> int:
+        """ Offset in the source file of line. """
+        with open(self.plan_file, 'rb') as fd:
+            fd.seek(self.data_size + 8 * (self.lines + line))
+            return struct.unpack("<Q", fd.read(8))[0]
+
+    def line_offsets(self) -> array:
+        """ Offset of every line in the normalized bytes ('Q').
+            Raises OSError on error.
+        """
+        offsets = array('Q')
+        with open(self.plan_file, 'rb') as fd:
+            fd.seek(self.data_size)
+            offsets.frombytes(fd.read(8 * self.lines))
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        return offsets
+
+    def source_offsets(self) -> array:
+        """ Offset in the source file of every line sent ('Q').
+            Raises OSError on error.
+        """
+        offsets = array('Q')
+        with open(self.plan_file, 'rb') as fd:
+            fd.seek(self.data_size + 8 * self.lines)
+            offsets.frombytes(fd.read(8 * self.lines))
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        return offsets
+
+    def open_lines(self, start_line: int = 0) -> Iterator[str]:
+        """ Iterator of the lines to send, starting at start_line.
+
+            The plan file is opened now, so a plan put in its place after
+            this (see save_preflight() in gcode_preflight.py) does not
+            change what is sent.
+            Raises OSError if the file is no longer the plan we loaded.
+        """
+        fd = open(self.plan_file, 'rb')
+        try:
+            if header_from(fd, PLAN_MAGIC) != self.header:
+                raise OSError(f"{self.plan_file} changed since it was loaded")
+        except (ValueError, struct.error) as err:
+            fd.close()
+            raise OSError(f"{self.plan_file}: {err}")
+        except BaseException:
+            fd.close()
+            raise
+        return self._lines(fd, start_line)
+
+    def _lines(self, fd, start_line: int) -> Iterator[str]:
+        with fd:
+            if start_line >= self.lines:
+                return
+            fd.seek(self._line_offset(fd, start_line))
+            for line in range(start_line, self.lines):
+                if line == self.lines - 1:
+                    # Last line ends with % not \n so read to the end.
+                    raw = fd.read(self.data_size - fd.tell())
+                else:
+                    raw = fd.readline()
+                yield raw.decode("utf-8")
+
+
+class LineTiming:
+    """ How long each line of a send plan takes to run, from the timing
+        file.  Only the header is read on load.
+    """
+    def __init__(self, fd, header: dict):
+        self.fd = fd                # Kept open, the file may be replaced
+        self.header = header
+
+    @property
+    def lines(self) -> int:
+        return self.header["lines"]
+
+    @property
+    def summary(self) -> dict:
+        """ The drip feed projection, see DripFeed.summary(). """
+        return self.header["summary"]
+
+    @classmethod
+    def load(cls, source_file: str,
+             st: Optional[os.stat_result] = None) -> Optional["LineTiming"]:
+        """ Return the timing for source_file, or None if there is none
+            or it is out of date.
+        """
+        try:
+            if st is None:
+                st = os.stat(source_file)
+            fd = open(timing_path(source_file), 'rb')
+        except OSError:
+            return None
+        try:
+            header = header_from(fd, TIMING_MAGIC)
+        except (OSError, ValueError, struct.error):
+            header = None
+        if (header is None
+                or header.get("version") != TIMING_VERSION
+                or header.get("source_size") != st.st_size
+                or header.get("source_mtime_ns") != st.st_mtime_ns):
+            fd.close()
+            return None
+        return cls(fd, header)
+
+    def read(self, start: int, count: int):
+        """ (chars, seconds, finish) arrays for count lines from start.
+
+            Shorter at the end of the plan.
+            Raises OSError on error.
+        """
+        count = max(0, min(count, self.lines - start))
+        arrays = (array('I'), array('f'), array('d'))
+        section = 0
+        for values in arrays:
+            self.fd.seek(section + values.itemsize * start)
+            values.frombytes(self.fd.read(values.itemsize * count))
+            if sys.byteorder != "little":
+                values.byteswap()
+            section += values.itemsize * self.lines
+        return arrays
+
+
+def plan_path(source_file: str) -> str:
+    """ Where the plan for source_file lives, next to the file it links
+        to if it is a link.
+    """
+    source_file = os.path.realpath(source_file)
+    return os.path.join(os.path.dirname(source_file), PLAN_DIR_NAME,
+                        os.path.basename(source_file) + PLAN_SUFFIX)
+
+
+def timing_path(source_file: str) -> str:
+    """ Where the timing file for source_file lives. """
+    return plan_path(source_file)[:-len(PLAN_SUFFIX)] + TIMING_SUFFIX
+
+
+def resume_path(source_file: str) -> str:
+    """ Where the resume index for source_file lives. """
+    return plan_path(source_file)[:-len(PLAN_SUFFIX)] + RESUME_SUFFIX
+
+
+def read_header(path: str, magic: bytes) -> Optional[dict]:
+    """ The json header from the end of a plan, timing or resume file, or
+        None if the file does not end with magic.
+        Raises OSError, ValueError or struct.error.
+    """
+    with open(path, 'rb') as fd:
+        return header_from(fd, magic)
+
+
+def header_from(fd, magic: bytes) -> Optional[dict]:
+    """ read_header() from an open file. """
+    fd.seek(-TRAILER.size, os.SEEK_END)
+    header_size, found = TRAILER.unpack(fd.read(TRAILER.size))
+    if found != magic:
+        return None
+    fd.seek(-TRAILER.size - header_size, os.SEEK_END)
+    return json.loads(fd.read(header_size).decode("utf-8"))
+
+
+def save_timing(source_file: str, st: os.stat_result, chars: array,
+                seconds: array, finish: array, summary: dict) -> None:
+    """ Write the timing file for source_file.
+
+        st is the stat of the file the times were worked out from.
+        chars ('I'), seconds ('f') and finish ('d') have one entry for every
+        line of the send plan.  summary is from DripFeed.summary().
+
+        Raises OSError on error.
+    """
+    timing_file = timing_path(source_file)
+    os.makedirs(os.path.dirname(timing_file), exist_ok=True)
+    header = {
+        "version": TIMING_VERSION,
+        "source_size": st.st_size,
+        "source_mtime_ns": st.st_mtime_ns,
+        "lines": len(chars),
+        "summary": summary,
+    }
+    fd_out, tmp_name = tempfile.mkstemp(dir=os.path.dirname(timing_file),
+                                        suffix=".tmp")
+    try:
+        with open(fd_out, 'wb') as out:
+            for values in (chars, seconds, finish):
+                if sys.byteorder != "little":
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                out.write(values.tobytes())
+            header_bytes = json.dumps(header).encode("utf-8")
+            out.write(header_bytes)
+            out.write(TRAILER.pack(len(header_bytes), TIMING_MAGIC))
+        os.replace(tmp_name, timing_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def compile_plan(source_file: str, upload: Optional[dict] = None,
+                 compact: bool = False,
+                 arc_tolerance_mm: float = 0.0) -> SendPlan:
+    """ Build and save the send plan for source_file.
+
+        The plan is written to a temp file and renamed into place so the
+        serial sender never sees a partial plan.
+
+        upload is the size and hashes from save_upload() in upload_store.py.
+        If given, the file must still match it.
+
+        compact adds the Compaction stage.  It is several times slower,
+        too slow to do while an upload waits, so the preflight does it
+        (see save_preflight() in gcode_preflight.py).  So does a non zero
+        arc_tolerance_mm, which adds the ArcFitting stage (gcode_arcs.py).
+
+        Raises OSError on error, or if the file does not match upload.
+    """
+    plan_file = plan_path(source_file)
+    os.makedirs(os.path.dirname(plan_file), exist_ok=True)
+
+    st = os.stat(source_file)
+    compaction = None
+    fitting = None
+    if compact or arc_tolerance_mm:
+        keep_sequence_numbers = uses_sequence_numbers(source_file)
+        if compact:
+            compaction = Compaction(keep_sequence_numbers)
+        if arc_tolerance_mm:
+            fitting = ArcFitting(arc_tolerance_mm, keep_sequence_numbers)
+    sha256 = hashlib.sha256()
+    offsets = array('Q')
+    source_offsets = array('Q', [0])    # The leader
+    crc32_value = 0
+    data_size = 0
+
+    fd_out, tmp_name = tempfile.mkstemp(dir=os.path.dirname(plan_file),
+                                        suffix=".tmp")
+    try:
+        with open(fd_out, 'wb') as out, open_source(source_file) as fd:
+            lines = gcode_lines(source_lines(fd, sha256))
+            if fitting is not None:
+                lines = fitted_lines(lines, fitting)
+            if compaction is not None:
+                lines = compacted_lines(lines, compaction)
+            lines = recorded_lines(lines, source_offsets)
+            for line in framed_lines(padded_lines(lines)):
+                raw = line.encode("utf-8")
+                offsets.append(data_size)
+                out.write(raw)
+                crc32_value = crc32(raw, crc32_value)
+                data_size += len(raw)
+            # The clean up stops at the % end marker.  Hash the rest too.
+            for raw in iter(lambda: fd.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(raw)
+
+            if len(source_offsets) < len(offsets):
+                source_offsets.append(0)    # A % with no line to go on
+            if sys.byteorder != "little":
+                offsets.byteswap()
+                source_offsets.byteswap()
+            out.write(offsets.tobytes())
+            out.write(source_offsets.tobytes())
+
+            if upload is not None and (
+                    upload["sha256"] != sha256.hexdigest()
+                    or upload["size"] != fd.tell()):
+                raise OSError(f"{source_file} does not match what was uploaded")
+
+            header = {
+                "version": PLAN_VERSION,
+                "source_size": st.st_size,
+                "source_mtime_ns": st.st_mtime_ns,
+                "source_sha256": sha256.hexdigest(),
+                "lines": len(offsets),
+                "crc32": crc32_value,
+                "data_size": data_size,
+            }
+            if upload is not None:
+                header["upload"] = upload
+            if compaction is not None:
+                header["compaction"] = compaction.summary()
+            if fitting is not None:
+                header["arcs"] = fitting.summary()
+            header_bytes = json.dumps(header).encode("utf-8")
+            out.write(header_bytes)
+            out.write(TRAILER.pack(len(header_bytes), PLAN_MAGIC))
+        os.replace(tmp_name, plan_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+    return SendPlan(plan_file, header)
+
+
+def remove_plan(source_file: str) -> None:
+    """ Remove the plan, timing and resume index for source_file if there
+        are any.
+    """
+    for path in (plan_path(source_file), timing_path(source_file),
+                 resume_path(source_file)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
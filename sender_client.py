@@ -0,0 +1,204 @@
+"""
+
+sender_client.py - talk to the serial_sender daemon from the web app
+
+Keeps one connection per web server worker open to the serial sender and
+reuses it for every command, instead of connecting and tearing down a
+socket for each /api call.  If the connection has gone bad (the sender was
+restarted, say) we reconnect and try once more, but only if the commands
+never went out.  Once they are sent a command may have been done even if
+no reply comes, and start, enqueue and the like must not be done twice,
+so a lost or late reply is a SenderError.
+
+Commands and replies are newline delimited json with request ids (see
+serial_sender.py), so several commands can be sent at once with
+request_many() and the replies matched up whatever order they come in.
+
+Connects over a Unix domain socket when SERIAL_SOCKET_PATH is set, which is
+cheaper than TCP on the same box, else to localhost:SERIAL_TCP_PORT.
+
+"""
+
+import os
+import json
+import select
+import socket
+import threading
+from typing import Optional, List, Dict, Iterator
+
+DEFAULT_TIMEOUT = 5.0       # Seconds to wait on the sender
+
+
+class SenderError(OSError):
+    """ Could not get a reply from the serial sender. """
+
+
+class SenderClient:
+    """ Persistent, auto reconnecting connection to serial_sender. """
+    def __init__(self, tcp_port: Optional[int] = None,
+                 unix_path: Optional[str] = None,
+                 host: str = 'localhost',
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.tcp_port = tcp_port
+        self.unix_path = unix_path or None
+        self.host = host
+        self.timeout = timeout
+        self.sock: Optional[socket.socket] = None
+        self.rfile = None                   # Buffered reader on sock
+        self.next_id = 0                    # Id of last request sent
+        self.replies: Dict[int, dict] = {}  # Replies read but not yet wanted
+        self.pid = os.getpid()
+        self.lock = threading.Lock()    # One command at a time per socket
+
+    @classmethod
+    def from_environment(cls) -> "SenderClient":
+        return cls(tcp_port=int(os.environ['SERIAL_TCP_PORT']),
+                   unix_path=os.environ.get('SERIAL_SOCKET_PATH'))
+
+    def new_socket(self, timeout: float) -> socket.socket:
+        """ Open a new connection to the sender. """
+        if self.unix_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.unix_path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self.host, self.tcp_port)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def connect(self) -> socket.socket:
+        """ Return the open connection, connecting if needed. """
+        if self.sock is not None and self.pid != os.getpid():
+            # We were forked.  The socket belongs to our parent.
+            self.sock = None
+            self.rfile = None
+            self.replies = {}
+        if self.sock is not None and self.closed_by_sender():
+            self.close()
+        if self.sock is None:
+            sock = self.new_socket(self.timeout)
+            self.sock = sock
+            self.rfile = sock.makefile('rb')
+            self.pid = os.getpid()
+        return self.sock
+
+    def closed_by_sender(self) -> bool:
+        """ True if the sender has closed the connection since we last
+            used it, so nothing sent on it now would be read.
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and \
+                self.sock.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def close(self) -> None:
+        if self.rfile is not None:
+            try:
+                self.rfile.close()
+            except OSError:
+                pass
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.rfile = None
+        self.replies = {}
+
+    def request(self, mesg: dict) -> dict:
+        """ Send one command and return the sender's reply.
+            Raises SenderError if the sender can't be reached.
+        """
+        return self.request_many([mesg])[0]
+
+    def request_many(self, mesgs: List[dict]) -> List[dict]:
+        """ Send several commands at once without waiting for each reply.
+
+            Returns the replies in the same order as the commands, no
+            matter what order the sender answers them in.
+            Raises SenderError if the sender can't be reached.
+        """
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    self.connect()
+                    ids = []
+                    out = b''
+                    for mesg in mesgs:
+                        self.next_id += 1
+                        ids.append(self.next_id)
+                        out += json.dumps(dict(mesg, id=self.next_id)).encode('utf-8') + b'\n'
+                    self.sock.sendall(out)
+                except socket.timeout as err:
+                    # Some of it may have gone out, don't send it again
+                    self.close()
+                    raise SenderError(f"serial sender: {err}") from err
+                except OSError as err:
+                    # Stale connection, nothing was read.  Start over.
+                    self.close()
+                    if attempt == 1:
+                        raise SenderError(f"serial sender: {err}") from err
+                    continue
+                try:
+                    return [self.reply(request_id) for request_id in ids]
+                except (OSError, ValueError) as err:
+                    # Timed out, or a garbled reply.  The commands went
+                    # out and may have been done, so they are not sent
+                    # again.
+                    self.close()
+                    raise SenderError(f"serial sender: {err}") from err
+
+    def reply(self, request_id: int) -> dict:
+        """ Read replies until we get the one for request_id. """
+        while request_id not in self.replies:
+            line = self.rfile.readline()
+            if not line:
+                raise ConnectionResetError("serial sender closed the connection")
+            rx_mesg_obj = json.loads(line.decode('utf-8'))
+            if 'id' not in rx_mesg_obj:
+                # Only errors we can't tie to a request come back
+                # without an id, like a request line that is too long.
+                raise ValueError(rx_mesg_obj.get('message', 'reply without id'))
+            self.replies[rx_mesg_obj.pop('id')] = rx_mesg_obj
+        return self.replies.pop(request_id)
+
+    def events(self, keepalive: float) -> Iterator[Optional[dict]]:
+        """ Generator of status change events from the sender.
+
+            Uses its own connection, since it is tied up for as long as
+            the caller keeps reading.  Yields None when nothing has
+            happened for keepalive seconds so the caller can check its
+            own client is still there.
+            Raises SenderError if the sender can't be reached or goes away.
+        """
+        try:
+            sock = self.new_socket(keepalive)
+        except OSError as err:
+            raise SenderError(f"serial sender: {err}") from err
+        try:
+            sock.sendall(json.dumps({'cmd': 'subscribe'}).encode('utf-8') + b'\n')
+            buf = b''
+            while True:
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    yield None
+                    continue
+                if not data:
+                    raise ConnectionResetError("serial sender closed the connection")
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    yield json.loads(line.decode('utf-8'))
+        except (OSError, ValueError) as err:
+            raise SenderError(f"serial sender: {err}") from err
+        finally:
+            sock.close()
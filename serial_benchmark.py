@@ -0,0 +1,385 @@
+"""
+
+serial_benchmark.py - measure how well serial_sender.py drives the line
+
+Runs the real SerialSender pacing loop against matsuura_simulator.py over
+a pty, on a small corpus of made up G-code that covers the shapes that
+matter on the Matsuura:
+
+    endings     A short job followed by a long run of tiny M-code blocks,
+                the kind of ending that used to cause RS-232 overrun alarms.
+                TAPE mode.
+
+    surfacing   Long 3D surfacing, over a thousand short G01 XYZ moves, so the
+                machine eats blocks faster than 9600 baud can bring them.
+                TAPE mode.
+
+    contour     Circles stepped down in Z, each posted as 360 short G01
+                moves, the kind of file arc fitting is for.  TAPE mode.
+
+    memory      A big file loaded into memory, where nothing but the
+                sender's pacing limits the speed.
+
+For each case, and each flow control policy asked for, it reports:
+
+    cps         Chars per second from the first char received to the %,
+                and as a percent of the 960 chars/sec the line can carry.
+    idle        Seconds RTS was on but nothing was coming down the wire.
+    backlog     Most chars left waiting in the "OS buffers" while RTS was off.
+    late        Most chars the machine got after it turned RTS off.
+    latency     Seconds from the start command to the first char received.
+    secs        Seconds from the first char received to the %.
+    eta         What the preflight projected secs would be, see DripFeed in
+                gcode_motion.py.
+
+The corpus gets send plans and, unless --no-timing, the timing files the
+sender looks ahead with, just like an upload does.  With --compact the plans
+are compacted (see Compaction in send_plan.py), so a run with and without it
+shows what compaction saves on the line.  --arc-tolerance does the same
+for arc fitting (see gcode_arcs.py).
+
+Results are written as json with --output so changes to pacing and chunk
+sizes can be compared run to run with --compare:
+
+    python3 serial_benchmark.py --flow fixed --flow adaptive -o before.json
+    ... change something ...
+    python3 serial_benchmark.py --flow fixed --flow adaptive \\
+        -o after.json --compare before.json
+
+Takes a few minutes at --scale 1.  Use --scale 0.2 for a quick look.
+Exits with status 1 if the simulated machine had an overrun alarm.
+
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+import gcode_motion
+import serial_sender
+from send_plan import compile_plan
+from gcode_preflight import save_preflight
+from flow_control import CHARS_PER_SEC
+from matsuura_simulator import MachineSimulator
+
+DEFAULT_SCALE = 1.0
+DEFAULT_SEED = 9600
+FINISH_MARGIN = 10.0    # Seconds past the ideal send time before giving up
+CASE_PAUSE = 0.5        # Seconds between cases for the port to settle
+
+
+# ----------------------------------------------------------------------
+# The corpus.  Each maker writes a G-code file and returns nothing.
+
+def make_endings(fd, rng: random.Random, scale: float):
+    """ A little cutting, then a long run of one word blocks. """
+    fd.write("%\nO1001 (ENDINGS)\nG90 G20 G17\nM06 T1\nS2500 M03\n")
+    fd.write("G00 X0. Y0. Z0.1\nG01 Z-0.05 F30.\n")
+    for _ in range(int(40 * scale) + 1):
+        fd.write(f"X{rng.uniform(0, 0.1):.4f} Y{rng.uniform(0, 0.1):.4f}\n")
+    tails = ["M05", "M09", "M01", "G80", "M06 T2", "T3", "M3", "M8",
+             "G91 G28 Z0", "G90", "M00", "G49"]
+    for _ in range(int(400 * scale) + 1):
+        fd.write(rng.choice(tails) + "\n")
+    fd.write("M05\nM09\nM30\n%\n")
+
+
+def make_surfacing(fd, rng: random.Random, scale: float):
+    """ Back and forth raster over a bumpy surface. """
+    fd.write("%\nO1002 (SURFACING)\nG90 G20 G17\nM06 T2\nS8000 M03\n")
+    fd.write("G00 X0. Y0. Z0.1\nG01 Z0. F60.\n")
+    rows = int(40 * scale) + 1
+    steps = 40
+    for row in range(rows):
+        y = row * 0.02
+        for step in range(steps + 1):
+            x = (step if row % 2 == 0 else steps - step) * 0.005
+            z = 0.05 * math.sin(x * 7.0) * math.cos(y * 5.0) \
+                + rng.uniform(-0.0005, 0.0005)
+            fd.write(f"G01 X{x:.4f} Y{y:.4f} Z{z:.4f}\n")
+    fd.write("G00 Z1.\nM05\nM30\n%\n")
+
+
+def make_contour(fd, rng: random.Random, scale: float):
+    """ Circles stepped down in Z, posted as 1 degree G1 moves. """
+    fd.write("%\nO1004 (CONTOUR)\nG90 G20 G17\nM06 T4\nS6000 M03\n")
+    fd.write("G00 X1.5 Y0. Z0.1\nG01 Z0. F120.\n")
+    for level in range(int(10 * scale) + 1):
+        radius = 1.5 - rng.uniform(0, 0.01)
+        fd.write(f"G01 X{radius:.4f} Y0. Z{-0.01 * (level + 1):.4f}\n")
+        for degree in range(1, 361):
+            a = math.radians(degree)
+            fd.write(f"X{radius * math.cos(a):.4f}"
+                     f" Y{radius * math.sin(a):.4f}\n")
+    fd.write("G00 Z1.\nM05\nM30\n%\n")
+
+
+def make_memory(fd, rng: random.Random, scale: float):
+    """ A big program to load into memory, mixed block lengths. """
+    fd.write("%\nO1003 (MEMORY LOAD)\nG90 G20 G17\nM06 T3\nS5000 M03\n")
+    for n in range(int(1500 * scale) + 1):
+        kind = rng.random()
+        if kind < 0.6:
+            fd.write(f"N{n} G01 X{rng.uniform(-4, 4):.4f}"
+                     f" Y{rng.uniform(-4, 4):.4f} F{rng.randint(5, 60)}.\n")
+        elif kind < 0.9:
+            fd.write(f"N{n} G02 X{rng.uniform(-4, 4):.4f}"
+                     f" Y{rng.uniform(-4, 4):.4f} R{rng.uniform(0.5, 4):.4f}\n")
+        else:
+            fd.write(f"N{n} Z{rng.uniform(-0.5, 0.1):.4f}\n")
+    fd.write("M05\nM30\n%\n")
+
+
+CORPUS: Dict[str, dict] = {
+    "endings": {"mode": "tape", "make": make_endings},
+    "surfacing": {"mode": "tape", "make": make_surfacing},
+    "contour": {"mode": "tape", "make": make_contour},
+    "memory": {"mode": "memory", "make": make_memory},
+}
+
+
+def write_corpus(directory: str, names: List[str], scale: float,
+                 seed: int, timing: bool = True, compact: bool = False,
+                 arc_tolerance_mm: float = 0.0) -> Dict[str, str]:
+    """ Write the corpus files, their send plans and timing files.
+        Returns file path by case name.
+    """
+    paths = {}
+    for name in names:
+        path = os.path.join(directory, f"{name}.nc")
+        with open(path, "w") as fd:
+            make: Callable = CORPUS[name]["make"]
+            make(fd, random.Random(seed), scale)
+        compile_plan(path, compact=compact, arc_tolerance_mm=arc_tolerance_mm)
+        if timing:
+            save_preflight(path, compact=compact,
+                           arc_tolerance_mm=arc_tolerance_mm)
+        paths[name] = path
+    return paths
+
+
+# ----------------------------------------------------------------------
+# Running one case
+
+def run_case(name: str, path: str, flow: str, link: str,
+             sim_args: dict) -> dict:
+    """ Send one file with one flow control policy and measure it. """
+    sim = MachineSimulator(link=link, mode=CORPUS[name]["mode"], **sim_args)
+    sim.start()
+    os.environ['SERIAL_PORTS'] = ''     # Just the one, on the simulator
+    os.environ['SERIAL_PORT_NAME'] = link
+    os.environ['SERIAL_SIMULATOR'] = '1'
+    os.environ['UPLOAD_PATH'] = os.path.dirname(path)
+    os.environ['FLOW_CONTROL'] = flow
+    sender = serial_sender.SerialSender()
+    try:
+        return asyncio.run(drive(sender, sim, name, path))
+    finally:
+        sender.default_machine.serial_port.close()
+        sim.stop()
+        time.sleep(CASE_PAUSE)
+
+
+async def drive(sender: serial_sender.SerialSender, sim: MachineSimulator,
+                name: str, path: str) -> dict:
+    """ Run the sender's serial loop until the simulator has the whole
+        program, or until it is clearly not going to get it.
+    """
+    machine = sender.default_machine
+    machine.wakeup = asyncio.Event()
+    loop_task = asyncio.ensure_future(machine.serial_loop())
+    try:
+        file_name = os.path.basename(path)
+        plan_crc = None
+        started = time.monotonic()
+        reply = await machine.serial_start_send(file_name)
+        if reply["error"]:
+            raise RuntimeError(reply["message"])
+        plan = machine.file_to_send.plan
+        projected = None
+        if plan is not None:
+            plan_crc = plan.crc32_value
+            if plan.timing is not None:
+                timing = plan.timing.summary
+                projected = timing["drip_feed_seconds"] \
+                    if sim.mode == "tape" else timing["link_seconds"]
+        ideal = (plan.data_size if plan else os.path.getsize(path)) \
+            / CHARS_PER_SEC
+        if sim.mode == "tape":
+            ideal += machine_time(path)
+        deadline = started + ideal * 2 + FINISH_MARGIN
+        while not sim.results:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{name}: machine never got the %,"
+                                   f" sender says {machine.status_message()!r}")
+            await asyncio.sleep(0.05)
+        flow_status = machine.flow.status
+    finally:
+        loop_task.cancel()
+        try:
+            await loop_task
+        except asyncio.CancelledError:
+            pass
+
+    p = sim.results[0]
+    seconds = p["end"] - p["first_char"]
+    cps = p["chars"] / seconds if seconds > 0 else 0.0
+    return {
+        "case": name,
+        "mode": p["mode"],
+        "flow_control": machine.flow.name,
+        "flow_status": flow_status,
+        "chars": p["chars"],
+        "blocks": p["blocks"],
+        "seconds": round(seconds, 3),
+        "projected_seconds": projected,
+        "chars_per_sec": round(cps, 1),
+        "line_efficiency": round(cps / CHARS_PER_SEC, 4),
+        "rts_idle_time": round(p["rts_idle_time"], 3),
+        "max_backlog": p["max_backlog"],
+        "max_late_chars": p["max_late_chars"],
+        "start_latency": round(p["first_char"] - started, 4),
+        "rts_drops": p["rts_drops"],
+        "starved_time": round(p["starved_time"], 3),
+        "overrun_alarms": p["overrun_alarms"],
+        "crc_ok": plan_crc is None or plan_crc == p["crc32"],
+        "stranded_by_end": p["stranded_by_end"],
+    }
+
+
+def machine_time(path: str) -> float:
+    """ Seconds the simulator should take to run the file in TAPE mode. """
+    motion = gcode_motion.MotionState()
+    with open(path) as fd:
+        return sum(motion.block(line)[1] for line in fd)
+
+
+# ----------------------------------------------------------------------
+# Reporting
+
+COLUMNS = [("chars_per_sec", "cps", "{:7.1f}"),
+           ("line_efficiency", "line%", "{:6.1%}"),
+           ("rts_idle_time", "idle s", "{:7.2f}"),
+           ("max_backlog", "backlog", "{:7d}"),
+           ("max_late_chars", "late", "{:5d}"),
+           ("start_latency", "latency", "{:7.3f}"),
+           ("overrun_alarms", "alarms", "{:6d}"),
+           ("seconds", "secs", "{:7.2f}"),
+           ("projected_seconds", "eta", "{:7.2f}")]
+
+
+def result_key(result: dict) -> str:
+    return f"{result['case']}/{result['flow_control']}"
+
+
+def print_table(results: List[dict], previous: Optional[Dict[str, dict]]):
+    header = f"{'case/flow':<20}" + "".join(
+        f" {label:>{len(fmt.format(0))}}" for _, label, fmt in COLUMNS)
+    print(header)
+    for result in results:
+        key = result_key(result)
+        row = f"{key:<20}" + "".join(
+            " " + cell(fmt, result.get(field)) for field, _, fmt in COLUMNS)
+        if result["stranded_by_end"]:
+            row += "  M30 RAN BEFORE %"
+        elif not result["crc_ok"]:
+            row += "  CRC MISMATCH"
+        print(row)
+        old = previous.get(key) if previous else None
+        if old is not None:
+            print(f"{'  was':<20}" + "".join(
+                " " + cell(fmt, old.get(field)) for field, _, fmt in COLUMNS))
+
+
+def cell(fmt: str, value) -> str:
+    """ value formatted for the table, "-" if missing. """
+    if value is None:
+        return "-".rjust(len(fmt.format(0)))
+    return fmt.format(value)
+
+
+def load_previous(path: str) -> Dict[str, dict]:
+    with open(path) as fd:
+        return {result_key(r): r for r in json.load(fd)["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--flow", action="append", choices=["fixed", "adaptive"],
+                        help="flow control policy to run, may be repeated"
+                             " (default: FLOW_CONTROL or fixed)")
+    parser.add_argument("--case", action="append", choices=list(CORPUS),
+                        help="corpus case to run, may be repeated"
+                             " (default: all)")
+    parser.add_argument("--scale", type=float, default=DEFAULT_SCALE,
+                        help="corpus size multiplier")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--buffer-size", type=int, default=None,
+                        help="simulated Yasnac buffer size")
+    parser.add_argument("--no-timing", action="store_true",
+                        help="no timing files, so the sender can't look ahead")
+    parser.add_argument("--compact", action="store_true",
+                        help="compact the send plans, see send_plan.py")
+    parser.add_argument("--arc-tolerance", type=float, default=0.0,
+                        metavar="MM",
+                        help="fit arcs in the send plans, see gcode_arcs.py")
+    parser.add_argument("-o", "--output", help="write results as json here")
+    parser.add_argument("--compare", help="json results of an earlier run")
+    args = parser.parse_args()
+
+    serial_sender.LOG_TO_SYSLOG = False     # Sender to stderr, like the simulator
+    flows = args.flow or [os.environ.get('FLOW_CONTROL',
+                                         serial_sender.DEFAULT_FLOW_CONTROL)]
+    names = args.case or list(CORPUS)
+    sim_args = {}
+    if args.buffer_size is not None:
+        sim_args["buffer_size"] = args.buffer_size
+    previous = load_previous(args.compare) if args.compare else None
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="serial_benchmark") as directory:
+        paths = write_corpus(directory, names, args.scale, args.seed,
+                             timing=not args.no_timing,
+                             compact=args.compact,
+                             arc_tolerance_mm=args.arc_tolerance)
+        link = os.path.join(directory, "matsuura_sim")
+        for name in names:
+            for flow in flows:
+                results.append(run_case(name, paths[name], flow, link,
+                                        sim_args))
+
+    print_table(results, previous)
+    if args.output:
+        report = {
+            "when": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "scale": args.scale,
+            "seed": args.seed,
+            "timing": not args.no_timing,
+            "compact": args.compact,
+            "arc_tolerance_mm": args.arc_tolerance,
+            "settings": {k: os.environ[k] for k in
+                         ("FLOW_MIN_CHUNK", "FLOW_MAX_CHUNK",
+                          "FLOW_MAX_BACKLOG") if k in os.environ},
+            "simulator": sim_args,
+            "results": results,
+        }
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=2)
+            fd.write("\n")
+    if any(r["overrun_alarms"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+    exit(0)
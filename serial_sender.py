@@ -9,12 +9,71 @@ Receives json encoded commands e.g.: {"cmd": "start", "file": "1001.nc"}
 Response is coded as: {"error": 0, "message": "File Started"}
 Error of 0 means no error.  Error of 1, means something is wrong.
 
-Other commands supported are "stop", and "status".  Neither take an argument.
+Each command and each response is one line of json ending in a newline.
+A command may carry an "id", e.g. {"id": 7, "cmd": "status"}, which is
+copied into its response so a client can send several commands on one
+connection without waiting and match up the responses.
+
+Other commands supported are "stop", "status" and "metrics".  None take an
+argument, other than which machine (see below).
 "stop" aborts the current sending file, and "status" returns a text
 description of the daemon status (sending, idle, finished send, etc).
 
+The daemon can drive several machines, each on its own serial port, set
+in SERIAL_PORTS as e.g. "matsuura=/dev/ttyUSB0,yasnac=/dev/ttyUSB1" (else
+the one machine "matsuura" is on SERIAL_PORT_NAME).  "start", "stop",
+"status" and "metrics" take a "machine" naming which one, e.g. {"cmd":
+"start", "machine": "yasnac", "file": "1001.nc"}, the first configured is
+used if not given.  "machines" returns the name, port and status of each
+in a "machines" field.
+
+Each machine has a queue of files to send, kept in UPLOAD_PATH so it
+survives restarts (see job_queue.py).  "enqueue" adds a "file" to the end
+of it, with "auto": true to have it start by itself when the send before
+it finishes without error, or right away if the machine is idle.  "queue"
+lists the jobs, "cancel" takes the "job" with that number out, and "move"
+puts it at "position" (0 is next).  "start" with no "file" starts the next
+job.  The status says how many are queued, and the "status" response has
+it in a "queued" field.  Queued jobs are not started by a restart of the
+daemon, only when a send finishes or on "start".
+
+"subscribe" turns the connection into an event stream.  After the normal
+response, an event line like {"event": "status", "machine": "matsuura",
+"error": 0, "message": "Sending 1001.nc, Line 89/234 38%"} is sent each time
+the status of a machine changes.  Events are "status", "started",
+"stopped", "sent", "stall" (CTS held off while sending) and "error".
+
+"metrics" returns counters and histograms about the serial line, like chars
+written, write sizes and how long CTS was off, in a "metrics" field of the
+response.  See send_metrics.py.
+
+When the preflight of a file has worked out how long each line takes to run
+(see gcode_preflight.py and the timing file in send_plan.py), the sender
+logs the projected drip feed time and where the machine will be left
+waiting on the 9600 baud line when a send starts, returns them in a
+"timing" field of the "start" response, shows the time left in the status,
+and tells the flow control policy what is coming so it can keep ahead of
+the machine.  If the plan was compacted (see Compaction in send_plan.py),
+what that saved is logged and returned in a "compaction" field, and the
+same for arc fitting (see gcode_arcs.py) in an "arcs" field.
+
+"resume" restarts a "file" part way through, from the last restart-safe
+point (a tool change or a retract to clearance) at or before "line" in the
+file, or with "safe": false from that line itself, once the preflight has
+made the file's resume index (see gcode_resume.py).  A preamble that puts
+the machine back in the modal state the program had there is sent first,
+and the "start" style response has it in a "resume" field.  The "stop"
+response and status say which line in the file had been sent, in a "line"
+field.
+
 Supports simultaneous connections from the network for command and control
-but only supports sending data on one RS-232 port.
+and sending data on any number of RS-232 ports at once.  The command server
+and the pacing of each serial port run as separate asyncio tasks, so any
+number of clients can be served, and each port is written to as soon as it
+is ready, without one delaying another.  Anything that reads files to start
+a send (the plan, the resume index) is done in a thread, and the machine
+is woken up when it is ready, so starting a send on one port never holds
+up the others.
 
 Notice: This is custom configured to work with the Nova Labs Matsuura with all
 it's special needs and requirements, based on how we have the machine
@@ -127,22 +186,39 @@ Curt Welch
 """
 
 import syslog
-import socket
-import select
+import asyncio
 import os
 import sys
-from typing import Optional, List
+from typing import Optional, Iterator, Dict
 import serial
 import serial.tools.list_ports
 import time
 import random
 import dotenv
 import json
+import sqlite3
 from zlib import crc32
+from send_plan import SendPlan, source_lines, gcode_lines, padded_lines, \
+    framed_lines, open_source
+from flow_control import FlowControl, make_flow_control, LOOKAHEAD_CHARS
+from gcode_motion import format_duration
+from pty_lines import PtyLines, LINES_SUFFIX
+from send_metrics import SendMetrics
+from job_queue import JobQueue
+from gcode_resume import ResumeIndex, Resume, ResumeError
+from array import array
 
 DEFAULT_SERIAL_PORT_NAME = "/dev/ttyUSB0"
+DEFAULT_MACHINE_NAME = "matsuura"   # When SERIAL_PORTS is not set
 DEFAULT_TCP_PORT = 1111
+SOCKET_BACKLOG = 64     # Pending connections, web server has many workers
+PUBLISH_INTERVAL = 0.25 # Min seconds between progress events to subscribers
+STALL_TIME = 1.0        # Seconds of CTS off while sending to report a stall
+SUBSCRIBER_MAX_BUFFER = 64 * 1024   # Drop subscribers that stop reading
 DEFAULT_UPLOAD_PATH = "/home/pi/matsuura_uploader/uploads"
+DEFAULT_FLOW_CONTROL = "fixed"      # or "adaptive", see flow_control.py
+TIMING_BLOCK = 1024     # Lines of timing read from the plan at a time
+STARVING_WAIT = 0.001   # Seconds a projected wait for a line must be
 
 BAUD = 9600     # Not meant to be changed
 
@@ -158,138 +234,223 @@ FAKE_CTS_OFF = 2.0          # Seconds
 
 class SerialSender:
     """ Matsuura SerialSender Daemon
+
+        Serves the command sockets and runs one Machine for each
+        configured serial port.
     """
     def __init__(self):
-        self.server_socket = None
-        self.read_list = []
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.unix_server: Optional[asyncio.AbstractServer] = None
 
         dotenv.load_dotenv()  # load .env but don't override environment
 
-        self.serial_port_name = \
-            os.environ.get('SERIAL_PORT_NAME', DEFAULT_SERIAL_PORT_NAME)
         self.tcp_port = int(os.environ.get('SERIAL_TCP_PORT', DEFAULT_TCP_PORT))
+        self.unix_path = os.environ.get('SERIAL_SOCKET_PATH') or None
         self.upload_path = os.environ.get('UPLOAD_PATH', DEFAULT_UPLOAD_PATH)
+        self.flow_control_name = \
+            os.environ.get('FLOW_CONTROL', DEFAULT_FLOW_CONTROL)
+        # Ports are matsuura_simulator.py ptys, for testing.
+        self.port_class = SimulatedSerialPort \
+            if os.environ.get('SERIAL_SIMULATOR') == '1' else SerialPort
+        try:
+            ports = machine_ports(
+                os.environ.get('SERIAL_PORTS', ''),
+                os.environ.get('SERIAL_PORT_NAME', DEFAULT_SERIAL_PORT_NAME))
+            make_flow_control(self.flow_control_name)
+        except ValueError as err:
+            log(f"Exit: {err}")
+            exit(1)
 
-        self.serial_port = SerialPort(self.serial_port_name)
-        self.file_to_send: Optional[FileToSend] = None
+        try:
+            self.queue = JobQueue(self.upload_path)
+        except sqlite3.Error as err:
+            log(f"Exit: Cannot open job queue in {self.upload_path}: {err}")
+            exit(1)
 
-        self.sticky_status: Optional[str] = None
+        # Clients that asked to be told about status changes.
+        self.subscribers = set()
 
-        self.last_cts = None
-        self.time_to_check_again = time.time()
+        # In the order configured, the first is used when a command
+        # does not say which machine.
+        self.machines: Dict[str, Machine] = {}
+        for name, port_name in ports.items():
+            self.machines[name] = Machine(self, name, port_name)
+        self.default_machine = next(iter(self.machines.values()))
 
         if DEBUG_FAKE_CTS:
             log(f"Using DEBUG_FAKE_CTS to turn CTS on for {FAKE_CTS_ON:.3} sec"
                 f" and off for {FAKE_CTS_OFF:.3} sec")
 
     def run(self):
-        self.prep_socket()
         # sys.stderr.write(gen_send_random_string() + '\n')
         # list_ports()
         try:
-            self.main_loop()
+            asyncio.run(self.main())
         except KeyboardInterrupt:
             log(f"KeyboardInterrupt")
         log("Exit")
 
-    def main_loop(self):
-        """ Main loop, only ends on interrupt. """
-        while True:
-            self.serial_port.check_open()
-
-            if self.serial_port.is_not_open and self.file_to_send is not None:
-                # We lost the serial port, abort the file send.
-                log(f"Lost serial port, abort sending {self.file_to_send.name}")
-                self.file_to_send: Optional[FileToSend] = None
-
-            if self.serial_port.is_open and time.time() > self.time_to_check_again:
-                self.serial_chores()
-
-            sock, mesg_from_socket = self.process_inbound_socket_connections()
-
-            if mesg_from_socket != '':
-                self.process_message(mesg_from_socket, sock)
-
-    def process_message(self, mesg_from_socket, sock):
-        # process inbound message
+    async def main(self):
+        """ Start the command server, then pace every serial port, each
+            in its own task.  Only ends on interrupt.
+        """
+        for machine in self.machines.values():
+            machine.wakeup = asyncio.Event()
+        await self.prep_socket()
+        await asyncio.gather(*[machine.serial_loop()
+                               for machine in self.machines.values()])
+
+    async def process_message(self, mesg_from_socket, writer=None) -> dict:
+        """ Process one inbound message and return the response.
+
+            If the request has an "id", the response carries the same
+            "id" so clients can have several requests outstanding on
+            one connection and match up the responses.
+        """
         if DEBUG_SOCKET:
             log(f'Message received: {mesg_from_socket!r}\n')
 
         try:
             mesg = json.loads(mesg_from_socket)
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, UnicodeError):
             log(f"Invalid json data in request: {mesg_from_socket}")
-            self.send_err(sock, "Invalid json data in request")
-            return
+            return self.err("Invalid json data in request")
+        if not isinstance(mesg, dict):
+            log(f"Invalid json data in request: {mesg_from_socket}")
+            return self.err("Invalid json data in request")
 
+        response = await self.process_command(mesg, writer)
+        if "id" in mesg:
+            response["id"] = mesg["id"]
+        return response
+
+    async def process_command(self, mesg: dict, writer=None) -> dict:
         command = mesg.get("cmd")
         if command is None:
-            self.send_err(sock, "Missing 'cmd' label in request")
+            return self.err("Missing 'cmd' label in request")
+
+        elif command == "subscribe":
+            # From now on this connection also gets an event line
+            # each time the status of any machine changes.
+            if writer is None:
+                return self.err("Can't subscribe on this connection")
+            self.subscribers.add(writer)
+            # Make sure the new subscriber gets the current status.
+            for machine in self.machines.values():
+                machine.last_published = None
+                machine.last_publish_time = 0.0
+                machine.wakeup.set()
+            return self.ok("Subscribed")
+
+        elif command == "machines":
+            return self.ok("Machines", machines=[
+                {"machine": machine.name,
+                 "port": machine.serial_port.port_name,
+                 "status": machine.status_message()}
+                for machine in self.machines.values()])
+
+        elif command in ("cancel", "move"):
+            # Jobs are known by their number whatever machine they are for.
+            job_id = mesg.get("job")
+            if not isinstance(job_id, int):
+                return self.err(f"Missing 'job' number in {command} request.")
+            if command == "cancel":
+                job = self.queue.remove(job_id)
+            else:
+                position = mesg.get("position")
+                if not isinstance(position, int):
+                    return self.err("Missing 'position' in move request.")
+                job = self.queue.move(job_id, position)
+            if job is None:
+                return self.err(f"No job {job_id} in the queue")
+            machine = self.machines.get(job["machine"])
+            if machine is not None:
+                machine.publish("status")
+            what = "Cancelled" if command == "cancel" else "Moved"
+            return self.ok(f"{what} {job['file']}", job=job,
+                           queue=self.queue.jobs(job["machine"]))
+
+        machine = self.machines.get(mesg.get("machine") or
+                                    self.default_machine.name)
+        if machine is None:
+            return self.err(f"Unknown machine {mesg.get('machine')!r}")
+
+        if command == "resume":
+            file = mesg.get("file")
+            line = mesg.get("line")
+            if file is None or not isinstance(line, int):
+                return self.err("Missing 'file' or 'line' in resume request.")
+            safe = mesg.get("safe")
+            machine.sticky_status: Optional[str] = None
+            return await machine.serial_start_send(file, line,
+                                                   safe is None or bool(safe))
 
         elif command == "start":
             file = mesg.get("file")
+            machine.sticky_status: Optional[str] = None
             if file is None:
-                self.send_err(sock, "Missing 'file' label in start request.")
-            else:
-                self.sticky_status: Optional[str] = None
-                self.serial_start_send(sock, file)
+                # Start the next job in the queue.
+                job = self.queue.next_job(machine.name)
+                if job is None:
+                    return self.err("Missing 'file' label in start request,"
+                                    " and nothing queued.")
+                return await machine.start_job(job)
+            return await machine.serial_start_send(file)
+
+        elif command == "enqueue":
+            file = mesg.get("file")
+            if file is None:
+                return self.err("Missing 'file' label in enqueue request.")
+            return await machine.enqueue(file, bool(mesg.get("auto")))
+
+        elif command == "queue":
+            jobs = self.queue.jobs(machine.name)
+            return self.ok(f"{len(jobs)} queued", machine=machine.name,
+                           queue=jobs)
 
         elif command == "stop":
-            if self.file_to_send is not None:
-                file_name = self.file_to_send.name
-                # log(f"Closing file: {file_name}")
-                self.file_to_send: Optional[FileToSend] = None
-                self.sticky_status = f"Stopped: {file_name}"
-                self.send_ok(sock, self.sticky_status)
-                self.serial_port.drain()
-            else:
-                self.sticky_status: Optional[str] = None
-                self.send_err(sock, "Already stopped")
+            return machine.stop_send()
 
         elif command == "status":
-            m = "Idle"
-            if self.sticky_status:
-                # This is a saved status that needs to hang around
-                # to be sure the user sees it on the next web page
-                # update.  Really useful for "file sent" but also used
-                # to make other messages sticky.
-                m = self.sticky_status
-
-            if self.serial_port.is_not_open:
-                m = f"Cannot open serial port: {self.serial_port.port_name}"
-            elif self.file_to_send is not None:
-                m = self.file_to_send.status
-
-            self.send_ok(sock, m)
-        else:
-            self.send_err(sock, "Unknown command")
+            return self.ok(machine.status_message(), machine=machine.name,
+                           queued=self.queue.depth(machine.name))
 
-    def send_ok(self, sock, message):
-        self.send_response(sock, 0, message)
+        elif command == "metrics":
+            return self.ok("Metrics", machine=machine.name,
+                           metrics=machine.metrics.snapshot())
+        else:
+            return self.err("Unknown command")
+
+    def publish(self, event: dict):
+        """ Send an event line to all subscribers. """
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > SUBSCRIBER_MAX_BUFFER:
+                # Not reading its events.  Cut it loose.
+                log("Dropping subscriber that stopped reading")
+                self.subscribers.discard(writer)
+                writer.close()
+                continue
+            self.send_response(writer, event)
 
-    def send_err(self, sock, message):
-        self.send_response(sock, 1, message)
+    @staticmethod
+    def ok(message, **extra) -> dict:
+        return {"error": 0, "message": message, **extra}
 
     @staticmethod
-    def send_response(sock, error, message):
-        response = json.dumps({"error": error, "message": message})
-        if DEBUG_SOCKET:
-            log(f"Response to client: {response!r}")
-        sock.send(response.encode("utf-8"))
+    def err(message, **extra) -> dict:
+        return {"error": 1, "message": message, **extra}
 
-    def prep_socket(self):
-        """ Called once to prepare the primary tcp listener socket.
+    async def prep_socket(self):
+        """ Called once to start the tcp command server, and the Unix
+            socket server if SERIAL_SOCKET_PATH is set.
             exit(1) on error.
         """
         try:
-            self.server_socket = socket.socket(socket.AF_INET,
-                                               socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET,
-                                          socket.SO_REUSEADDR, 1)
             # log(f"port is {self.tcp_port}")
             # self.tcp_port = 1111999 # force port error for testing
-            self.server_socket.bind(('', self.tcp_port))
-            self.server_socket.listen(1)
+            self.server = await asyncio.start_server(self.handle_client,
+                                                     port=self.tcp_port,
+                                                     backlog=SOCKET_BACKLOG)
         except OSError as err:
             log(f"Exit: Cannot open TCP port: ({err}")
             exit(1)
@@ -300,11 +461,127 @@ class SerialSender:
             exit(1)
         log(f"Listening on TCP port {self.tcp_port}")
 
-        self.read_list = [self.server_socket]  # read list is the list of tcp ports
+        if self.unix_path:
+            try:
+                if os.path.exists(self.unix_path):
+                    os.unlink(self.unix_path)   # Left over from last run
+                self.unix_server = await asyncio.start_unix_server(
+                    self.handle_client, path=self.unix_path,
+                    backlog=SOCKET_BACKLOG)
+            except OSError as err:
+                log(f"Exit: Cannot open Unix socket {self.unix_path}: ({err}")
+                exit(1)
+            log(f"Listening on Unix socket {self.unix_path}")
+
+    async def handle_client(self, reader, writer):
+        """ Serve one client connection until it closes.
+
+            Requests and responses are each one line of json, ending
+            in a newline, so messages are never split or run together
+            no matter how the network delivers them.
+        """
+        if DEBUG_SOCKET:
+            address = writer.get_extra_info('peername')
+            log(f"Connection from: {address}")
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Line longer than the stream buffer limit.
+                    self.send_response(writer, self.err("Request too long"))
+                    break
+                if not line:
+                    # connection must have shut down
+                    # log("Disconnecting from client")
+                    break
+                if not line.strip():
+                    continue
+                self.send_response(writer,
+                                   await self.process_message(line, writer))
+                await writer.drain()
+        except OSError:
+            log("Error: socket reset")
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    @staticmethod
+    def send_response(writer, response: dict):
+        response = json.dumps(response)
+        if DEBUG_SOCKET:
+            log(f"Response to client: {response!r}")
+        writer.write(response.encode("utf-8") + b"\n")
+
+
+class Machine:
+    """ One machine on one serial port.
+
+        Has its own file being sent, flow control, stall watch, status
+        and metrics, and paces its port in its own task (serial_loop()),
+        so a machine holding CTS off or a long wait for the next write
+        on one port never delays the writes to another.
+    """
+    def __init__(self, sender: SerialSender, name: str, port_name: str):
+        self.sender = sender
+        self.name = name                # e.g. "matsuura"
+        self.wakeup: Optional[asyncio.Event] = None
+
+        self.flow: FlowControl = make_flow_control(sender.flow_control_name)
+        log(f"{self.name}: using {self.flow.name} flow control"
+            f" on {port_name}")
+
+        self.serial_port = sender.port_class(port_name)
+        self.file_to_send: Optional[FileToSend] = None
+        self.starting: Optional[str] = None     # File being opened to send
+        self.start_stopped = False              # Stop came while starting
+
+        self.sticky_status: Optional[str] = None
+
+        self.last_cts = None
+        self.time_to_check_again = time.time()
+
+        self.last_published: Optional[str] = None
+        self.last_publish_time = 0.0
+        self.cts_off_since: Optional[float] = None
+        self.stall_reported = False
+
+        self.metrics = SendMetrics()
+
+    async def serial_loop(self):
+        """ Serial pacing task.
+
+            Runs on its own so client connections, however many, and
+            the other machines are handled while we sleep until the
+            next write is due.
+        """
+        while True:
+            self.serial_port.check_open()
 
-    def process_inbound_socket_connections(self):
-        """ select() returns all the connections and their statuses """
+            if self.serial_port.is_not_open and self.file_to_send is not None:
+                # We lost the serial port, abort the file send.
+                log(f"{self.name}: lost serial port, sent to line"
+                    f" {self.sent_to_line()},"
+                    f" abort sending {self.file_to_send.name}")
+                self.file_to_send.close()
+                self.file_to_send: Optional[FileToSend] = None
+                self.publish("error")
 
+            now = time.time()
+            if self.serial_port.is_open and now > self.time_to_check_again:
+                if self.file_to_send is not None:
+                    self.metrics.loop_woke(self.time_to_check_again, now)
+                self.serial_chores()
+
+            if self.sender.subscribers:
+                self.publish_changes()
+
+            await self.sleep_until_needed()
+
+    async def sleep_until_needed(self):
+        """ Sleep until it's time to check the serial port again, or
+            until a command (like start) wakes us up.
+        """
         timeout = 1.0  # check status of serial every second
         now = time.time()
         if self.serial_port.is_open and self.file_to_send is not None:
@@ -316,63 +593,251 @@ class SerialSender:
         if timeout > 1.0:
             timeout = 1.0
 
-        # log(f"select with timeout of {timeout:.6f} now:{now:.3f} check_again:{self.time_to_check_again:.2f}")
-        readable, writable, errored = \
-            select.select(self.read_list, [], [], timeout)
-
-        for s in readable:
-            # for anything inbound...
-            if s is self.server_socket:
-                # new connections will appear on server_socket
-                client_socket, address = self.server_socket.accept()
-                self.read_list.append(client_socket)    # put it on our read_list
-                if DEBUG_SOCKET:
-                    log("Connection from: %s:%s\n" % (address[0], address[1]))
-            else:
-                # handle messages from client connections
-                data_buf = b''
-                try:
-                    data_buf = s.recv(1024)
-                except OSError:
-                    log("Error: socket reset")
-
-                if data_buf:
-                    # extract message.
-                    try:
-                        mesg = data_buf.decode('utf-8')  # attempt to convert
-                    except UnicodeError:
-                        return [s, data_buf]       # send raw if unable
-                    return [s, mesg.rstrip()]   # otherwise send utf-8 version
-                else:
-                    # otherwise connection must have shut down
-                    # log("Disconnecting from client")
-                    self.read_list.remove(s)
-                    s.close()
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def status_message(self) -> str:
+        """ Text description of what we are doing for the status command. """
+        m = "Idle"
+        if self.sticky_status:
+            # This is a saved status that needs to hang around
+            # to be sure the user sees it on the next web page
+            # update.  Really useful for "file sent" but also used
+            # to make other messages sticky.
+            m = self.sticky_status
 
-        return ['', '']  # if select() returns w/nothing readable return empty
+        if self.serial_port.is_not_open:
+            m = f"Cannot open serial port: {self.serial_port.port_name}"
+        elif self.file_to_send is not None:
+            m = self.file_to_send.status
+        elif self.starting is not None:
+            m = f"Starting {self.starting}"
+        queued = self.sender.queue.depth(self.name)
+        if queued:
+            m += f", {queued} queued"
+        return m
+
+    def publish(self, event: str, message: Optional[str] = None):
+        """ Send an event line about this machine to all subscribers.
+
+            event is one of "status", "started", "stopped", "sent",
+            "stall" or "error".  The message is the current status
+            unless given.
+        """
+        if message is None:
+            message = self.status_message()
+        self.last_published = message
+        self.last_publish_time = time.time()
+        if not self.sender.subscribers:
+            return
+        error = 1 if event in ("error", "stall") else 0
+        self.sender.publish({"event": event, "machine": self.name,
+                             "error": error, "message": message})
+
+    def publish_changes(self):
+        """ Publish the status if it changed, but not too often. """
+        if time.time() - self.last_publish_time < PUBLISH_INTERVAL:
+            return
+        message = self.status_message()
+        if message != self.last_published:
+            self.publish("status", message)
+
+    async def serial_start_send(self, filename, line: Optional[int] = None,
+                                safe: bool = True) -> dict:
+        """ open file and start sending on serial port
+
+            With line, restart part way through, from the last restart-safe
+            point at or before that line in the file, or if not safe from
+            that line itself.  See gcode_resume.py.
 
-    def serial_start_send(self, sock, filename):
-        """ open file and start sending on serial port """
+            The file is opened by open_send() in a thread, meanwhile this
+            machine is "Starting" and every other machine carries on.
+        """
+        ok, err = self.sender.ok, self.sender.err
 
         if self.file_to_send is not None:
-            self.send_err(sock, f"Already Busy Sending {self.file_to_send.name}")
-            return
+            return err(f"Already Busy Sending {self.file_to_send.name}")
+        if self.starting is not None:
+            return err(f"Already Busy Sending {self.starting}")
 
         if self.serial_port.is_not_open:
-            self.send_err(sock, f"Can't send, serial port problem. Check cable.")
-            return
+            return err(f"Can't send, serial port problem. Check cable.")
 
-        file_with_path = os.path.join(self.upload_path, filename)
+        self.starting = filename
+        self.start_stopped = False
+        self.publish("status")
         try:
-            self.file_to_send = FileToSend(file_with_path)
+            file_to_send = await asyncio.get_event_loop().run_in_executor(
+                None, self.open_send, filename, line, safe)
+        except ResumeError as e:
+            return err(str(e))
         except OSError:
-            self.file_to_send: Optional[serial.Serial] = None
-            self.send_err(sock, f"Cannot open {filename!r}")
-            return
+            return err(f"Cannot open {filename!r}")
+        finally:
+            self.starting = None
+        if self.start_stopped:
+            file_to_send.close()
+            return err(f"Stopped: {filename}")
+        self.file_to_send = file_to_send
+        if not file_to_send.counted:
+            self.count_lines(file_to_send)
+        plan, resume = file_to_send.plan, file_to_send.resume
+
+        # Start each file with fresh flow control measurements.
+        self.flow = make_flow_control(self.sender.flow_control_name)
+        self.cts_off_since = None
+        self.stall_reported = False
+        self.metrics.started()
+        # Get the serial loop going now, not on its next check.
+        self.wakeup.set()
+        self.publish("started")
+
+        extra = {"machine": self.name}
+        label = f"{self.name}: {filename}"
+        timing = self.file_to_send.timing
+        if timing is not None:
+            log_timing(label, timing.summary)
+            extra["timing"] = timing.summary
+        if plan is not None and plan.compaction is not None:
+            log_compaction(label, plan.compaction)
+            extra["compaction"] = plan.compaction
+        if plan is not None and plan.arcs is not None:
+            log_arcs(label, plan.arcs)
+            extra["arcs"] = plan.arcs
+        if resume is not None:
+            extra["resume"] = {"line": resume.file_line, "kind": resume.kind,
+                               "preamble": resume.preamble}
 
         # Note: "Sending" is the keyword the web server looks for to
         # set fast updates while sending (case is not important).
-        self.send_ok(sock, self.file_to_send.status)
+        return ok(self.file_to_send.status, **extra)
+
+    def open_send(self, filename: str, line: Optional[int],
+                  safe: bool) -> "FileToSend":
+        """ Load the plan, and the resume index for a restart at line,
+            and open the file to send.  Reads files, so is run in a
+            thread, see serial_start_send().
+            Raises ResumeError if it can't restart there, OSError if the
+            file can't be opened.
+        """
+        file_with_path = os.path.join(self.sender.upload_path, filename)
+        resume = None
+        plan = SendPlan.load(file_with_path)
+        if plan is None:
+            if line is not None:
+                raise ResumeError(f"Can't restart {filename}, it has no"
+                                  f" send plan yet")
+            log(f"{self.name}: no current send plan for {filename},"
+                f" reading file")
+        elif line is not None:
+            index = ResumeIndex.load(file_with_path, plan)
+            if index is None:
+                raise ResumeError(f"Can't restart {filename} until its"
+                                  f" preflight is done")
+            resume = index.resume(plan, line, safe)
+            log(f"{self.name}: restart {filename} at line"
+                f" {resume.file_line} ({resume.kind}), preamble"
+                f" {' / '.join(resume.preamble)}")
+        return FileToSend(file_with_path, plan=plan, resume=resume)
+
+    def count_lines(self, file_to_send: "FileToSend") -> None:
+        """ Have file_to_send count its lines in a thread, so neither this
+            machine's send nor any other machine waits on reading the
+            whole file.
+        """
+        def counted(future):
+            err = future.exception()
+            if err is not None:
+                log(f"{self.name}: can't count the lines of"
+                    f" {file_to_send.name}: {err}")
+
+        asyncio.get_event_loop().run_in_executor(
+            None, file_to_send.count_lines).add_done_callback(counted)
+
+    async def enqueue(self, filename: str, auto: bool) -> dict:
+        """ Add a file to the end of our queue.  If auto, and nothing is
+            being sent or queued before it, it is started now.
+        """
+        if not os.path.isfile(os.path.join(self.sender.upload_path, filename)):
+            return self.sender.err(f"Cannot open {filename!r}")
+        job = self.sender.queue.add(self.name, filename, auto)
+        log(f"{self.name}: queued job {job['job']} {filename}"
+            f"{' to start when ready' if auto else ''}")
+        if auto and self.file_to_send is None and \
+                self.sender.queue.next_job(self.name) == job:
+            self.sticky_status: Optional[str] = None
+            return await self.start_job(job)
+        self.publish("status")
+        return self.sender.ok(f"Queued {filename}", machine=self.name,
+                              job=job, queue=self.sender.queue.jobs(self.name))
+
+    async def start_job(self, job: dict) -> dict:
+        """ Start sending a job from the queue.  It leaves the queue if
+            it starts.
+        """
+        response = await self.serial_start_send(job["file"])
+        if not response["error"]:
+            self.sender.queue.remove(job["job"])
+        response["job"] = job
+        return response
+
+    def advance_queue(self):
+        """ A send has just finished without error.  Start the next job
+            if it was queued to start by itself, in a task of its own.
+        """
+        job = self.sender.queue.next_job(self.name)
+        if job is None or not job["auto"]:
+            return
+        asyncio.ensure_future(self.start_queued(job))
+
+    async def start_queued(self, job: dict):
+        if self.file_to_send is not None or self.starting is not None:
+            return  # Started by hand since, the job waits its turn
+        response = await self.start_job(job)
+        if response["error"]:
+            log(f"{self.name}: can't start queued job {job['job']}"
+                f" {job['file']}: {response['message']}")
+            self.sticky_status = f"Queue stopped: {response['message']}"
+            self.publish("error")
+
+    def stop_send(self) -> dict:
+        """ Abort the file being sent, if any. """
+        if self.file_to_send is None and self.starting is not None:
+            # It is dropped when it has been opened.
+            self.start_stopped = True
+            self.sticky_status = f"Stopped: {self.starting}"
+            self.publish("stopped")
+            return self.sender.ok(self.sticky_status, machine=self.name,
+                                  line=None)
+        if self.file_to_send is not None:
+            file_name = self.file_to_send.name
+            line = self.sent_to_line()
+            # log(f"Closing file: {file_name}")
+            self.file_to_send.close()
+            self.file_to_send: Optional[FileToSend] = None
+            self.sticky_status = f"Stopped: {file_name}"
+            if line is not None:
+                self.sticky_status += f", sent to line {line}"
+            self.serial_port.drain()
+            self.publish("stopped")
+            return self.sender.ok(self.sticky_status, machine=self.name,
+                                  line=line)
+        else:
+            self.sticky_status: Optional[str] = None
+            return self.sender.err("Already stopped", machine=self.name)
+
+    def sent_to_line(self) -> Optional[int]:
+        """ The line in the file of the last line sent, if any.  The
+            machine has not got that far yet, the serial buffers hold
+            some.  Restart from a safe point before it.
+        """
+        try:
+            return self.file_to_send.sent_file_line()
+        except OSError:
+            return None
 
     def serial_chores(self):
         """
@@ -388,6 +853,7 @@ class SerialSender:
             if self.file_to_send is not None:
                 msg += f" out_waiting: {self.serial_port.out_waiting:<3} "
                 msg += f" {self.file_to_send.status}"
+                msg += f" {self.flow.status}"
 
             if cts != self.last_cts:
                 self.last_cts = cts
@@ -398,65 +864,127 @@ class SerialSender:
 
         if self.file_to_send.eof:
             # No need to try reading.
-            log(f"EOF: {self.file_to_send.status}")
+            log(f"{self.name}: EOF: {self.file_to_send.status}")
             self.sticky_status = self.file_to_send.status
+            sent_ok = not self.file_to_send.crc_mismatch
             self.file_to_send: Optional[FileToSend] = None
+            self.metrics.finished()
+            self.publish("sent")
+            if sent_ok:
+                self.advance_queue()
             return
 
-        if self.serial_port.out_waiting == 0 and self.serial_port.cts:
-            line_from_file = self.file_to_send.read_line(max_size=50)
-            # NOTE: max_size controls the size of chunks we write
-            # to the RS-232 port since what we read here gets written
-            # in one write below. To keep the OS buffers from filling
-            # up (we try to keep them empty), we must not write more
-            # (on average) than what the Matsuura will typically read
-            # on a single RTS flow control on/off cycle, which has to
-            # do with how large the G-code blocks (lines) are, and how
-            # fast they re being performed.  Larger values help us run
-            # faster, but too large and we just start to back up the
-            # OS buffers which leads to great user confusion and problems
-            # even if it doesn't create run errors.
-            # You have been warned.
-            if line_from_file is None:
-                # Should never happen because we checked for eof above.
-                log(f"serial_chores(): should never happen: read_line returns None")
-                # Just return and handle it above on next call.
-                return
-
-            line_from_file_as_bytes = line_from_file.encode('utf-8')
-            # log("UNPLUG NOW sleep(2) then will try write")
-            # time.sleep(2)
-            # Note, write() can cause port to close and return None if
-            # the RS-232 USB adaptor is disconnected.
-            bytes_sent = self.serial_port.write(line_from_file_as_bytes)
-            if DEBUG_SEND:
-                # bytes_sent -= 1   # Debug to force error log below
-                if bytes_sent:
-                    if bytes_sent == len(line_from_file_as_bytes):
-                        log(f"SEND: {len(line_from_file_as_bytes):3} {line_from_file!r}")
-                    else:
-                        # Should never happen unless we have a worse error
-                        # that will be caught elsewhere so I'm not going to
-                        # cope with this.
-                        log(f"SEND ERROR unexpected SHORT WRITE: {bytes_sent}"
-                            f" of {len(line_from_file_as_bytes)}"
-                            f" {line_from_file!r}")
-            if bytes_sent:
-                # Don't try to send more until these bytes have had time
-                # to be sent. (9600 baud is 960 characters per second)
-                # 1 stop bit, 8 data, 1 stop so 10 bits per character sent.
-                self.time_to_check_again = time.time() + (bytes_sent - 1) / (BAUD/10)
+        now = time.time()
+        out_waiting = self.serial_port.out_waiting
+        self.flow.observe(cts, out_waiting, now)
+        self.metrics.observe(cts, out_waiting, now)
+
+        self.check_stall(cts, now)
+
+        if self.file_to_send.timing is not None:
+            self.flow.ahead(self.file_to_send.starving_ahead(LOOKAHEAD_CHARS))
+
+        if not self.flow.ready(cts, out_waiting):
+            self.time_to_check_again = self.flow.idle(cts, out_waiting, now)
+            return
 
-            # log(f"    chore done cts: {cts!s:<5}"
-            #     f" out_waiting: {self.serial_port.out_waiting:<3} "
-            #     f" {self.file_to_send.status}"
-            #     )
+        if self.flow.link_bound:
+            # The machine will take all we can send, fewer bigger writes
+            # keep the line busy with less waking up.
+            line_from_file = self.file_to_send.read_lines(
+                max_size=self.flow.chunk_size)
+        else:
+            line_from_file = self.file_to_send.read_line(
+                max_size=self.flow.chunk_size)
+        # NOTE: max_size controls the size of chunks we write
+        # to the RS-232 port since what we read here gets written
+        # in one write below. To keep the OS buffers from filling
+        # up (we try to keep them empty), we must not write more
+        # (on average) than what the Matsuura will typically read
+        # on a single RTS flow control on/off cycle, which has to
+        # do with how large the G-code blocks (lines) are, and how
+        # fast they re being performed.  Larger values help us run
+        # faster, but too large and we just start to back up the
+        # OS buffers which leads to great user confusion and problems
+        # even if it doesn't create run errors.
+        # You have been warned.
+        # The flow control policy (see flow_control.py) picks the
+        # size, either fixed at 50, or adapted to what the Matsuura
+        # has been taking on each CTS on period.
+        if line_from_file is None:
+            # Should never happen because we checked for eof above.
+            log(f"{self.name}: serial_chores(): should never happen:"
+                f" read_line returns None")
+            # Just return and handle it above on next call.
+            return
+
+        line_from_file_as_bytes = line_from_file.encode('utf-8')
+        # log("UNPLUG NOW sleep(2) then will try write")
+        # time.sleep(2)
+        # Note, write() can cause port to close and return None if
+        # the RS-232 USB adaptor is disconnected.
+        bytes_sent = self.serial_port.write(line_from_file_as_bytes)
+        if DEBUG_SEND:
+            # bytes_sent -= 1   # Debug to force error log below
+            if bytes_sent:
+                if bytes_sent == len(line_from_file_as_bytes):
+                    log(f"SEND: {len(line_from_file_as_bytes):3} {line_from_file!r}")
+                else:
+                    # Should never happen unless we have a worse error
+                    # that will be caught elsewhere so I'm not going to
+                    # cope with this.
+                    log(f"SEND ERROR unexpected SHORT WRITE: {bytes_sent}"
+                        f" of {len(line_from_file_as_bytes)}"
+                        f" {line_from_file!r}")
+        if bytes_sent:
+            # Don't try to send more until these bytes have had time
+            # to be sent.  The flow control policy knows how long.
+            now = time.time()
+            self.time_to_check_again = self.flow.wrote(bytes_sent, now)
+            self.metrics.wrote(bytes_sent, now, self.time_to_check_again)
+
+        # log(f"    chore done cts: {cts!s:<5}"
+        #     f" out_waiting: {self.serial_port.out_waiting:<3} "
+        #     f" {self.file_to_send.status}"
+        #     )
+
+
+    def check_stall(self, cts: bool, now: float):
+        """ Tell subscribers when the Matsuura has held CTS off a while. """
+        if cts:
+            self.cts_off_since = None
+            if self.stall_reported:
+                self.stall_reported = False
+                self.publish("status")
+            return
+        if self.cts_off_since is None:
+            self.cts_off_since = now
+        elif not self.stall_reported and now - self.cts_off_since > STALL_TIME:
+            self.stall_reported = True
+            self.publish("stall", f"{self.status_message()}"
+                                  f" (machine not reading, CTS off)")
 
 
 class FileToSend:
     """" File To Send to Matsuura.
 
-        Reads entire file into memory.
+        Streams the file from disk, cleaning it up a line at a time as it
+        is sent, so memory use and start up time do not grow with the
+        size of the file.  Only a compact index of where each G-code line
+        starts in the file is kept in memory.  It is made by count_lines(),
+        which reads the whole file, so is run in a thread while the send
+        goes on; until it is done the number of lines is not known.
+
+        If given a current SendPlan (see send_plan.py) made when the file
+        was uploaded, the cleaned up lines are read from the plan and
+        the file is not read at all.  A compacted or arc fitted plan (see
+        Compaction in send_plan.py and gcode_arcs.py) is sent as it is.
+        Without a plan there is neither, they take too long to do before
+        the send starts.
+
+        With a Resume (see gcode_resume.py) as well, sends the leader line,
+        the resume preamble, then the plan from the restart line on.
+
         Fixes issues to prep for sending.
         Strips training spaces and \r and \n then adds \r\n at end.
         Ignores/removes blank lines.
@@ -475,17 +1003,49 @@ class FileToSend:
         Looks for % end marker and ignores rest of file.
         Adds % to end of last line to signal end of code.
     """
-    def __init__(self, file_name):
-        """ Reads and cleans up entire file into memory on creation.
+    def __init__(self, file_name, plan: Optional[SendPlan] = None,
+                 resume: Optional[Resume] = None):
+        """ Opens the file, or the plan, but does not read it.
+            resume needs a plan.
             Raises OSError on file open error. """
 
         self.file_name = file_name      # Full name with path
-        self.line_buf: List[str] = []   # Lines of file with \r\n on each.
+        self.plan = plan                # Precompiled plan or None
+        self.resume = resume            # Where to restart from, or None
+        self._line_skew = 0             # Plan line less line sent
+        self.file_lines = array('I')    # Line in the file of each G-code
+                                        # line, when there is no plan
+        self._resume_index: Optional[ResumeIndex] = None
+        self.line_count = 0             # Total lines to send
+        self.counted = True             # False until line_count is known
+        self._source = None             # The open file, when no plan
         self.lines_sent = 0             # Index of next line to send
         self.read_buffer = ""           # Chars waiting to be sent
         self.crc32_value = 0            # CRC32 check of data to be sent
-
-        self._read_file()
+        self._line_iter: Optional[Iterator[str]] = None
+        self.timing = None              # plan.timing, if it has any
+        self._timing_start = 0          # First line in _timing
+        self._timing = (array('I'), array('f'), array('d'))
+        self._total_seconds = 0.0       # Projected finish of the last line
+
+        if self.plan is not None:
+            self.line_count = self.plan.lines
+            self.timing = self.plan.timing
+            # Open it now, it may be replaced while we send.
+            if self.resume is None:
+                self._line_iter = self.plan.open_lines()
+            else:
+                preamble = self.resume.preamble_lines()
+                self._line_skew = self.resume.line - 1 - len(preamble)
+                self.line_count -= self._line_skew
+                self._line_iter = self._resumed_lines(
+                    preamble, self.plan.open_lines(self.resume.line))
+        else:
+            self._source = open_source(self.file_name)
+            self._line_iter = self._file_lines(self._source)
+            self.counted = False
+        if self.timing is not None:
+            self._total_seconds = self.timing.summary["drip_feed_seconds"]
 
     @property
     def name(self):
@@ -495,109 +1055,215 @@ class FileToSend:
     @property
     def lines(self) -> int:
         """ Total number of lines from file to be sent. """
-        return len(self.line_buf)
+        return self.line_count
+
+    @property
+    def label(self) -> str:
+        """ name, and where it restarted from if it did. """
+        if self.resume is None:
+            return self.name
+        return f"{self.name} from line {self.resume.file_line}"
 
     @property
     def percent_sent(self) -> int:
-        """ Percent line_buf sent (0 to 100) """
+        """ Percent of lines sent (0 to 100), 0 until they are counted """
+        if not self.counted:
+            return 0
         return int(self.lines_sent * 100 / self.lines)
 
     @property
     def eof(self) -> bool:
-        return self.lines_sent >= len(self.line_buf) and self.read_buffer == ""
+        return self.counted and self.lines_sent >= self.lines and \
+            self.read_buffer == ""
 
     @property
     def status(self):
         """ e.g. "Sending 1001.nc, Line 89/234 38%" """
         # Note: "Sending" is the keyword the web server looks for to
         # set fast updates while sending (case not important).
-        status = f"Sending {self.name}, Line {self.lines_sent}/{self.lines} " \
+        status = f"Sending {self.label}, Line {self.lines_sent}/{self.lines} " \
                  f"{self.percent_sent}%"
-        if self.lines_sent >= self.lines:
-            status = f"Sent: {self.name}," \
+        if not self.counted:
+            status = f"Sending {self.label}, Line {self.lines_sent}"
+        seconds_left = self.seconds_left
+        if seconds_left is not None:
+            status += f", about {format_duration(seconds_left)} left"
+        if self.counted and self.lines_sent >= self.lines:
+            status = f"Sent: {self.label}," \
                     f" {self.lines} lines, 100%, crc: {self.crc32_value:08X}"
+            if self.crc_mismatch:
+                status += f" CRC MISMATCH, upload crc: {self.plan.crc32_value:08X}"
         return status
 
-    def _read_file(self) -> None:
-        """ Read file into memory.
-
-            Builds the list of line_buf to transmit (without \r or \n) and makes
-            sure it starts with a blank line and ends with the needed % marker.
-
-            Only reads up to the % End-of-code marker and skips a beginning
-            % if there is one.
+    @property
+    def crc_mismatch(self) -> bool:
+        """ True if what we sent does not match the plan made at upload.
+            A restart sends something else, so is never checked.
+        """
+        return (self.plan is not None and self.resume is None and self.eof
+                and self.crc32_value != self.plan.crc32_value)
 
-            open() will throw OSError exception
+    @property
+    def seconds_left(self) -> Optional[float]:
+        """ Projected drip feed time until the last line has run, or None
+            if we don't know.  Worked out from the line being sent.
         """
+        if self.timing is None or self.lines_sent == 0:
+            return None
+        done = self._line_timing(self.lines_sent - 1)
+        if done is None:
+            return None
+        return max(0.0, self._total_seconds - done[2])
 
-        self.line_buf = []
+    def starving_ahead(self, max_chars: int) -> bool:
+        """ True if the machine is projected to sit waiting on the line
+            for any of the next max_chars or so of lines.
+        """
+        chars = len(self.read_buffer)
+        line = self.lines_sent
+        before = self._line_timing(line - 1) if line else None
+        while chars < max_chars:
+            timing = self._line_timing(line)
+            if timing is None:
+                break
+            chars_in_line, seconds, finish = timing
+            if before is not None and \
+                    finish - seconds - before[2] > STARVING_WAIT:
+                return True
+            chars += chars_in_line
+            before = timing
+            line += 1
+        return False
 
-        saw_start_percent = False
-        with open(self.file_name) as fd:
-            while True:
-                line = fd.readline()
-                if line == "":  # EOF
-                    break
-                line = line.rstrip().upper()    # Strip \n, spaces, make upper
-                if len(self.line_buf) == 0:
-                    if line == "":
-                        # skip all initial blank line_buf.
-                        continue
-                    if not saw_start_percent and line[0] == "%":
-                        # We treat an initial '%' as a G code start of code
-                        # marker but we can not send it because the Matsuura
-                        # will treat it as an end of code marker and stop
-                        # reading. So we strip it, but we only strip one. The
-                        # next one we see is the end of code marker.
-                        saw_start_percent = True
-                        continue
-                if line == "":
-                    # Strip all blank lines.
-                    continue
-                # We have a non blank line
-                if line[0] == "%":  # end of code marker
-                    break
-                while len(line) < 3:
-                    # Short lines like "M06\n" (4 chars) seemed to have been
-                    # a key part of the Matsuura RS-232 Over-run Alarm so
-                    # I'm going to just pad all short lines with spaces
-                    # to make sure "M6" becomes "M6 " as well
-                    # as adding \r\n instead of just \n.
-                    line += ' '
-                line += '\r\n'  # Put CR LF on every line
-                self.line_buf.append(line)
-
-        # End of file.
-
-        # Add a % to the end of the line buffer.
-        #
-        # Because there is a really odd bug here we add it to the end of the
-        # last line so it gets sent at the same time the last line is sent. The
-        # bug is if we are drip feeding slowly, and the M30 stop
-        # command at the end of the file gets executed before
-        # the Matsuura reads the %, then the Matsuura stops reading.
-        # So CTS will never go low and we will be hung waiting
-        # for the Matsuura to ask for more data so we can send the % to tell it
-        # there is nothing more to send!  In drip feed (TAPE) mode,
-        # we could imply never bother to send the %. But when sending to load a
-        # program into memory, the % is required.  Since we don't know if we
-        # are drip feeding or loading into memory, we must send the %.  So the
-        # simple hack I choose to use here, is to send it as part of the last
-        # line of the file.
-
-        # We do not add a CR or LF after the %.
-
-        if len(self.line_buf) == 0:
-            # There is no last line to add it to!
-            self.line_buf.append("%")
-        else:
-            self.line_buf[-1] += "%"
+    def _line_timing(self, line: int):
+        """ (chars, seconds, finish) for one line, or None.  Read from
+            the timing file TIMING_BLOCK lines at a time.  line is a line
+            sent, not a plan line, they differ on a restart.
+        """
+        if line >= self.lines:
+            return None
+        line += self._line_skew
+        if self.resume is not None and line < self.resume.line:
+            return None     # The leader or the preamble
+        index = line - self._timing_start
+        if not 0 <= index < len(self._timing[0]):
+            try:
+                self._timing = self.timing.read(line, TIMING_BLOCK)
+            except OSError:
+                # Gone or replaced since we started, carry on without it.
+                self.timing = None
+                return None
+            self._timing_start = line
+            index = 0
+        return (self._timing[0][index], self._timing[1][index],
+                self._timing[2][index])
+
+    def count_lines(self) -> None:
+        """ Make one pass over the file to find the G-code lines, when
+            there is no plan.
+
+            Records where each line to be sent starts in the file, and
+            then how many lines there are, without keeping the lines.
+            Reads the whole file, so is run in a thread, not on the event
+            loop, while the send goes on.  Stops if the send is closed.
+
+            Raises OSError on error.
+        """
+        if self.counted:
+            return
+        numbered = [0]      # Line number of the last line read
+
+        def numbered_lines(source):
+            for numbered[0], line in enumerate(source, 1):
+                yield line
+
+        with open_source(self.file_name) as fd:
+            # gcode_lines() yields each line as soon as it has read it.
+            for _ in gcode_lines(numbered_lines(source_lines(fd))):
+                if self._line_iter is None:
+                    return      # Closed
+                self.file_lines.append(numbered[0])
+
+        if not self.counted:
+            # The G-code lines plus the leader line.  A file with no
+            # G-code still sends a line with the % marker.
+            self.line_count = 1 + max(1, len(self.file_lines))
+            self.counted = True
+
+    def _open_lines(self) -> Iterator[str]:
+        """ Generator of the lines to send, read lazily from the file. """
+        if self.plan is not None:
+            yield from self.plan.open_lines()
+            return
+        yield from self._file_lines(open_source(self.file_name))
 
-        # Add initial blank line for the Matsuura LSK (Leader Skip) to eat.
-        self.line_buf.insert(0, "\r\n")
+    @staticmethod
+    def _file_lines(fd) -> Iterator[str]:
+        """ The lines to send, read lazily from the open file fd, which
+            is closed at the end.
+        """
+        with fd:
+            yield from framed_lines(padded_lines(gcode_lines(source_lines(fd))))
 
-        self.lines_sent = 0
-        self.crc32_value = 0    # Reset -- computed as read()/sent
+    @staticmethod
+    def _resumed_lines(preamble, lines: Iterator[str]) -> Iterator[str]:
+        """ The leader line, the preamble, then lines. """
+        try:
+            yield "\r\n"
+            yield from preamble
+            yield from lines
+        finally:
+            lines.close()
+
+    def sent_file_line(self) -> Optional[int]:
+        """ The line in the file of the last line sent, or None if no line
+            from the file has been sent or we can't tell.
+
+            Called from the event loop, so it never reads the file: with a
+            plan the line comes from the plan's resume index, if the
+            preflight has made one, with one small read.
+            Raises OSError on error.
+        """
+        line = self.lines_sent - 1
+        if self.plan is not None:
+            line += self._line_skew
+            if line < (1 if self.resume is None else self.resume.line):
+                return None
+            if self._resume_index is None:
+                self._resume_index = ResumeIndex.load(self.file_name,
+                                                      self.plan)
+                if self._resume_index is None:
+                    return None
+            return self._resume_index.file_line(min(line, self.plan.lines - 1))
+        if not 1 <= line <= len(self.file_lines):
+            return None
+        return self.file_lines[line - 1]
+
+    def close(self) -> None:
+        """ Close the file if we are part way through sending it. """
+        if self._line_iter is not None:
+            self._line_iter.close()
+            self._line_iter = None
+        if self._source is not None:
+            self._source.close()    # In case no line was read from it
+            self._source = None
+
+    def read_lines(self, max_size: int) -> Optional[str]:
+        """ Like read_line(), but adds on following whole lines while
+            they fit in max_size.  Only when we know the line sizes.
+        """
+        data = self.read_line(max_size)
+        if data is None:
+            return None
+        while self.timing is not None and not self.read_buffer:
+            timing = self._line_timing(self.lines_sent)
+            if timing is None or len(data) + timing[0] > max_size:
+                break
+            line = self.read_line()
+            if line is None:
+                break
+            data += line
+        return data
 
     def read_line(self, max_size=0) -> Optional[str]:
         """ Return next line to send (with CR LF added)
@@ -610,8 +1276,22 @@ class FileToSend:
         if self.read_buffer:
             line = self.read_buffer
         else:
-            line = self.line_buf[self.lines_sent]
+            if self._line_iter is None:
+                self._line_iter = self._open_lines()
+            line = next(self._line_iter, None)
+            if line is None:
+                # The end, before count_lines() got there, or the file
+                # got shorter since it was counted.  Nothing more to
+                # send, so call it done.
+                if not self.counted:
+                    self.line_count = self.lines_sent
+                    self.counted = True
+                self.lines_sent = self.lines
+                self.close()
+                return None
             self.lines_sent += 1
+            if self.counted and self.lines_sent >= self.lines:
+                self.close()
         if max_size:
             # Split into two parts
             self.read_buffer = line[max_size:]
@@ -697,7 +1377,7 @@ class SerialPort:
         """
         if self.is_open:
             try:
-                cts = self.serial_connection.cts
+                cts = self.read_cts()
                 if DEBUG_FAKE_CTS:
                     cts = self.fake_cts()
                 return cts
@@ -705,6 +1385,9 @@ class SerialPort:
                 self.log_and_close(err)
         return False
 
+    def read_cts(self) -> bool:
+        return self.serial_connection.cts
+
     @staticmethod
     def fake_cts():
         return (time.time() % (FAKE_CTS_ON + FAKE_CTS_OFF)) > FAKE_CTS_OFF
@@ -778,11 +1461,72 @@ class SerialPort:
         """
         if self.is_open:
             try:
-                return self.serial_connection.out_waiting
+                return self.read_out_waiting()
             except OSError as err:
                 self.log_and_close(err)
         return 0
 
+    def read_out_waiting(self) -> int:
+        return self.serial_connection.out_waiting
+
+
+class SimulatedSerialPort(SerialPort):
+    """ A pty from matsuura_simulator.py, which has no CTS wire or output
+        buffer.  CTS and out_waiting come from the simulator instead, see
+        pty_lines.py.  Used when SERIAL_SIMULATOR is 1.
+    """
+    def __init__(self, port_name: str):
+        self.pty_lines: Optional[PtyLines] = None
+        super().__init__(port_name)
+
+    def open(self):
+        super().open()
+        try:
+            self.pty_lines = PtyLines(self.port_name + LINES_SUFFIX)
+        except (OSError, ValueError) as err:
+            log(f"{self.port_name} is not a simulator port: {err}")
+            self.close()
+            raise serial.SerialException(str(err))
+
+    def read_cts(self) -> bool:
+        return self.pty_lines.cts
+
+    def read_out_waiting(self) -> int:
+        return self.pty_lines.out_waiting
+
+    def close(self):
+        super().close()
+        if self.pty_lines is not None:
+            self.pty_lines.close()
+            self.pty_lines = None
+
+
+def machine_ports(serial_ports: str, default_port_name: str) -> Dict[str, str]:
+    """ Machine name to serial port name, in order, from SERIAL_PORTS.
+
+        e.g. "matsuura=/dev/ttyUSB0, yasnac=/dev/ttyUSB1".  If empty, the
+        one machine is DEFAULT_MACHINE_NAME on default_port_name.
+        Raises ValueError if it does not make sense.
+    """
+    ports: Dict[str, str] = {}
+    for entry in serial_ports.split(","):
+        if not entry.strip():
+            continue
+        name, equals, port_name = entry.partition("=")
+        name = name.strip()
+        port_name = port_name.strip()
+        if not equals or not name or not port_name:
+            raise ValueError(f"SERIAL_PORTS entry {entry.strip()!r}"
+                             f" is not name=port")
+        if name in ports:
+            raise ValueError(f"SERIAL_PORTS has machine {name!r} twice")
+        if port_name in ports.values():
+            raise ValueError(f"SERIAL_PORTS has port {port_name!r} twice")
+        ports[name] = port_name
+    if not ports:
+        ports[DEFAULT_MACHINE_NAME] = default_port_name
+    return ports
+
 
 def log(message: str):
     """ Write string s to stderr with ms timestamp. """
@@ -797,6 +1541,34 @@ def log(message: str):
     sys.stderr.write(f" {message.rstrip()}\n")
 
 
+def log_timing(file_name: str, timing: dict):
+    """ Log the drip feed projection for a file about to be sent. """
+    log(f"{file_name}: runs {format_duration(timing['machine_seconds'])},"
+        f" {format_duration(timing['link_seconds'])} to send,"
+        f" drip feed ETA {format_duration(timing['drip_feed_seconds'])},"
+        f" waiting on the line {timing['starved_seconds']:.1f} s")
+    for first, last, wait in timing["link_bound"]:
+        log(f"{file_name}: link bound at lines {first}-{last},"
+            f" machine waits {wait:.1f} s")
+
+
+def log_compaction(file_name: str, compaction: dict):
+    """ Log what compaction took out of a file about to be sent. """
+    saved = compaction["chars_before"] - compaction["chars_after"]
+    log(f"{file_name}: compacted, {saved} of {compaction['chars_before']}"
+        f" chars and {compaction['lines_dropped']} lines taken out,"
+        f" {format_duration(compaction['seconds_saved'])} less to send")
+
+
+def log_arcs(file_name: str, arcs: dict):
+    """ Log what arc fitting did to a file about to be sent. """
+    saved = arcs["chars_before"] - arcs["chars_after"]
+    log(f"{file_name}: {arcs['arcs']} arcs fitted, {arcs['blocks_removed']}"
+        f" blocks and {saved} chars taken out,"
+        f" {format_duration(arcs['seconds_saved'])} less to send,"
+        f" deviation up to {arcs['max_deviation_mm']:.4f} mm")
+
+
 def list_ports():
     # list available ports. For debugging
     iterator = serial.tools.list_ports.comports()
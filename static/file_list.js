@@ -0,0 +1,97 @@
+$(document).ready(() => {
+
+  // The file list on the index page, a page at a time from /files, so
+  // the first files show at once however many there are.
+
+  var next_cursor = null;   // where the next page starts, null at the end
+  var loading = false;
+  var generation = 0;       // bumped when the sort or search changes
+  var search_timer = null;
+
+  function esc(s) {
+    return $('<div>').text(s).html();
+  }
+
+  function file_row(f) {
+    let o = '';
+    o += '<div class="row m-2 div-custom-bordered" style="margin-left:1%;">';
+    o += '<div class="col-md-9 m-1"><span style="font-size:+1.5em;font-weight:bolder;"> ' + esc(f['file_name']) + ' </span> ';
+    o += '<span style="font-family: Courier;padding-left:5em;"> ' + esc(f['first_line']) + ' </span>';
+    o += f['summary'];  // rendered by the server from preflight.html
+    o += '</div>';
+    o += '<div class="float-right">';
+    o += '<button type="submit" class="btn btn-lg btn-primary m-1" name="file_to_send" value="' + esc(f['file_name']) + '"> SEND</button>';
+    o += '<button type="submit" class="btn btn-lg btn-danger m-1" name="file_to_delete" value="' + esc(f['file_name']) + '"> DELETE</button>';
+    o += '</div>';
+    o += '</div>';
+    return o;
+  }
+
+  function load_page(first) {
+    if (loading && !first) {
+      return;
+    }
+    if (first) {
+      generation += 1;
+      next_cursor = null;
+    }
+    let sort = $('#file_sort').val().split(' ');
+    let data = {'sort': sort[0], 'order': sort[1] || 'asc', 'q': $('#file_search').val()};
+    if (!first) {
+      data['cursor'] = next_cursor;
+    }
+    let asked = generation;
+    loading = true;
+    $.ajax( {
+      type: 'GET',
+      url: '/files',
+      data: data,
+      success: (r) => {
+        if (asked != generation) {
+          return;   // the sort or search changed since
+        }
+        if (first) {
+          $('#file_list').empty();
+          $('#file_total').text('(' + r['total'] + ')');
+        }
+        $('#file_list').append(r['files'].map(file_row).join(''));
+        next_cursor = r['next'];
+        $('#file_more').toggle(next_cursor != null);
+      },
+      complete: () => {
+        if (asked == generation) {
+          loading = false;
+          more_if_near_end();
+        }
+      }
+    });
+  }
+
+  function more_if_near_end() {
+    // keep loading while the end of the list is on the screen
+    if (next_cursor == null || loading) {
+      return;
+    }
+    if ($('#file_more').offset().top < $(window).scrollTop() + 2 * $(window).height()) {
+      load_page(false);
+    }
+  }
+
+  $(window).on('scroll', more_if_near_end);
+
+  $(document).on('click','#file_more', (ev) => {
+    ev.preventDefault();
+    load_page(false);
+  });
+
+  $(document).on('change','#file_sort', () => {
+    load_page(true);
+  });
+
+  $(document).on('input','#file_search', () => {
+    clearTimeout(search_timer);
+    search_timer = setTimeout(() => { load_page(true); }, 300);
+  });
+
+  load_page(true);
+});
@@ -5,11 +5,27 @@ $(document).ready(() => {
   var idle_intrvl_sending_secs = 2;
   var idle_intrvl_idle_secs = 5;
   var idle_intrvl_secs = idle_intrvl_idle_secs;
+  var event_source = null; // server push of status changes
+  var status_machine = ''; // machine the sender answered the last status for
 
   function show_loader() {
     $('#message_div').html(mesg('fa-cog fa-spin','','warning'));
   }
 
+  function machine() {
+    // machine picked on the send page, '' for the sender's default
+    return $('#machine_select').val() || '';
+  }
+
+  function shown_machine() {
+    // the machine whose status we show
+    return machine() || status_machine;
+  }
+
+  function machine_arg() {
+    return '&machine=' + encodeURIComponent(machine());
+  }
+
   function mesg(i,m,c) {
     // primary, secondary, success, danger, warning, info, light, dark
     let o = '';
@@ -32,10 +48,32 @@ $(document).ready(() => {
   }
 
   $(document).on('click','#send_start_btn', () => {
+    start_cmd('cmd=start&file=' + encodeURIComponent($('#send_start_btn').val()));
+  });
+
+  function resume_cmd(line, safe) {
+    // restart part way through, see gcode_resume.py
+    start_cmd('cmd=resume&file=' + encodeURIComponent($('#send_start_btn').val()) +
+              '&line=' + encodeURIComponent(line) + '&safe=' + safe);
+  }
+
+  $(document).on('click','#resume_safe_btn', () => {
+    resume_cmd($('#resume_line').val(), 1);
+  });
+
+  $(document).on('click','#resume_line_btn', () => {
+    resume_cmd($('#resume_line').val(), 0);
+  });
+
+  $(document).on('click','.resume_tool_btn', (ev) => {
+    resume_cmd($(ev.currentTarget).val(), 1);
+  });
+
+  function start_cmd(data) {
     $.ajax( {
       type: 'PUT',
       url: '/api',
-      data: 'cmd=start&file=' + $('#send_start_btn').val(),
+      data: data + machine_arg(),
       beforeSend: () => { 
         show_loader();
         idle_counter = 0;
@@ -50,13 +88,13 @@ $(document).ready(() => {
         last_status_message = r['message']
       }
     });
-  });
+  }
 
   $(document).on('click','#send_stop_btn', () => {
     $.ajax( {
       type: 'PUT',
       url: '/api',
-      data: 'cmd=stop',
+      data: 'cmd=stop' + machine_arg(),
       beforeSend: () => { 
         show_loader();
         idle_counter = 0;
@@ -76,12 +114,56 @@ $(document).ready(() => {
     get_status();
   });
 
+  function queue_cmd(data) {
+    // change the queue, then show the page again with the new queue
+    $.ajax( {
+      type: 'PUT',
+      url: '/api',
+      data: data + machine_arg(),
+      beforeSend: () => { 
+        show_loader();
+        idle_counter = 0;
+      },
+      success: (r) => { 
+        if (r['error'] == 1) {
+          $('#message_div').html(mesg('fa-bomb',r['message'],'danger'));
+          last_status_message = r['message']
+        } else {
+          show_send_page();
+        }
+      }
+    });
+  }
+
+  function show_send_page() {
+    window.location.search = '?file_to_send=' +
+      encodeURIComponent($('#send_start_btn').val()) + machine_arg();
+  }
+
+  $(document).on('click','#send_queue_btn', () => {
+    queue_cmd('cmd=enqueue&auto=1&file=' + encodeURIComponent($('#send_queue_btn').val()));
+  });
+
+  $(document).on('click','.queue_up_btn', (ev) => {
+    let b = $(ev.currentTarget);
+    queue_cmd('cmd=move&job=' + b.val() + '&position=' + b.data('position'));
+  });
+
+  $(document).on('click','.queue_cancel_btn', (ev) => {
+    queue_cmd('cmd=cancel&job=' + $(ev.currentTarget).val());
+  });
+
+  $(document).on('change','#machine_select', () => {
+    // the queue shown is for the machine picked
+    show_send_page();
+  });
+
   function get_status() {
     //$('#message_div').html(mesg('fa-binoculars ','under construction','warning'));
     $.ajax( {
       type: 'PUT',
       url: '/api',
-      data: 'cmd=status',
+      data: 'cmd=status' + machine_arg(),
       beforeSend: () => { 
         show_loader();
         idle_counter = 0;
@@ -92,14 +174,43 @@ $(document).ready(() => {
         } else {
           $('#message_div').html(mesg('fa-binoculars',r['message'],'success'));
         }
+        status_machine = r['machine'] || '';
         last_status_message = r['message']
       }
     });
   }
 
+  function show_event(r) {
+    // status change pushed from the server, for any machine
+    if (r['machine'] && shown_machine() && r['machine'] != shown_machine())
+      return;
+    if (r['error'] == 1) {
+      $('#message_div').html(mesg('fa-bomb',r['message'],'danger'));
+    } else {
+      $('#message_div').html(mesg('fa-binoculars',r['message'],'success'));
+    }
+    last_status_message = r['message']
+  }
+
+  function start_push_events() {
+    // get status changes pushed to us as they happen. falls back
+    // to polling in periodic_chores() when this is not working
+    if (!window.EventSource)
+      return;
+    // the browser reconnects on its own if the stream drops
+    event_source = new EventSource('/events');
+    event_source.onmessage = (m) => {
+      show_event(JSON.parse(m.data));
+    };
+  }
+
   function periodic_chores() {
     // tend to periodic housekeeping chores
     idle_counter++;
+    if (event_source && event_source.readyState == EventSource.OPEN) {
+      // status is being pushed to us, no need to poll
+      idle_counter = 0;
+    }
     if (idle_counter >= idle_intrvl_secs) {
       idle_counter = 0;
       get_status();
@@ -112,8 +223,13 @@ $(document).ready(() => {
       idle_intrvl_secs = idle_intrvl_idle_secs;
   }
 
-  setInterval(periodic_chores,  1000);
+  // only pages that show the sender status poll for it or open /events,
+  // the login page would just be redirected
+  if ($('#message_div').length) {
+    setInterval(periodic_chores,  1000);
 
-  get_status();
+    get_status();
+    start_push_events();
+  }
 
 });
@@ -0,0 +1,252 @@
+"""
+
+upload_store.py - stream uploads straight into UPLOAD_PATH
+
+Flask normally buffers an uploaded file (in memory, or in a temp file in
+/tmp if it is big) and then image.save() copies it into UPLOAD_PATH.  On the
+Pi that means a big G-code upload is held twice and copied once more before
+the worker is free again.
+
+Instead the web app hands the form parser a HashingTempFile for each file.
+It is a hidden temp file in UPLOAD_PATH itself, the data is written to it as
+it arrives off the network, and the CRC32 and SHA-256 are worked out on the
+way through.  save_upload() then just renames it into place, which is
+atomic, so the serial sender and the file listing never see half a file.
+
+A file bigger than the limit is stopped part way with UploadTooLarge.
+
+The same program gets uploaded again and again under other names, so what
+is saved is a blob in UPLOAD_PATH/.blobs named by its SHA-256, and the name
+the user sees is a symlink to it.  Everything else opens the name and gets
+the blob, and the send plan, timing and resume files are kept next to the
+blob (see plan_path() in send_plan.py), so every name for the same bytes
+shares them.  An upload whose blob is already there just has its temp file
+thrown away, without the fsync, and the web app uses the plan it already
+has instead of making one.  When the last name for a blob is deleted or
+uploaded over, the blob and its plan go too.  Finding a blob and linking
+to it, and finding no links to a blob and removing it, are done holding a
+lock (see blob_lock()) so the two can't cross.  Files saved before there was
+a blob store are plain files and are left as they are.
+
+G-code compresses 5 to 10 times, so blobs are gzip files, compressed as the
+upload arrives.  Whatever reads an upload opens it with open_source() in
+send_plan.py, which streams it through a decompressor when it starts with
+the gzip magic, so the G-code, offsets, lines sent and CRC are all as they
+would be from the plain file, and nothing is ever held decompressed in
+memory.  The send plan is the exception on disk: it holds the cleaned up
+G-code uncompressed, so the sender can seek straight to any line, and
+takes about as much room as the upload did before it was compressed.  The
+sizes shown in the file list are of the G-code, not the blob (see
+scan_file() in file_index.py).
+
+"""
+
+import os
+import gzip
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from zlib import crc32
+
+import send_plan
+
+UPLOAD_TEMP_PREFIX = ".upload-"     # Hidden, so listings skip it
+BLOB_DIR_NAME = ".blobs"            # Hidden sub directory of UPLOAD_PATH
+BLOB_LOCK_NAME = ".lock"            # In BLOB_DIR_NAME, see blob_lock()
+COMPRESS_LEVEL = 3      # Most of what 6 saves, at twice the speed
+UPLOAD_CHUNK_SIZE = 64 * 1024       # Bytes per copy when not streamed
+DEFAULT_MAX_UPLOAD_MB = 64
+
+
+class UploadTooLarge(OSError):
+    """ An uploaded file is over the size limit.
+
+        Not a ValueError, the form parser quietly drops those.
+    """
+
+
+class HashingTempFile:
+    """ A temp file in the upload directory that hashes what is written,
+        and compresses it on the way to the disk.
+
+        Removed on close() unless save_upload() renamed it into place.
+    """
+    def __init__(self, upload_path: str, max_size: Optional[int] = None):
+        self.max_size = max_size
+        self.size = 0
+        self.crc32_value = 0
+        self.sha256 = hashlib.sha256()
+        fd, self.name = tempfile.mkstemp(dir=upload_path,
+                                         prefix=UPLOAD_TEMP_PREFIX)
+        self.file = open(fd, 'w+b')
+        self.gzip = gzip.GzipFile(fileobj=self.file, mode='wb',
+                                  compresslevel=COMPRESS_LEVEL, mtime=0)
+        self.saved = False
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            # The form parser won't close a file it did not finish.
+            self.close()
+            raise UploadTooLarge(f"upload over {self.max_size} bytes")
+        self.crc32_value = crc32(data, self.crc32_value)
+        self.sha256.update(data)
+        self.gzip.write(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # The form parser rewinds it when the upload is in.  Nothing
+        # reads it back until it is the blob, through open_source().
+        return 0
+
+    def __getattr__(self, name):
+        # tell(), flush() and the rest go to the file.
+        return getattr(self.file, name)
+
+    def finish(self) -> None:
+        """ Write out the end of the compressed data and get it all onto
+            the disk.  Does nothing the second time.
+        """
+        if self.gzip.closed:
+            return
+        self.gzip.close()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        if not self.gzip.closed:
+            self.gzip.close()
+        if not self.file.closed:
+            self.file.close()
+        if not self.saved:
+            try:
+                os.unlink(self.name)
+            except FileNotFoundError:
+                pass
+
+    def hashes(self) -> dict:
+        return {"size": self.size, "crc32": self.crc32_value,
+                "sha256": self.sha256.hexdigest()}
+
+
+def save_upload(stream, path: str, max_size: Optional[int] = None) -> dict:
+    """ Put an uploaded file at path and return its size and hashes, and
+        "deduplicated" true if its blob was already there.
+
+        A HashingTempFile becomes the blob, or is dropped if the blob is
+        there, and path is made a link to the blob.  Any other stream is
+        copied in chunks to a temp file next to path, hashed on the way,
+        and saved the same way.
+
+        Raises OSError on error, UploadTooLarge if over max_size.
+    """
+    upload_path = os.path.dirname(path) or '.'
+    if not isinstance(stream, HashingTempFile):
+        temp = HashingTempFile(upload_path, max_size)
+        try:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                temp.write(chunk)
+            return save_upload(temp, path)
+        finally:
+            temp.close()
+
+    hashes = stream.hashes()
+    blob = blob_path(upload_path, hashes["sha256"])
+    if not os.path.isfile(blob):
+        # Most likely new, fsync it before taking the lock.
+        stream.finish()
+
+    previous = blob_of(path)
+    if previous is None and os.path.isfile(path):
+        # A plain file from before the blob store, its plan is its own.
+        send_plan.remove_plan(path)
+    link_name = stream.name + ".link"   # mkstemp made the name unique
+    with blob_lock(upload_path):
+        # Look again, it may have been uploaded or released meanwhile.
+        deduplicated = os.path.isfile(blob)
+        if deduplicated:
+            stream.close()      # Removes it
+        else:
+            stream.finish()
+            os.chmod(stream.name, 0o644)    # mkstemp makes it owner only
+            os.replace(stream.name, blob)
+            stream.saved = True
+        os.symlink(os.path.join(BLOB_DIR_NAME, hashes["sha256"]), link_name)
+        os.replace(link_name, path)
+    if previous is not None and previous != hashes["sha256"]:
+        release_blob(upload_path, previous)
+    return dict(hashes, deduplicated=deduplicated)
+
+
+@contextmanager
+def blob_lock(upload_path: str) -> Iterator[None]:
+    """ Held while looking for a blob and linking to it, and while looking
+        for links to a blob and removing it, so another worker can't
+        remove a blob between an upload finding it and linking to it.
+    """
+    blob_dir = os.path.join(upload_path, BLOB_DIR_NAME)
+    os.makedirs(blob_dir, exist_ok=True)
+    fd = os.open(os.path.join(blob_dir, BLOB_LOCK_NAME),
+                 os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)    # Drops the lock
+
+
+def blob_path(upload_path: str, sha256: str) -> str:
+    """ Where the blob with the SHA-256 hex digest lives. """
+    return os.path.join(upload_path, BLOB_DIR_NAME, sha256)
+
+
+def blob_of(path: str) -> Optional[str]:
+    """ The SHA-256 of the blob the upload at path links to, or None if
+        it is not a link to a blob.
+    """
+    try:
+        target = os.readlink(path)
+    except OSError:
+        return None
+    if os.path.dirname(target) != BLOB_DIR_NAME:
+        return None
+    return os.path.basename(target)
+
+
+def remove_upload(path: str) -> None:
+    """ Delete the upload at path, and its blob and plan if nothing else
+        links to them.
+        Raises OSError on error.
+    """
+    sha256 = blob_of(path)
+    os.unlink(path)
+    if sha256 is None:
+        send_plan.remove_plan(path)
+    else:
+        release_blob(os.path.dirname(path) or '.', sha256)
+
+
+def release_blob(upload_path: str, sha256: str) -> None:
+    """ Remove a blob and its plan if no upload links to it any more. """
+    with blob_lock(upload_path):
+        with os.scandir(upload_path) as it:
+            for entry in it:
+                if entry.is_symlink() and blob_of(entry.path) == sha256:
+                    return
+        blob = blob_path(upload_path, sha256)
+        try:
+            os.unlink(blob)
+        except FileNotFoundError:
+            pass
+        send_plan.remove_plan(blob)
+
+
+def max_upload_size() -> int:
+    """ Upload size limit in bytes, from MAX_UPLOAD_MB. """
+    return int(float(os.environ.get('MAX_UPLOAD_MB', DEFAULT_MAX_UPLOAD_MB))
+               * 1024 * 1024)
@@ -0,0 +1,250 @@
+"""
+
+upload_watcher.py - keep the file index up to date as uploads come and go
+
+Files get into UPLOAD_PATH by upload, but also by copying them in over SSH
+or SMB, and get deleted by /file_action or by hand.  Rather than scan the
+directory on every request to notice, one web server worker watches it
+with Linux inotify and tells the app about each name that was created,
+written, renamed or deleted, so the file index (file_index.py), the send
+plan (send_plan.py) and the preflight summary (gcode_preflight.py) are
+brought up to date once, in the background.
+
+Names are handled once no more events have come for them for
+SETTLE_SECONDS, so a file being copied in is looked at when the copy is
+done, and a web upload has made its own send plan by then.  When watching
+starts, and if the kernel's event queue overflows, the whole directory is
+synced with the index instead.
+
+Every worker starts a watcher, after it is forked, but only the one
+holding the lock on WATCH_LOCK_NAME watches.  The others wait on the lock
+and take over if that worker goes away, or if its watch fails.
+watching() tells a request whether the index is being kept up to date, or
+whether it has to sync the index itself as before (on a box without
+inotify, say).  Each worker looks at the lock at most every
+WATCHING_SECONDS.
+
+"""
+
+import os
+import sys
+import time
+import fcntl
+import errno
+import select
+import struct
+import ctypes
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+WATCH_LOCK_NAME = ".watch.lock"     # Hidden file in UPLOAD_PATH
+SETTLE_SECONDS = 2.0
+RETRY_SECONDS = 60.0                # After the watch failed
+WATCHING_SECONDS = 5.0              # How long watching() trusts its answer
+READ_SIZE = 64 * 1024
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct("iIII")       # wd, mask, cookie, len, then the name
+
+# IN_MODIFY is left out, a file being written is looked at when it is
+# closed.  IN_CREATE is for links, which are never written.
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR)
+GONE_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+
+def _libc():
+    """ libc if it has inotify, else None. """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def available() -> bool:
+    """ True if this box has inotify. """
+    return _libc() is not None
+
+
+_watching: Dict[str, Tuple[float, bool]] = {}  # path: (when, answer)
+
+
+def watching(upload_path: str) -> bool:
+    """ True if some worker is watching upload_path and keeping the file
+        index up to date.  Asked on every page, so the answer is kept for
+        WATCHING_SECONDS.
+    """
+    now = time.monotonic()
+    checked = _watching.get(upload_path)
+    if checked is None or now - checked[0] > WATCHING_SECONDS:
+        checked = _watching[upload_path] = (now, _lock_held(upload_path))
+    return checked[1]
+
+
+def _lock_held(upload_path: str) -> bool:
+    """ True if some worker holds the lock on WATCH_LOCK_NAME. """
+    try:
+        fd = os.open(os.path.join(upload_path, WATCH_LOCK_NAME),
+                     os.O_RDONLY | os.O_CREAT, 0o644)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True     # The watcher holds it
+    except OSError:
+        return False
+    finally:
+        os.close(fd)    # Drops our lock too
+    return False
+
+
+class UploadWatcher:
+    """ Watches one upload directory in a background thread.
+
+        changed(name) is called for a file that is new or has changed,
+        removed(name) for one that is gone.  Both are called from the
+        watcher thread, one at a time.
+    """
+    def __init__(self, index, changed: Callable[[str], None],
+                 removed: Callable[[str], None]):
+        self.index = index              # file_index.FileIndex
+        self.upload_path = index.upload_path
+        self.changed = changed
+        self.removed = removed
+        self.due: Dict[str, float] = {}  # name: when to handle it
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def start(self) -> bool:
+        """ Start the watcher thread, unless this process has one.
+            Cheap enough to call on every request.
+            False if there is no inotify.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # We were forked, the thread belongs to our parent.
+                self.thread = None
+                self.due = {}
+                self.pid = os.getpid()
+            if self.thread is not None:
+                return True
+            if not available():
+                return False
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return True
+
+    def run(self):
+        lock_fd = os.open(os.path.join(self.upload_path, WATCH_LOCK_NAME),
+                          os.O_RDONLY | os.O_CREAT, 0o644)
+        while True:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)  # Wait our turn
+            try:
+                self.watch()
+            except Exception as err:
+                # Anything, a locked index say, must not leave us holding
+                # the lock with nobody watching.
+                log(f"upload watcher: {self.upload_path}: {err!r}")
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            time.sleep(RETRY_SECONDS)
+
+    def watch(self) -> None:
+        """ Watch the directory until it goes away.
+            Raises OSError if it can't be watched.
+        """
+        libc = _libc()
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise_errno("inotify_init1")
+        try:
+            if libc.inotify_add_watch(fd, os.fsencode(self.upload_path),
+                                      WATCH_MASK) < 0:
+                raise_errno("inotify_add_watch")
+            # Watch first so nothing changes between the sync and the
+            # first event unseen.
+            self.rescan()
+            while True:
+                timeout = None
+                if self.due:
+                    timeout = max(0.0, min(self.due.values()) - time.time())
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if ready:
+                    data = os.read(fd, READ_SIZE)
+                    if not self.events(data):
+                        raise OSError(errno.ENOENT, "directory went away")
+                self.settled()
+        finally:
+            os.close(fd)
+
+    def events(self, data: bytes) -> bool:
+        """ Note the names in a read of inotify events.
+            Returns False if the directory itself went away.
+        """
+        offset = 0
+        settle = time.time() + SETTLE_SECONDS
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                log("upload watcher: events lost, rescanning")
+                self.rescan()
+            elif mask & GONE_MASK:
+                return False
+            elif name and not name.startswith(b'.'):
+                # skip hidden files and dirs like the send plans
+                self.due[os.fsdecode(name)] = settle
+        return True
+
+    def settled(self) -> None:
+        """ Handle the names nothing has happened to for a while. """
+        now = time.time()
+        for name in [n for n, due in self.due.items() if due <= now]:
+            del self.due[name]
+            path = os.path.join(self.upload_path, name)
+            try:
+                if os.path.isfile(path):
+                    self.changed(name)
+                elif not os.path.lexists(path):
+                    self.removed(name)
+            except Exception as err:
+                log(f"upload watcher: {name}: {err!r}")
+
+    def rescan(self) -> None:
+        """ Sync the index with the directory and handle what changed. """
+        self.due.clear()
+        for name in self.index.sync():
+            try:
+                self.changed(name)
+            except Exception as err:
+                log(f"upload watcher: {name}: {err!r}")
+
+
+def raise_errno(what: str):
+    err = ctypes.get_errno()
+    raise OSError(err, f"{what}: {os.strerror(err)}")
+
+
+def log(message: str) -> None:
+    sys.stderr.write(message + "\n")
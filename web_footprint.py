@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+
+web_footprint.py - how long the web app takes to start and how much memory
+it uses
+
+    python3 web_footprint.py            import the app in a fresh python
+    python3 web_footprint.py --pid PID  memory of a running gunicorn
+
+The first imports app.py in a new interpreter, as a gunicorn worker would,
+with python's -X importtime, and shows the time from starting python to
+the first page served (logged in, the file list page, through Flask's
+test client), the time spent importing the app and the modules it imports
+that took longest, and the resident memory after that.  Run it from the
+directory with the .env the app uses.
+
+The second adds up the memory of a running gunicorn master (the PID in
+`systemctl status matsuura_uploader`) and its workers.  RSS counts pages
+the processes share once per process, PSS shares them out, so with the app
+preloaded (see gunicorn.conf.py) PSS is what the web app really costs.
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+TOP_IMPORTS = 12
+
+# Run in the new interpreter.
+CHILD = """
+import os, json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.flask_app.test_client()
+client.post('/login', data={'username': os.environ['USER_NAME'],
+                            'password': os.environ['PASSWORD']})
+page = client.get('/')
+served = time.perf_counter()
+status = dict(line.split(':', 1) for line in open('/proc/self/status'))
+print(json.dumps({'import': imported - started, 'page': served - imported,
+                  'status': page.status_code,
+                  'rss_kb': int(status['VmRSS'].split()[0])}))
+"""
+
+
+def import_report() -> int:
+    started = time.perf_counter()
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+    total = time.perf_counter() - started
+    if child.returncode != 0:
+        sys.stderr.write(child.stderr[-2000:])
+        return 1
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    print(f"python start to first page  {total:7.3f} s")
+    print(f"import app                  {result['import']:7.3f} s")
+    print(f"first page (status {result['status']})     "
+          f"{result['page']:7.3f} s")
+    print(f"RSS after first page        {result['rss_kb'] / 1024:7.1f} MB")
+    print()
+    print("slowest imports of app.py, with what they import:")
+    for name, seconds in slowest_imports(child.stderr)[:TOP_IMPORTS]:
+        print(f"  {seconds:7.3f} s  {name}")
+    return 0
+
+
+def slowest_imports(importtime: str) -> List[Tuple[str, float]]:
+    """ (module, cumulative seconds) for the modules app imports itself,
+        slowest first, from -X importtime output.
+    """
+    found = []
+    for line in importtime.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue    # The heading
+        name = fields[2].rstrip()
+        # Two more spaces for each level down, app's imports are at one.
+        if not name.startswith('  ') or name.startswith('    '):
+            continue
+        found.append((name.strip(), int(fields[1]) / 1e6))
+    return sorted(found, key=lambda item: -item[1])
+
+
+def children(pid: int) -> List[int]:
+    """ The pids of the processes pid started. """
+    found = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as fd:
+                stat = fd.read()
+        except OSError:
+            continue    # Gone
+        # The command name is in ( ) and may have spaces in it.
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            found.append(int(entry))
+    return found
+
+
+def memory_kb(pid: int) -> Dict[str, Optional[int]]:
+    """ Rss and Pss of a process in kB.  Pss is None if the kernel
+        doesn't have smaps_rollup.
+        Raises OSError if there is no such process.
+    """
+    memory: Dict[str, Optional[int]] = {'Rss': None, 'Pss': None}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as fd:
+            for line in fd:
+                key, _, value = line.partition(':')
+                if key in memory:
+                    memory[key] = int(value.split()[0])
+    except FileNotFoundError:
+        with open(f'/proc/{pid}/status') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    memory['Rss'] = int(line.split()[1])
+    return memory
+
+
+def process_report(pid: int) -> int:
+    totals: Dict[str, Optional[int]] = {'Rss': 0, 'Pss': 0}
+    print(f"{'pid':>7}  {'RSS MB':>8}  {'PSS MB':>8}")
+    for each in [pid] + children(pid):
+        try:
+            memory = memory_kb(each)
+        except OSError as err:
+            sys.stderr.write(f"{each}: {err}\n")
+            continue
+        for key in totals:
+            if memory[key] is not None and totals[key] is not None:
+                totals[key] += memory[key]
+            else:
+                totals[key] = None
+        print(f"{each:7}  {mb(memory['Rss'])}  {mb(memory['Pss'])}")
+    print(f"{'total':>7}  {mb(totals['Rss'])}  {mb(totals['Pss'])}")
+    return 0
+
+
+def mb(kb: Optional[int]) -> str:
+    return f"{'-':>8}" if kb is None else f"{kb / 1024:8.1f}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="import time and memory of the web app")
+    parser.add_argument('--pid', type=int,
+                        help="report the memory of this gunicorn master "
+                             "and its workers instead")
+    args = parser.parse_args()
+    if args.pid is not None:
+        return process_report(args.pid)
+    return import_report()
+
+
+if __name__ == '__main__':
+    sys.exit(main())